@@ -7,17 +7,23 @@ import multiprocessing
 import optparse
 import os
 import Queue
+import random
 import shutil
+import socket
 import subprocess
 import sys
 import threading
 import time
-import csv
-import json
 import traceback
+import xmlrpclib
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 import multi_mechanize
-from multi_mechanize import results, progressbar
+from multi_mechanize import compare, distributed, livestats, pacing, results, progressbar, scheduler, sketch, timing, transport, writers
 
 MM_ROOT = multi_mechanize.__path__[0]
 
@@ -26,6 +32,11 @@ parser = optparse.OptionParser(usage=usage)
 parser.add_option('-p', '--port',
                   dest='port', type='int',
                   help='rpc listener port')
+parser.add_option('--controller',
+                  dest='controller',
+                  help='Run the test on the load nodes listening on the given'
+                  ' comma separated host:port list, and report their merged'
+                  ' results')
 parser.add_option('-v', '--verbose',
                   dest='verbose', action='store_true', default=False,
                   help='Produce verbose output')
@@ -33,6 +44,12 @@ parser.add_option('-R', '--reanalyze-results',
                   dest='results_dir',
                   help='Instead of running a test, reanalyze the results in the'
                   ' given directory based on the CSV data')
+parser.add_option('--compare',
+                  dest='compare', nargs=2, metavar='BASELINE CANDIDATE',
+                  help='Instead of running a test, compare the results in the'
+                  ' given candidate directory to the baseline directory, and'
+                  ' exit with 1 on regressions beyond the max_regression of'
+                  ' the project config')
 parser.add_option('--clone-test-project',
                   dest='clone_test_project', action='store_true', default=False,
                   help='Clone the test project to your <project_path>')
@@ -123,10 +140,16 @@ def main():
     if cmd_opts.results_dir:
         # Don't run a test, just reprocess past results
         reanalyze_results(project_name, project_path, cmd_opts.results_dir)
+    elif cmd_opts.compare:
+        baseline_dir, candidate_dir = cmd_opts.compare
+        sys.exit(compare_results(
+            project_name, project_path, baseline_dir, candidate_dir))
     elif cmd_opts.port:
         import multi_mechanize.rpcserver
         multi_mechanize.rpcserver.launch_rpc_server(
-            cmd_opts.port, project_name, run_test)
+            cmd_opts.port, project_name, run_remote_test, project_path)
+    elif cmd_opts.controller:
+        run_controller(project_name, project_path, cmd_opts.controller)
     else:
         run_test(project_name, project_path)
 
@@ -167,59 +190,95 @@ def clone_project_tpl(project_name, project_path, project_tpl):
         "Successfully cloned the %s project to: %s", project_tpl, project_path)
 
 def run_test(project_name, project_path, remote_starter=None):
+    start_time = stream = None
     if remote_starter is not None:
         remote_starter.test_running = True
         remote_starter.output_dir = None
+        # a controller picks the start, and fetches the results
+        start_time = remote_starter.start_time
+        stream = remote_starter.stream
 
     config_path = os.path.join(project_path, 'config.cfg')
-    run_time, rampup, console_logging, results_ts_interval, user_group_configs, results_database, post_run_script = configure(project_name, project_path, config_path)
+    run_time, rampup, console_logging, results_ts_interval, user_group_configs, results_database, post_run_script, results_format, report = configure(project_name, project_path, config_path)
 
     run_localtime = time.localtime()
     time_str = time.strftime('%Y.%m.%d_%H.%M.%S', run_localtime)
     output_dir = os.path.join(project_path, 'results', 'results_%s' % time_str)
     logger.debug("Test output directory: %s", output_dir)
 
+    # every process times the run from this one start
+    run_clock = timing.RunClock(start_time)
+
     # this queue is shared between all processes/threads
     queue = multiprocessing.Queue()
-    rw = ResultsWriter(queue, output_dir, console_logging)
+    rw = ResultsWriter(queue, output_dir, console_logging, results_format, results_ts_interval, run_clock, stream, run_time)
     rw.daemon = True
     rw.start()
+    if remote_starter is not None:
+        remote_starter.results_writer = rw
+
+    if start_time is not None:
+        logger.info('starting at %s', time.strftime(
+            '%Y-%m-%d %H:%M:%S', time.localtime(start_time)))
+        delay = -run_clock.elapsed()
+        if delay > 0:
+            time.sleep(delay)
 
     user_groups = []
+    cpu = 0
     for i, ug_config in enumerate(user_group_configs):
-        ug = UserGroup(
-            queue,
-            i,
-            ug_config.name,
-            ug_config.num_threads,
-            test_scripts[ug_config.script_file],
-            run_time,
-            rampup)
-        user_groups.append(ug)
+        # split the group's threads over its worker processes, all of them
+        # report as the same user group and process_num
+        num_processes = ug_config.num_processes
+        thread_offset = 0
+        for worker in range(num_processes):
+            num_threads = scheduler.worker_share(
+                ug_config.num_threads, worker, num_processes)
+            # each worker takes its share of the group's arrival rate. The
+            # running users of a profile are rounded for the whole group
+            # first, then split, so the workers don't round away users.
+            share = float(num_threads) / ug_config.num_threads
+            arrival_rate = None
+            if ug_config.arrival_rate is not None:
+                arrival_rate = ug_config.arrival_rate.scaled(share)
+            ug = UserGroup(
+                queue,
+                i,
+                ug_config.name,
+                num_threads,
+                test_scripts[ug_config.script_file],
+                run_time,
+                rampup,
+                ug_config.engine,
+                thread_offset=thread_offset,
+                start_delay=float(rampup) * worker / ug_config.num_threads,
+                cpu=cpu % CPU_COUNT if ug_config.pin_cpus else None,
+                arrival_rate=arrival_rate,
+                profile=ug_config.profile,
+                pacing=ug_config.pacing,
+                run_clock=run_clock,
+                worker=worker,
+                num_workers=num_processes,
+                group_threads=ug_config.num_threads)
+            user_groups.append(ug)
+            thread_offset += num_threads
+            if ug_config.pin_cpus:
+                cpu += 1
     for user_group in user_groups:
         user_group.start()
 
-    start_time = time.time()
+    scheduler.save_phases(output_dir, dict(
+        (ug_config.name, ug_config.phases())
+        for ug_config in user_group_configs if ug_config.phases()))
 
     if console_logging:
         for user_group in user_groups:
             user_group.join()
     else:
-        print '\n  user_groups:  %i' % len(user_groups)
-        print '  threads: %i\n' % (ug_config.num_threads * len(user_groups))
-        p = progressbar.ProgressBar(run_time)
-        elapsed = 0
-        while elapsed < (run_time + 1):
-            p.update_time(elapsed)
-            if sys.platform.startswith('win'):
-                print '%s   transactions: %i  timers: %i  errors: %i\r' % (p, rw.trans_count, rw.timer_count, rw.error_count),
-            else:
-                print '%s   transactions: %i  timers: %i  errors: %i' % (p, rw.trans_count, rw.timer_count, rw.error_count)
-                sys.stdout.write(chr(27) + '[A' )
-            time.sleep(1)
-            elapsed = time.time() - start_time
-
-        print p
+        print '\n  user_groups:  %i' % len(user_group_configs)
+        print '  processes: %i' % len(user_groups)
+        print '  threads: %i\n' % sum(ug_config.num_threads for ug_config in user_group_configs)
+        show_progress(rw, run_clock, run_time)
 
         while [user_group for user_group in user_groups if user_group.is_alive()] != []:
             if sys.platform.startswith('win'):
@@ -232,16 +291,17 @@ def run_test(project_name, project_path, remote_starter=None):
             print
 
     # all agents are done running at this point
-    time.sleep(.2) # make sure the writer queue is flushed
+    rw.stop()
     logger.info('analyzing results...\n')
     results.output_results(
         output_dir,
-        os.path.join(output_dir, 'results.csv'),
+        os.path.join(output_dir, writers.RESULTS_FILES[results_format]),
         run_time,
         rampup,
         results_ts_interval,
         user_group_configs,
         template_dirs=get_mm_templates_dirs(project_path),
+        report=report,
     )
     logger.info('created: %s', os.path.join(output_dir, 'results.html'))
 
@@ -250,6 +310,46 @@ def run_test(project_name, project_path, remote_starter=None):
     saved_config = os.path.join(output_dir, 'config.cfg')
     shutil.copy(project_config, saved_config)
 
+    if remote_starter is None:
+        # a node only has part of a controller's run, the controller loads
+        # the merged run and runs the post_run_script
+        post_process_results(
+            project_name, run_localtime, output_dir, results_database,
+            post_run_script, run_time, rampup, results_ts_interval,
+            user_group_configs, results_format)
+
+    logger.info('done.')
+
+    if remote_starter is not None:
+        remote_starter.output_dir = output_dir
+
+    return
+
+def run_remote_test(project_name, project_path, remote_starter):
+    """
+    Run a test for a controller. The node's run always ends up finished,
+    with the error that stopped it if any, even when the test never got to
+    start (e.g. the controller pushed a bad config). The controller would
+    wait for its results forever otherwise.
+    """
+    error = None
+    try:
+        run_test(project_name, project_path, remote_starter)
+    except SystemExit, e:
+        # configure() and the results writer exit on errors they logged
+        error = 'test exited with status %s' % e.code
+    except Exception, e:
+        logger.exception('test failed')
+        error = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        remote_starter.stream.finish(error)
+        remote_starter.test_running = False
+
+def post_process_results(
+    project_name, run_localtime, output_dir, results_database,
+    post_run_script, run_time, rampup, results_ts_interval,
+    user_group_configs, results_format):
+    """Load the results into the database and run the post_run_script."""
     if results_database is not None:
         logger.info('loading results into database: %s\n', results_database)
         import multi_mechanize.resultsloader
@@ -261,23 +361,122 @@ def run_test(project_name, project_path, remote_starter=None):
             run_time,
             rampup,
             results_ts_interval,
-            user_group_configs)
+            user_group_configs,
+            os.path.join(output_dir, writers.RESULTS_FILES[results_format]))
 
     if post_run_script is not None:
         logger.info('running post_run_script: %s\n', post_run_script)
         subprocess.call(post_run_script)
 
-    logger.info('done.')
+def show_progress(rw, run_clock, run_time):
+    """Show the progress bar and live stats until the end of the run."""
+    p = progressbar.ProgressBar(run_time)
+    elapsed = 0
+    while elapsed < (run_time + 1):
+        p.update_time(elapsed)
+        if sys.platform.startswith('win'):
+            print '%s   transactions: %i  timers: %i  errors: %i\r' % (p, rw.trans_count, rw.timer_count, rw.error_count),
+        else:
+            print '%s   transactions: %i  timers: %i  errors: %i' % (p, rw.trans_count, rw.timer_count, rw.error_count)
+            live_lines = rw.live_stats.lines(elapsed)
+            for line in live_lines:
+                print line.ljust(79)
+            sys.stdout.write((chr(27) + '[A') * (len(live_lines) + 1))
+        time.sleep(1)
+        elapsed = run_clock.elapsed()
+
+    if not sys.platform.startswith('win'):
+        # clear the live stats
+        sys.stdout.write(chr(27) + '[J')
+    print p
+
+def run_controller(project_name, project_path, nodes):
+    """
+    Run the project's test on the load nodes in ``nodes`` (host:port,...)
+    and report their merged results.
+    """
+    try:
+        nodes = distributed.parse_nodes(nodes)
+    except ValueError, e:
+        logger.critical('Bad --controller node list: %s', e)
+        sys.exit(1)
 
-    if remote_starter is not None:
-        remote_starter.test_running = False
-        remote_starter.output_dir = output_dir
+    config_path = os.path.join(project_path, 'config.cfg')
+    run_time, rampup, console_logging, results_ts_interval, user_group_configs, results_database, post_run_script, results_format, report = configure(project_name, project_path, config_path)
 
-    return
+    run_localtime = time.localtime()
+    time_str = time.strftime('%Y.%m.%d_%H.%M.%S', run_localtime)
+    output_dir = os.path.join(project_path, 'results', 'results_%s' % time_str)
+    logger.debug("Test output directory: %s", output_dir)
+
+    with open(config_path) as f:
+        config = f.read()
+    try:
+        start_time = distributed.start_nodes(nodes, config)
+    except (socket.error, xmlrpclib.Error, RuntimeError), e:
+        logger.critical('Can not start the test on all nodes: %s', e)
+        sys.exit(1)
+    run_clock = timing.RunClock(start_time)
+
+    # the nodes' batches end up on this queue, like those of local agents
+    queue = Queue.Queue()
+    rw = ResultsWriter(queue, output_dir, console_logging, results_format, results_ts_interval, run_clock, run_time=run_time)
+    rw.daemon = True
+    rw.start()
+    feeds = [distributed.NodeFeed(host, port, queue) for host, port in nodes]
+    for feed in feeds:
+        feed.start()
+    scheduler.save_phases(output_dir, dict(
+        (ug_config.name, ug_config.phases())
+        for ug_config in user_group_configs if ug_config.phases()))
+
+    delay = -run_clock.elapsed()
+    if delay > 0:
+        time.sleep(delay)
+
+    if not console_logging:
+        print '\n  nodes:  %i' % len(nodes)
+        print '  user_groups:  %i' % len(user_group_configs)
+        print '  threads per node: %i\n' % sum(ug_config.num_threads for ug_config in user_group_configs)
+        show_progress(rw, run_clock, run_time)
+    for feed in feeds:
+        while feed.is_alive():
+            logger.info('waiting for the results of %s...\r', feed.name)
+            feed.join(1)
+    if not sys.platform.startswith('win'):
+        print
+
+    rw.stop()
+    if not rw.trans_count:
+        logger.critical('No results from any node')
+        sys.exit(1)
+    if [feed for feed in feeds if feed.error is not None]:
+        logger.warning('results of some nodes are incomplete')
+    logger.info('analyzing results...\n')
+    results.output_results(
+        output_dir,
+        os.path.join(output_dir, writers.RESULTS_FILES[results_format]),
+        run_time,
+        rampup,
+        results_ts_interval,
+        user_group_configs,
+        template_dirs=get_mm_templates_dirs(project_path),
+        report=report,
+    )
+    logger.info('created: %s', os.path.join(output_dir, 'results.html'))
+
+    shutil.copy(config_path, os.path.join(output_dir, 'config.cfg'))
+
+    post_process_results(
+        project_name, run_localtime, output_dir, results_database,
+        post_run_script, run_time, rampup, results_ts_interval,
+        user_group_configs, results_format)
+
+    logger.info('done.')
 
 def reanalyze_results(project_name, project_path, results_dir):
     config_path = os.path.join(results_dir, 'config.cfg')
-    run_time, rampup, console_logging, results_ts_interval, user_group_configs, results_database, post_run_script = configure(project_name, project_path, config_path)
+    run_time, rampup, console_logging, results_ts_interval, user_group_configs, results_database, post_run_script, results_format, report = configure(project_name, project_path, config_path)
 
     # Get the top-level directory name for our results dir
     if results_dir[-1] == os.path.sep:
@@ -289,16 +488,46 @@ def reanalyze_results(project_name, project_path, results_dir):
     logger.info('Re-analyzing results...\n')
     results.output_results(
         output_dir,
-        os.path.join(output_dir, 'results.csv'),
+        os.path.join(output_dir, writers.RESULTS_FILES[results_format]),
         run_time,
         rampup,
         results_ts_interval,
         user_group_configs,
         template_dirs=get_mm_templates_dirs(project_path),
+        report=report,
     )
     logger.info('created: %s', os.path.join(output_dir, 'results.html'))
 
 
+def compare_results(project_name, project_path, baseline_dir, candidate_dir):
+    """
+    Compare two runs of the project. Returns the exit status, 1 if the
+    candidate regressed.
+    """
+    config_path = os.path.join(project_path, 'config.cfg')
+    try:
+        thresholds, alpha = compare.read_thresholds(config_path)
+    except ValueError, e:
+        logger.critical('Bad max_regression: %s', e)
+        return 2
+
+    logger.info('Comparing results...\n')
+    try:
+        regressions = compare.output_comparison(
+            baseline_dir, candidate_dir, thresholds, alpha,
+            template_dirs=get_mm_templates_dirs(project_path))
+    except IOError, e:
+        logger.critical('%s', e)
+        return 2
+    logger.info('created: %s',
+                os.path.join(candidate_dir, compare.COMPARE_FILE))
+    if regressions:
+        logger.critical('%i regressions beyond the max_regression thresholds',
+                        len(regressions))
+        return 1
+    return 0
+
+
 def configure(project_name, project_path, config_path):
     if not os.path.exists(config_path):
         logger.critical("Config file does not exist: %s", config_path)
@@ -320,28 +549,170 @@ def configure(project_name, project_path, config_path):
                 post_run_script = config.get(section, 'post_run_script')
             except ConfigParser.NoOptionError:
                 post_run_script = None
+            try:
+                results_format = config.get(section, 'results_format')
+            except ConfigParser.NoOptionError:
+                results_format = 'csv'
+            if results_format not in writers.RESULTS_FORMATS:
+                logger.critical(
+                    'Unknown results_format: %s (choose from: %s)',
+                    results_format, ', '.join(writers.RESULTS_FORMATS))
+                exit(1)
+            try:
+                report = config.get(section, 'report')
+            except ConfigParser.NoOptionError:
+                report = 'static'
+            if report not in results.REPORTS:
+                logger.critical(
+                    'Unknown report: %s (choose from: %s)',
+                    report, ', '.join(sorted(results.REPORTS)))
+                exit(1)
         else:
             threads = config.getint(section, 'threads')
             script = config.get(section, 'script')
+            try:
+                engine = config.get(section, 'engine')
+            except ConfigParser.NoOptionError:
+                engine = 'threads'
+            if engine not in AGENT_ENGINES:
+                logger.critical(
+                    'Unknown engine for user group %s: %s (choose from: %s)',
+                    section, engine, ', '.join(AGENT_ENGINES))
+                exit(1)
+            if engine == 'gevent':
+                try:
+                    import gevent
+                except ImportError:
+                    logger.critical(
+                        'User group %s needs gevent installed for its '
+                        'engine', section)
+                    exit(1)
+            try:
+                processes = config.get(section, 'processes')
+            except ConfigParser.NoOptionError:
+                processes = '1'
+            if processes == 'auto':
+                # spread the group across all cores
+                num_processes = CPU_COUNT
+            else:
+                try:
+                    num_processes = int(processes)
+                except ValueError:
+                    logger.critical(
+                        'User group %s: bad processes: %s (use a number or '
+                        '"auto")', section, processes)
+                    exit(1)
+            num_processes = max(1, min(num_processes, threads))
+            try:
+                pin_cpus = config.getboolean(section, 'pin_cpus')
+            except ConfigParser.NoOptionError:
+                pin_cpus = False
+            if pin_cpus and psutil is None:
+                logger.warning(
+                    'User group %s: install psutil to pin processes to '
+                    'CPUs, running unpinned', section)
+                pin_cpus = False
+            profiles = {}
+            for option in ('arrival_rate', 'profile'):
+                try:
+                    profiles[option] = scheduler.parse_profile(
+                        config.get(section, option))
+                except ConfigParser.NoOptionError:
+                    profiles[option] = None
+                except ValueError, e:
+                    logger.critical(
+                        'User group %s: bad %s (%s). Use load profile '
+                        'phases like "ramp 100 60, hold 300, step 200, '
+                        'spike 500 10, ramp 0 60" or steps like '
+                        '"10, 50@30, 100@60"', section, option, e)
+                    exit(1)
+            if profiles['arrival_rate'] and profiles['profile']:
+                logger.critical(
+                    'User group %s: set either arrival_rate or profile, the '
+                    'profile of an open workload group is its arrival_rate',
+                    section)
+                exit(1)
+            try:
+                think_time = pacing.parse_think_time(
+                    config.get(section, 'think_time'))
+            except ConfigParser.NoOptionError:
+                think_time = None
+            except ValueError, e:
+                logger.critical(
+                    'User group %s: bad think_time (%s). Use seconds, or '
+                    '"uniform MIN MAX", "exponential MEAN" or '
+                    '"gaussian MEAN STDEV"', section, e)
+                exit(1)
+            try:
+                iteration_pacing = pacing.parse_pacing(
+                    config.get(section, 'pacing'))
+            except ConfigParser.NoOptionError:
+                iteration_pacing = None
+            except ValueError, e:
+                logger.critical(
+                    'User group %s: bad pacing (%s)', section, e)
+                exit(1)
+            if think_time and iteration_pacing:
+                logger.critical(
+                    'User group %s: set either think_time or pacing', section)
+                exit(1)
+            if profiles['arrival_rate'] and (think_time or iteration_pacing):
+                logger.critical(
+                    'User group %s: the arrival_rate paces an open workload '
+                    'group, it takes no think_time or pacing', section)
+                exit(1)
             user_group_name = section
-            ug_config = UserGroupConfig(threads, user_group_name, script)
+            ug_config = UserGroupConfig(
+                threads, user_group_name, script, engine, num_processes,
+                pin_cpus, profiles['arrival_rate'], profiles['profile'],
+                think_time or iteration_pacing)
             user_group_configs.append(ug_config)
 
-    return (run_time, rampup, console_logging, results_ts_interval, user_group_configs, results_database, post_run_script)
+    return (run_time, rampup, console_logging, results_ts_interval, user_group_configs, results_database, post_run_script, results_format, report)
+
+
 
+AGENT_ENGINES = ('threads', 'gevent')
 
+CPU_COUNT = multiprocessing.cpu_count()
 
 class UserGroupConfig(object):
-    def __init__(self, num_threads, name, script_file):
+    def __init__(self, num_threads, name, script_file, engine='threads',
+                 num_processes=1, pin_cpus=False, arrival_rate=None,
+                 profile=None, pacing=None):
         self.num_threads = num_threads
         self.name = name
         self.script_file = script_file
-
-
+        self.engine = engine
+        self.num_processes = num_processes
+        self.pin_cpus = pin_cpus
+        # a scheduler.LoadProfile of transactions per second for open
+        # workload groups, whose threads are then a pool of agents taking
+        # transactions from a dispatcher
+        self.arrival_rate = arrival_rate
+        # a scheduler.LoadProfile of running users (capped at num_threads)
+        # for closed workload groups, instead of ramping up once
+        self.profile = profile
+        # a pacing.ThinkTime or pacing.Pacing for the wait between the
+        # iterations of every virtual user
+        self.pacing = pacing
+
+    def phases(self):
+        for profile in (self.arrival_rate, self.profile):
+            if profile is not None:
+                return profile.phases
+        return []
+
+
+
+# how often a user group with a load profile adjusts its running agents
+PROFILE_TICK = 0.1
 
 class UserGroup(multiprocessing.Process):
     def __init__(
-        self, queue, process_num, user_group_name, num_threads, script_module, run_time, rampup):
+        self, queue, process_num, user_group_name, num_threads, script_module, run_time, rampup, engine='threads',
+        thread_offset=0, start_delay=0, cpu=None, arrival_rate=None, profile=None, pacing=None,
+        run_clock=None, worker=0, num_workers=1, group_threads=None):
         multiprocessing.Process.__init__(self)
         self.queue = queue
         self.process_num = process_num
@@ -350,45 +721,165 @@ class UserGroup(multiprocessing.Process):
         self.script_module = script_module
         self.run_time = run_time
         self.rampup = rampup
-        self.start_time = time.time()
+        self.engine = engine
+        # when a user group is split over several processes, this one runs
+        # the agents numbered from thread_offset, starting after start_delay
+        self.thread_offset = thread_offset
+        self.start_delay = start_delay
+        self.cpu = cpu
+        self.arrival_rate = arrival_rate
+        # the profile is the running users of the whole user group, of
+        # which this process is worker number ``worker`` of ``num_workers``
+        self.profile = profile
+        self.worker = worker
+        self.num_workers = num_workers
+        if group_threads is None:
+            group_threads = num_threads
+        self.group_threads = group_threads
+        self.pacing = pacing
+        if run_clock is None:
+            run_clock = timing.RunClock()
+        self.run_clock = run_clock
 
     def run(self):
-        threads = []
+        if self.cpu is not None:
+            psutil.Process(os.getpid()).cpu_affinity([self.cpu])
+        if self.engine == 'gevent':
+            # every agent becomes a greenlet, and blocking calls in the test
+            # scripts (sockets, sleeps) yield to the other agents. Real
+            # threads are left alone, the results queue needs its feeder
+            # thread.
+            from gevent import monkey
+            monkey.patch_all(thread=False)
+
+        # all agents in this process share one batcher, which ships their
+        # results to the writer in binary batches
+        batcher = transport.ResultBatcher(
+            self.queue, self.user_group_name, self.process_num)
+        agents = []
+        jobs = None
+        if self.arrival_rate is not None:
+            # open workload: the whole pool of agents is there from the
+            # start, the arrival rate alone shapes the load
+            if self.engine == 'gevent':
+                from gevent.queue import Queue as JobQueue
+            else:
+                JobQueue = Queue.Queue
+            jobs = JobQueue()
+            agents.append(self.start_agent(scheduler.Dispatcher(
+                jobs, self.arrival_rate, self.run_clock, self.run_time,
+                self.num_threads)))
+        elif self.profile is not None:
+            self.run_profile(batcher)
+            return
+        else:
+            time.sleep(self.start_delay)
         for i in range(self.num_threads):
             spacing = float(self.rampup) / float(self.num_threads)
-            if i > 0:
+            if i > 0 and jobs is None:
                 time.sleep(spacing)
-            agent_thread = Agent(
-                self.queue, self.process_num, i, self.start_time, self.run_time,
-                self.user_group_name, self.script_module)
-            agent_thread.daemon = True
-            threads.append(agent_thread)
-            agent_thread.start()
-        for agent_thread in threads:
-            agent_thread.join()
+            agent = Agent(
+                batcher, self.process_num, self.thread_offset + i,
+                self.run_clock, self.run_time,
+                self.user_group_name, self.script_module, jobs,
+                self.pacing)
+            agents.append(self.start_agent(agent))
+        while [a for a in agents if self.agent_running(a)]:
+            # don't let a batch wait on a slow agent for too long
+            time.sleep(batcher.batch_delay)
+            batcher.flush(stale_only=True)
+        batcher.flush()
+
+    def run_profile(self, batcher):
+        """
+        Start and retire agents so the number of running agents follows
+        the load profile.
+
+        A retired agent keeps its thread_num until it has finished its last
+        transaction, so no two live agents share one. Until then it can hold
+        back the start of a new agent by a tick.
+        """
+        agents = []
+        running = {}  # thread_num -> (agent, handle)
+        retiring = {}  # thread_num -> handle of an agent not stopped yet
+        free = range(self.thread_offset, self.thread_offset + self.num_threads)
+        elapsed = 0
+        while elapsed < self.run_time:
+            for thread_num, handle in retiring.items():
+                if not self.agent_running(handle):
+                    del retiring[thread_num]
+                    free.append(thread_num)
+            free.sort()
+            group_target = min(int(round(self.profile.level(elapsed))),
+                               self.group_threads)
+            target = scheduler.worker_share(
+                group_target, self.worker, self.num_workers)
+            while len(running) < target and free:
+                thread_num = free.pop(0)
+                agent = Agent(
+                    batcher, self.process_num, thread_num,
+                    self.run_clock, self.run_time,
+                    self.user_group_name, self.script_module,
+                    pacing=self.pacing)
+                handle = self.start_agent(agent)
+                running[thread_num] = agent, handle
+                agents.append(handle)
+            while len(running) > target:
+                # the agent finishes its current transaction and stops
+                thread_num = max(running)
+                agent, handle = running.pop(thread_num)
+                agent.retired = True
+                retiring[thread_num] = handle
+            time.sleep(PROFILE_TICK)
+            batcher.flush(stale_only=True)
+            elapsed = self.run_clock.elapsed()
+        while [a for a in agents if self.agent_running(a)]:
+            time.sleep(batcher.batch_delay)
+            batcher.flush(stale_only=True)
+        batcher.flush()
+
+    def start_agent(self, agent):
+        """Start running ``agent``, returns a handle for agent_running()."""
+        if self.engine == 'gevent':
+            import gevent
+            return gevent.spawn(agent.run)
+        agent.daemon = True
+        agent.start()
+        return agent
+
+    def agent_running(self, handle):
+        if self.engine == 'gevent':
+            return not handle.ready()
+        return handle.is_alive()
 
 
 class Agent(threading.Thread):
     def __init__(
-        self, queue, process_num, thread_num, start_time, run_time, user_group_name, script_module):
+        self, batcher, process_num, thread_num, run_clock, run_time, user_group_name, script_module, jobs=None,
+        pacing=None):
         threading.Thread.__init__(self)
-        self.queue = queue
+        self.batcher = batcher
         self.process_num = process_num
         self.thread_num = thread_num
-        self.start_time = start_time
+        self.run_clock = run_clock
         self.run_time = run_time
         self.user_group_name = user_group_name
         self.script_module = script_module
+        # queue of intended start times (timing.clock_ns) from a
+        # scheduler.Dispatcher, for open workload user groups
+        self.jobs = jobs
+        # set to stop the agent after its current transaction
+        self.retired = False
+        # the wait between iterations, see the pacing module
+        self.pacing = pacing
+        self.rng = random.Random()
 
-        # choose most accurate timer to use (time.clock has finer granularity than time.time on windows, but shouldn't be used on other systems)
-        if sys.platform.startswith('win'):
-            self.default_timer = time.clock
-        else:
-            self.default_timer = time.time
+        # transactions and waits are all timed in nanoseconds of the
+        # monotonic clock
+        self.default_timer = timing.clock_ns
 
 
     def run(self):
-        elapsed = 0
         try:
             Transaction = getattr(self.script_module, 'Transaction')
         except NameError, e:
@@ -401,52 +892,138 @@ class Agent(threading.Thread):
             logger.critical('Failed initializing Transaction: %s', self.script_module)
             logger.critical('Aborting user group: %s\n', self.user_group_name)
             return
-        trans.custom_timers = {}
-
         # scripts have access to these vars, which can be useful for loading unique data
         trans.thread_num = self.thread_num
         trans.process_num = self.process_num
 
-        while elapsed < self.run_time:
-            error_str = ''
+        if self.jobs is None:
+            self.run_closed(trans)
+        else:
+            self.run_open(trans)
+
+    def run_transaction(self, trans):
+        """Run ``trans`` once, returns the error string ('' if it passed)."""
+        error_str = ''
+        trans.custom_timers = {}
+        try:
+            trans.run()
+        except Exception, e:  # test runner catches all script exceptions here
+            # the writers quote and intern error strings, they are kept whole
+            error_str = str(e)
+            if not error_str:
+                # We need an error string otherwise this won't be reported
+                # as an error
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                traceback.print_exception(
+                    exc_type, exc_value, exc_traceback)
+                error_str = "Undefined Error"
+        return error_str
+
+    def run_closed(self, trans):
+        """
+        Run transactions until the end of the run, back to back or with
+        the think time or pacing of the user group in between. The wait is
+        not part of any transaction's time.
+        """
+        run_clock = self.run_clock
+        run_end = run_clock.to_ns(self.run_time)
+        elapsed = 0
+        while elapsed < self.run_time and not self.retired:
             start = self.default_timer()
 
-            try:
-                trans.run()
-            except Exception, e:  # test runner catches all script exceptions here
-                error_str = str(e).replace(',', '')
-                if not error_str:
-                    # We need an error string otherwise this won't be reported
-                    # as an error
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    traceback.print_exception(
-                        exc_type, exc_value, exc_traceback)
-                    error_str = "Undefined Error"
+            error_str = self.run_transaction(trans)
 
             finish = self.default_timer()
 
-            scriptrun_time = finish - start
-            elapsed = time.time() - self.start_time
-
-            epoch = time.mktime(time.localtime())
+            scriptrun_time = (finish - start) * 1e-9
+            elapsed = run_clock.elapsed(finish)
 
-            fields = (
+            self.batcher.add(
+                run_clock.elapsed(start),
                 elapsed,
-                epoch,
-                self.user_group_name,
+                run_clock.start_time + elapsed,
                 scriptrun_time,
                 error_str,
                 trans.custom_timers)
-            self.queue.put(fields)
+
+            if self.pacing is not None:
+                wait = self.pacing.wait(
+                    self.rng, start * 1e-9, finish * 1e-9)
+                # never wait past the end of the run
+                wait = min(wait, (run_end - self.default_timer()) * 1e-9)
+                if wait > 0:
+                    time.sleep(wait)
+                elapsed = run_clock.elapsed()
+
+    def run_open(self, trans):
+        """
+        Run a transaction for every intended start time taken from the jobs
+        queue.
+
+        Response times are measured from the intended start, so time spent
+        waiting for a free agent counts against the server like it would
+        for a real user. How late each transaction started is recorded as
+        the Dispatch_Lag timer. Transactions that never got an agent before
+        the end of the run are recorded with a transport.MISSED_DISPATCH
+        error when they were given up on, after the end of the run, so the
+        report counts them on their own and leaves their lag out of its
+        tables.
+        """
+        run_clock = self.run_clock
+        while True:
+            intended = self.jobs.get()
+            if intended is None:
+                break
+            start = self.default_timer()
+            intended_start = run_clock.elapsed(intended)
+            elapsed = run_clock.elapsed(start)
+            if elapsed >= self.run_time:
+                self.batcher.add(
+                    intended_start,
+                    elapsed,
+                    run_clock.start_time + elapsed,
+                    (start - intended) * 1e-9,
+                    transport.MISSED_DISPATCH,
+                    {})
+                continue
+
+            error_str = self.run_transaction(trans)
+
+            finish = self.default_timer()
+            elapsed = run_clock.elapsed(finish)
+            trans.custom_timers['Dispatch_Lag'] = (start - intended) * 1e-9
+            self.batcher.add(
+                intended_start,
+                elapsed,
+                run_clock.start_time + elapsed,
+                (finish - intended) * 1e-9,
+                error_str,
+                trans.custom_timers)
 
 
 
 class ResultsWriter(threading.Thread):
-    def __init__(self, queue, output_dir, console_logging):
+    def __init__(self, queue, output_dir, console_logging, results_format='csv', ts_interval=5, run_clock=None,
+                 stream=None, run_time=None):
         threading.Thread.__init__(self)
         self.queue = queue
         self.console_logging = console_logging
         self.output_dir = output_dir
+        self.results_format = results_format
+        if run_clock is None:
+            run_clock = timing.RunClock()
+        # exact times given by test scripts are made relative to this
+        self.start_time = run_clock.start_time
+        # a distributed.BatchStream the batches also go to, when a
+        # controller runs the test
+        self.stream = stream
+        # the sketches leave out what finished after the end of the run,
+        # like the report does
+        self.run_time = run_time
+        self.sketches = sketch.TimerSketches(ts_interval)
+        # guards the sketches, which can be read while the test runs
+        self.sketches_lock = threading.Lock()
+        self.live_stats = livestats.LiveStats()
         self.trans_count = 0
         self.timer_count = 0
         self.error_count = 0
@@ -460,21 +1037,56 @@ class ResultsWriter(threading.Thread):
             sys.exit(1)
 
     def run(self):
-        with open(os.path.join(self.output_dir, 'results.csv'), 'wb') as filestream:
-            f = csv.writer(filestream)
+        writer = writers.open_writer(self.results_format, self.output_dir)
+        try:
             while True:
-                try:
-                    elapsed, epoch, self.user_group_name, scriptrun_time, error, custom_timers = self.queue.get(False)
-                    self.trans_count += 1
-                    self.timer_count += len(custom_timers)
-                    if error != '':
-                        self.error_count += 1
-                    f.writerow((int(self.trans_count), elapsed, epoch, self.user_group_name, scriptrun_time, error, json.dumps(custom_timers)))
-                    filestream.flush()
-                    if self.console_logging:
-                        print '%i, %.3f, %i, %s, %.3f, %s, %s' % (self.trans_count, elapsed, epoch, self.user_group_name, scriptrun_time, error, repr(custom_timers))
-                except Queue.Empty:
-                    time.sleep(.05)
+                payload = self.queue.get()
+                if payload is None:
+                    # sent by stop(), everything before it has been written
+                    break
+                batch = transport.ResultBatch(payload)
+                writer.write(self.trans_count + 1, batch)
+                with self.sketches_lock:
+                    self.sketches.record_batch(
+                        batch, self.start_time, self.run_time)
+                self.live_stats.record_batch(batch, self.start_time)
+                if self.console_logging:
+                    self.log_batch(batch)
+                if self.stream is not None:
+                    self.stream.append(payload)
+                self.trans_count += len(batch)
+                self.timer_count += len(batch.samples)
+                self.error_count += batch.error_count
+        finally:
+            writer.close()
+            self.sketches.save(self.output_dir)
+            if self.stream is not None:
+                self.stream.finish()
+
+    def sketches_dict(self):
+        """The latency sketches so far, see sketch.TimerSketches.to_dict."""
+        with self.sketches_lock:
+            return self.sketches.to_dict()
+
+    def stop(self):
+        """
+        Write out everything that has been queued so far, then close the
+        results files.
+
+        Only call this once all user groups have finished.
+        """
+        self.queue.put(None)
+        self.join()
+
+    def log_batch(self, batch):
+        rows = zip(
+            batch.records['elapsed'].tolist(),
+            batch.records['epoch'].tolist(),
+            batch.records['trans_time'].tolist(),
+            batch.errors(),
+            batch.custom_timers())
+        for i, (elapsed, epoch, scriptrun_time, error, custom_timers) in enumerate(rows):
+            print '%i, %.3f, %i, %s, %.3f, %s, %s' % (self.trans_count + i + 1, elapsed, epoch, batch.user_group_name, scriptrun_time, error, repr(custom_timers))
 
 
 
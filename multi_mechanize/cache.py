@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""
+a cache of the parsed results and report tables of a results directory
+
+Most of the time it takes to report on CSV results goes into parsing them.
+The parsed columns are kept in ``results_cache.npz`` next to the results,
+and the report tables of every timer in ``results_cache.json``, so
+rendering the report again, with another template or another
+``results_ts_interval``, doesn't parse the results again.
+
+Both are keyed by the size and modification time of the files they were
+made from, the report tables also by the parameters they were computed
+with. Anything that doesn't match is made again.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+import mmbin
+
+# first try to import a fast newer version of simplejson
+try:
+    import simplejson as json
+except ImportError:
+    # fall back to the old, slow library version
+    import json
+
+logger = logging.getLogger('mm_cache')
+
+# changed whenever what is cached changes
+CACHE_VERSION = 3
+
+COLUMNS_FILE = 'results_cache.npz'
+AGGREGATES_FILE = 'results_cache.json'
+
+# sets of report parameters whose tables are kept
+MAX_AGGREGATES = 4
+
+
+def file_stamp(file_names):
+    """[name, size, mtime] of every file in ``file_names`` that exists."""
+    stamp = []
+    for file_name in file_names:
+        if os.path.exists(file_name):
+            stat = os.stat(file_name)
+            stamp.append([os.path.basename(file_name), stat.st_size,
+                          stat.st_mtime])
+    return stamp
+
+
+class ResultsCache(object):
+    """The cache of the results file ``results_file_name``."""
+    def __init__(self, results_file_name):
+        self.results_file_name = results_file_name
+        self.results_dir = os.path.dirname(results_file_name)
+        self.stamp = [CACHE_VERSION] + file_stamp([
+            results_file_name,
+            os.path.join(self.results_dir, 'results_timers.csv')])
+
+    def read_results(self, read_results_file):
+        """
+        Returns the transaction columns, the timer columns and the string
+        table of the results, like ``read_results_file``, which is called
+        when the cache is out of date.
+
+        Binary results are mapped straight from their file, they aren't
+        cached.
+        """
+        if self.results_file_name.endswith(mmbin.RESULTS_FILE):
+            return read_results_file(self.results_file_name)
+        parsed = self.load_columns()
+        if parsed is None:
+            parsed = read_results_file(self.results_file_name)
+            self.save_columns(*parsed)
+        return parsed
+
+    def load_columns(self):
+        file_name = os.path.join(self.results_dir, COLUMNS_FILE)
+        if not os.path.exists(file_name):
+            return None
+        try:
+            cached = np.load(file_name)
+            try:
+                if json.loads(str(cached['stamp'])) != self.stamp:
+                    return None
+                records, samples = {}, {}
+                for name in cached.files:
+                    if name.startswith('records_'):
+                        records[name[len('records_'):]] = cached[name]
+                    elif name.startswith('samples_'):
+                        samples[name[len('samples_'):]] = cached[name]
+                strings = json.loads(str(cached['strings']))
+            finally:
+                cached.close()
+        except (IOError, ValueError, KeyError), e:
+            logger.warning('Ignoring unreadable results cache: %s', e)
+            return None
+        logger.debug('Read the parsed results from %s', file_name)
+        return records, samples, strings
+
+    def save_columns(self, records, samples, strings):
+        arrays = dict(stamp=np.array(json.dumps(self.stamp)),
+                      strings=np.array(json.dumps(strings)))
+        for name, column in records.iteritems():
+            arrays['records_' + name] = column
+        for name, column in samples.iteritems():
+            arrays['samples_' + name] = column
+        self.write(COLUMNS_FILE, lambda f: np.savez(f, **arrays))
+
+    def aggregates(self, params):
+        """
+        Returns the report tables saved for ``params``, or None.
+        """
+        for entry in self.load_aggregates():
+            if entry['params'] == params:
+                return entry['timers']
+        return None
+
+    def save_aggregates(self, params, timers):
+        """
+        Save the report tables of ``timers`` (timer name: JSON-able dict),
+        computed with ``params``, a JSON-able list.
+        """
+        entries = [entry for entry in self.load_aggregates()
+                   if entry['params'] != params]
+        entries.insert(0, dict(params=params, timers=timers))
+        data = dict(stamp=self.stamp, entries=entries[:MAX_AGGREGATES])
+        self.write(AGGREGATES_FILE, lambda f: json.dump(data, f))
+
+    def load_aggregates(self):
+        file_name = os.path.join(self.results_dir, AGGREGATES_FILE)
+        if not os.path.exists(file_name):
+            return []
+        try:
+            with open(file_name, 'rb') as f:
+                data = json.load(f)
+        except (IOError, ValueError), e:
+            logger.warning('Ignoring unreadable results cache: %s', e)
+            return []
+        if data.get('stamp') != self.stamp:
+            return []
+        return data['entries']
+
+    def write(self, name, write):
+        """
+        Write a cache file with ``write(f)``, atomically. A cache that can't
+        be written is only logged.
+        """
+        file_name = os.path.join(self.results_dir, name)
+        temp_name = file_name + '.tmp'
+        try:
+            with open(temp_name, 'wb') as f:
+                write(f)
+            if os.path.exists(file_name):
+                # windows doesn't rename over existing files
+                os.remove(file_name)
+            os.rename(temp_name, file_name)
+        except (IOError, OSError), e:
+            logger.warning('Could not write the results cache: %s', e)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""
+comparing the results of two runs, to catch performance regressions
+
+For every timer of a baseline and a candidate run, the change in its
+average, percentiles, throughput and error rate is reported along with
+whether it is significant:
+
+``avg``
+    Welch's test of the difference of the means
+``pct_<n>``
+    bootstrap of the difference of the percentiles
+``throughput``
+    Mann-Whitney test of the per interval rates
+``error_rate``
+    test of the difference of two proportions
+
+A change is a regression when it goes the wrong way by more than its
+threshold, and is significant.
+"""
+
+import ConfigParser
+import math
+import os
+
+import numpy as np
+from jinja2 import Environment, FileSystemLoader
+
+import results
+import sketch
+import writers
+from transport import NO_ERROR
+
+# percentile metrics compared
+PERCENTILES = results.PERCENTILES + results.HIGH_PERCENTILES
+
+# metrics that get worse as they go up. Throughput gets worse going down.
+LATENCY_METRICS = ['avg'] + [sketch.pct_name(p) for p in PERCENTILES]
+METRICS = LATENCY_METRICS + ['throughput', 'error_rate']
+
+# changes with a p-value below this are significant
+ALPHA = 0.05
+
+# bootstrap resamples of every percentile
+BOOTSTRAP_ROUNDS = 2000
+
+COMPARE_FILE = 'compare.html'
+
+
+class Run(object):
+    """The results of a run, with the config they were made with."""
+    def __init__(self, results_dir):
+        config_path = os.path.join(results_dir, 'config.cfg')
+        if not os.path.exists(config_path):
+            raise IOError('No config.cfg in %s' % results_dir)
+        config = ConfigParser.ConfigParser()
+        config.read(config_path)
+        self.results_dir = results_dir
+        self.run_time = config.getint('global', 'run_time')
+        self.ts_interval = config.getint('global', 'results_ts_interval')
+        try:
+            results_format = config.get('global', 'results_format')
+        except ConfigParser.NoOptionError:
+            results_format = 'csv'
+        self.results = results.Results(
+            os.path.join(results_dir, writers.RESULTS_FILES[results_format]),
+            self.run_time)
+        self.timer_names = set(self.results.uniq_timer_names)
+        self.timer_names.add('Transactions')
+
+    def timer_values(self, timer_name):
+        """The values of a timer, sorted."""
+        return np.sort(self.results.timer_points(timer_name)[:, 1])
+
+    def timer_summary(self, timer_name):
+        points = self.results.timer_points(timer_name)
+        summary = results.timer_table_vals(
+            points.copy(), self.ts_interval)[0]
+        values = np.sort(points[:, 1])
+        high_pcts = np.percentile(values, results.HIGH_PERCENTILES)
+        for p, q in zip(results.HIGH_PERCENTILES, high_pcts):
+            summary[sketch.pct_name(p)] = q
+        failed = self.results.error[
+            self.results.timer_transactions(timer_name)] != NO_ERROR
+        summary['errors'] = int(failed.sum())
+        summary['error_rate'] = failed.mean()
+        summary['throughput'] = len(values) / float(self.run_time)
+        return summary
+
+    def timer_rates(self, timer_name):
+        """The throughput of a timer in every ``ts_interval`` of the run."""
+        times = self.results.timer_points(timer_name)[:, 0]
+        bins = np.arange(0, self.run_time + self.ts_interval, self.ts_interval)
+        return np.histogram(times, bins)[0] / float(self.ts_interval)
+
+
+def normal_p_value(z):
+    """Two sided p-value of a standard normal statistic."""
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def mann_whitney(a, b):
+    """
+    Two sided p-value of the Mann-Whitney U test of the samples ``a`` and
+    ``b``, with the normal approximation and a correction for ties.
+    """
+    n1, n2 = len(a), len(b)
+    if not n1 or not n2:
+        return float('nan')
+    values = np.concatenate((a, b))
+    n = n1 + n2
+    order = np.argsort(values, kind='mergesort')
+    sorted_values = values[order]
+    # tied values share the average of their ranks
+    starts = np.concatenate(
+        ([0], np.flatnonzero(np.diff(sorted_values)) + 1))
+    ties = np.diff(np.concatenate((starts, [n])))
+    avg_ranks = starts + (ties + 1) / 2.0
+    ranks = np.empty(n)
+    ranks[order] = np.repeat(avg_ranks, ties)
+
+    u = ranks[:n1].sum() - n1 * (n1 + 1) / 2.0
+    tie_term = float((ties ** 3 - ties).sum()) / (n * (n - 1))
+    variance = n1 * n2 / 12.0 * ((n + 1) - tie_term)
+    if variance <= 0:
+        return 1.0
+    return normal_p_value((u - n1 * n2 / 2.0) / math.sqrt(variance))
+
+
+def bootstrap_percentiles(sorted_values, p, rounds, rng):
+    """
+    ``rounds`` bootstrap resamples of the ``p`` percentile of a sorted
+    sample.
+
+    The k-th smallest of a resample of n values is the value at
+    floor(n * U), where U is the k-th smallest of n uniform draws, which
+    is Beta(k, n - k + 1) distributed. So the resamples don't need to be
+    drawn and sorted.
+    """
+    n = len(sorted_values)
+    k = max(int(math.ceil(p / 100.0 * n)), 1)
+    u = rng.beta(k, n - k + 1, rounds)
+    indexes = np.minimum((u * n).astype(int), n - 1)
+    return sorted_values[indexes]
+
+
+def bootstrap_p_value(deltas):
+    """Two sided p-value of a bootstrapped difference being 0."""
+    below = (deltas <= 0).mean()
+    above = (deltas >= 0).mean()
+    return min(2 * min(below, above), 1.0)
+
+
+def welch_p_value(a, b):
+    """p-value of the difference of the means, for big samples."""
+    if len(a) < 2 or len(b) < 2:
+        return float('nan')
+    se = math.sqrt(a.var(ddof=1) / len(a) + b.var(ddof=1) / len(b))
+    if not se:
+        return 1.0 if a.mean() == b.mean() else 0.0
+    return normal_p_value((b.mean() - a.mean()) / se)
+
+
+def proportion_p_value(errors1, n1, errors2, n2):
+    """p-value of the difference of two proportions."""
+    if not n1 or not n2:
+        return float('nan')
+    pooled = float(errors1 + errors2) / (n1 + n2)
+    se = math.sqrt(pooled * (1 - pooled) * (1.0 / n1 + 1.0 / n2))
+    if not se:
+        return 1.0
+    return normal_p_value((float(errors2) / n2 - float(errors1) / n1) / se)
+
+
+def compare_timer(baseline, candidate, timer_name, alpha=ALPHA,
+                  rounds=BOOTSTRAP_ROUNDS, rng=None):
+    """
+    Returns a row per metric of a timer that both runs have: metric,
+    baseline, candidate, change, change_pct, p_value and significant.
+    """
+    if rng is None:
+        rng = np.random.RandomState(0)
+    base_summary = baseline.timer_summary(timer_name)
+    cand_summary = candidate.timer_summary(timer_name)
+    base_values = baseline.timer_values(timer_name)
+    cand_values = candidate.timer_values(timer_name)
+
+    p_values = dict(avg=welch_p_value(base_values, cand_values))
+    for p in PERCENTILES:
+        deltas = (bootstrap_percentiles(cand_values, p, rounds, rng) -
+                  bootstrap_percentiles(base_values, p, rounds, rng))
+        p_values[sketch.pct_name(p)] = bootstrap_p_value(deltas)
+    p_values['throughput'] = mann_whitney(
+        baseline.timer_rates(timer_name), candidate.timer_rates(timer_name))
+    p_values['error_rate'] = proportion_p_value(
+        base_summary['errors'], base_summary['count'],
+        cand_summary['errors'], cand_summary['count'])
+
+    rows = []
+    for metric in METRICS:
+        base, cand = float(base_summary[metric]), float(cand_summary[metric])
+        change = cand - base
+        if base:
+            change_pct = 100.0 * change / base
+        else:
+            change_pct = float('nan')
+        rows.append(dict(
+            metric=metric, baseline=base, candidate=cand, change=change,
+            change_pct=change_pct, p_value=p_values[metric],
+            significant=p_values[metric] < alpha))
+    return rows
+
+
+def parse_thresholds(value):
+    """
+    Parses a max_regression option, comma separated metrics with the most
+    they may get worse: in percent for latencies and throughput, in
+    percentage points for the error rate, e.g.
+    "pct_95 10, avg 10, throughput 5, error_rate 1".
+    """
+    thresholds = {}
+    for item in value.split(','):
+        words = item.split()
+        if len(words) != 2 or words[0] not in METRICS:
+            raise ValueError('Bad regression threshold: %s (metrics: %s)'
+                             % (item.strip(), ', '.join(METRICS)))
+        thresholds[words[0]] = float(words[1].rstrip('%'))
+    return thresholds
+
+
+def read_thresholds(config_path):
+    """
+    Returns the regression thresholds and the significance level set in
+    the [global] section of a config file.
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(config_path)
+    thresholds, alpha = {}, ALPHA
+    if config.has_option('global', 'max_regression'):
+        thresholds = parse_thresholds(config.get('global', 'max_regression'))
+    if config.has_option('global', 'regression_alpha'):
+        alpha = config.getfloat('global', 'regression_alpha')
+    return thresholds, alpha
+
+
+def is_regression(row, thresholds):
+    """Whether a row of ``compare_timer`` breaks its threshold."""
+    threshold = thresholds.get(row['metric'])
+    if threshold is None or not row['significant']:
+        return False
+    if row['metric'] == 'throughput':
+        return -row['change_pct'] > threshold
+    if row['metric'] == 'error_rate':
+        return 100.0 * row['change'] > threshold
+    return row['change_pct'] > threshold
+
+
+def compare_runs(baseline, candidate, thresholds, alpha=ALPHA):
+    """
+    Returns a dict of the rows of every timer both runs have, the timers
+    only one of them has, and the regressions as (timer, row) pairs.
+    """
+    comparison = dict(timers={}, regressions=[],
+                      only_baseline=sorted(
+                          baseline.timer_names - candidate.timer_names),
+                      only_candidate=sorted(
+                          candidate.timer_names - baseline.timer_names))
+    for timer_name in sorted(baseline.timer_names & candidate.timer_names):
+        rows = compare_timer(baseline, candidate, timer_name, alpha)
+        for row in rows:
+            row['regression'] = is_regression(row, thresholds)
+            if row['regression']:
+                comparison['regressions'].append((timer_name, row))
+        comparison['timers'][timer_name] = rows
+    return comparison
+
+
+def output_comparison(baseline_dir, candidate_dir, thresholds, alpha=ALPHA,
+                      template_dirs=None):
+    """
+    Compare two results directories, print the regressions and write
+    compare.html into the candidate's. Returns the regressions.
+    """
+    if not template_dirs:
+        template_dirs = 'templates'
+    baseline = Run(baseline_dir)
+    candidate = Run(candidate_dir)
+    comparison = compare_runs(baseline, candidate, thresholds, alpha)
+
+    env = Environment(loader=FileSystemLoader(template_dirs))
+    template = env.get_template('compare_template.html')
+    with open(os.path.join(candidate_dir, COMPARE_FILE), 'w') as f:
+        f.write(template.render(
+            baseline=baseline, candidate=candidate, thresholds=thresholds,
+            alpha=alpha, **comparison))
+
+    for timer_name in sorted(comparison['timers']):
+        print timer_name
+        for row in comparison['timers'][timer_name]:
+            print '  %-12s %12.4f %12.4f %+9.1f%%  p=%.3f%s' % (
+                row['metric'], row['baseline'], row['candidate'],
+                row['change_pct'], row['p_value'],
+                '  REGRESSION' if row['regression'] else '')
+    print ''
+    for timer_name, row in comparison['regressions']:
+        print 'regression: %s %s %+.1f%% (p=%.3f)' % (
+            timer_name, row['metric'], row['change_pct'], row['p_value'])
+    return comparison['regressions']
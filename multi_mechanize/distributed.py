@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""
+running one test on many load nodes
+
+Every node runs multi-mechanize as an RPC server (``--port``), a controller
+(``--controller``) pushes its config to them, has them all start at one
+agreed wall clock time, and pulls their results while the test runs. The
+results come as the same binary batches the agents send their own results
+writer, so the controller writes and reports them like a local run.
+
+Nodes need to have their clocks in sync (NTP), so they agree on the start.
+"""
+
+import logging
+import marshal
+import socket
+import threading
+import time
+import xmlrpclib
+import zlib
+
+logger = logging.getLogger('mm_distributed')
+
+# seconds between telling the nodes to start and the start of the test, so
+# every node gets to set up first
+START_DELAY = 5
+
+# seconds between polls for new results
+POLL_INTERVAL = 0.5
+
+# most result batches sent in one reply
+MAX_BATCHES = 200
+
+
+class BatchStream(object):
+    """
+    The result batches of a run on a node, kept until the controller has
+    fetched them.
+
+    Batches are numbered from 0 in the order they arrived. The controller
+    asks for the batches from a number on, which also tells the node it has
+    everything before it, so those are dropped.
+
+    ``error`` says why the run failed, if it did.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first = 0
+        self.batches = []
+        self.finished = False
+        self.error = None
+
+    def append(self, payload):
+        with self.lock:
+            self.batches.append(payload)
+
+    def finish(self, error=None):
+        """
+        Called once the run's results have all been appended, or with the
+        ``error`` that ended it.
+        """
+        with self.lock:
+            self.finished = True
+            if error is not None and self.error is None:
+                self.error = error
+
+    def fetch(self, offset, max_batches=MAX_BATCHES):
+        """
+        Returns the batches from number ``offset`` on, and whether there
+        will be no more after them.
+        """
+        with self.lock:
+            if offset > self.first:
+                del self.batches[:offset - self.first]
+                self.first = offset
+            batches = self.batches[:max_batches]
+            return batches, self.finished and len(batches) == len(self.batches)
+
+
+def encode_batches(batches):
+    return xmlrpclib.Binary(zlib.compress(marshal.dumps(batches), 1))
+
+
+def decode_batches(data):
+    return marshal.loads(zlib.decompress(data.data))
+
+
+def parse_nodes(value):
+    """Parses a comma separated list of host:port into (host, port) pairs."""
+    nodes = []
+    for node in value.split(','):
+        host, _, port = node.strip().rpartition(':')
+        if not host:
+            raise ValueError('Node without a port: %s' % node)
+        nodes.append((host, int(port)))
+    return nodes
+
+
+def server_proxy(host, port):
+    return xmlrpclib.ServerProxy('http://%s:%i' % (host, port), allow_none=True)
+
+
+class NodeFeed(threading.Thread):
+    """
+    Pulls the result batches of one node into a results queue, until the
+    node's run is over and everything has been fetched.
+    """
+    def __init__(self, host, port, queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = '%s:%i' % (host, port)
+        self.node = server_proxy(host, port)
+        self.queue = queue
+        self.offset = 0
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                reply = self.node.get_batches(self.offset)
+                batches = decode_batches(reply['data'])
+                for payload in batches:
+                    self.queue.put(payload)
+                self.offset += len(batches)
+                if reply.get('error'):
+                    logger.critical('Test failed on node %s: %s',
+                                    self.name, reply['error'])
+                    self.error = reply['error']
+                    break
+                if reply['finished']:
+                    break
+                if len(batches) < MAX_BATCHES:
+                    time.sleep(POLL_INTERVAL)
+        except (socket.error, xmlrpclib.Error), e:
+            logger.critical('Lost node %s: %s', self.name, e)
+            self.error = e
+
+
+def start_nodes(nodes, config, start_delay=START_DELAY):
+    """
+    Push ``config`` to every node, and have them all start their test
+    ``start_delay`` seconds from now. Returns the agreed start time.
+    """
+    proxies = [server_proxy(host, port) for host, port in nodes]
+    for (host, port), proxy in zip(nodes, proxies):
+        if proxy.check_test_running():
+            raise RuntimeError('A test is already running on %s:%i'
+                               % (host, port))
+        proxy.update_config(config)
+    start_time = time.time() + start_delay
+    for (host, port), proxy in zip(nodes, proxies):
+        status = proxy.run_test_at(start_time)
+        logger.info('%s:%i: %s', host, port, status)
+    return start_time
@@ -8,8 +8,12 @@
 
 import sys
 import itertools
+import math
+import multiprocessing
 import os.path
 
+import numpy as np
+
 try:
     import matplotlib
     matplotlib.use('Agg')  # use a non-GUI backend
@@ -17,9 +21,116 @@ try:
 except ImportError:
     print 'ERROR: can not import Matplotlib. install Matplotlib to generate graphs'
 
-
-def resp_graph(lines, points, line_below, boxplots, image_name, timer, output_dir='./'):
+# a graph takes about as long to draw however many samples the run has:
+# lines are thinned out to at most MAX_GRAPH_POINTS points, there are at
+# most MAX_BOXES boxes, and the samples behind them are drawn as a density
+# of BACKDROP_BINS (time, value) cells
+MAX_GRAPH_POINTS = 1000
+MAX_BOXES = 100
+BACKDROP_BINS = (200, 100)
+
+# graphs a rendering process draws before it is replaced by a fresh one,
+# so whatever matplotlib holds on to doesn't pile up
+GRAPHS_PER_PROCESS = 10
+
+
+def render_graphs(tasks, processes=None):
+    """
+    Draw a ``resp_graph(*args, **kwargs)`` for every (args, kwargs) in
+    ``tasks``, in a pool of ``processes`` processes (one per CPU by
+    default), one graph per task.
+    """
+    tasks = list(tasks)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(tasks))
+    if processes <= 1:
+        for task in tasks:
+            _resp_graph_task(task)
+        return
+    pool = multiprocessing.Pool(processes,
+                                maxtasksperchild=GRAPHS_PER_PROCESS)
+    try:
+        # get() with a timeout, so ctrl-c isn't ignored while waiting
+        pool.map_async(_resp_graph_task, tasks, chunksize=1).get(1e9)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def density_backdrop(points, run_time, bins=BACKDROP_BINS):
+    """
+    Counts the [time, value] points in a grid of ``bins`` cells, up to the
+    end of the run and the highest value. Returns (counts, time edges,
+    value edges), or None without points.
+    """
+    points = np.asarray(points, dtype=float)
+    if not len(points):
+        return None
+    end = max(run_time, points[:, 0].max())
+    top = points[:, 1].max() or 1.0
+    return np.histogram2d(points[:, 0], points[:, 1], bins=bins,
+                          range=[[0, end], [0, top]])
+
+
+def decimate(line, max_points=MAX_GRAPH_POINTS):
+    """The x and y sequences of an {x: y} line, with at most max_points."""
+    x_seq = sorted(line.keys())
+    step = max(int(math.ceil(len(x_seq) / float(max_points))), 1)
+    x_seq = x_seq[::step]
+    return x_seq, [line[x] for x in x_seq]
+
+
+def draw_boxes(ax, boxes, width):
+    """
+    Draw box plots from their stats, dicts of pos, q1, med, q3, whislo and
+    whishi, the way ``boxplot`` draws them from raw values.
+    """
+    if not boxes:
+        return
+    pos = np.array([box['pos'] for box in boxes], dtype=float)
+    q1, med, q3, whislo, whishi = [
+        np.array([box[name] for box in boxes], dtype=float)
+        for name in ('q1', 'med', 'q3', 'whislo', 'whishi')]
+    left, right = pos - width / 2.0, pos + width / 2.0
+    ax.vlines(np.concatenate((left, right)), np.concatenate((q1, q1)),
+              np.concatenate((q3, q3)), color='blue', linewidth=0.75)
+    ax.hlines(np.concatenate((q1, q3)), np.concatenate((left, left)),
+              np.concatenate((right, right)), color='blue', linewidth=0.75)
+    ax.hlines(med, left, right, color='red', linewidth=0.75)
+    ax.vlines(np.concatenate((pos, pos)), np.concatenate((whislo, q3)),
+              np.concatenate((q1, whishi)), color='blue', linestyle='--',
+              linewidth=0.5)
+    ax.hlines(np.concatenate((whislo, whishi)),
+              np.concatenate((pos - width / 4.0,) * 2),
+              np.concatenate((pos + width / 4.0,) * 2),
+              color='black', linewidth=0.5)
+
+
+def _resp_graph_task(task):
+    args, kwargs = task
+    resp_graph(*args, **kwargs)
+
+
+def resp_graph(lines, backdrop, line_below, boxes, image_name, timer, output_dir='./'):
+    """
+    ``lines`` are (label, {time: value}) percentile lines, ``backdrop`` a
+    (label, ``density_backdrop``) of all the values, ``line_below`` the
+    (label, {time: value}) throughput and ``boxes`` (box width, box stats
+    for ``draw_boxes``).
+    """
     fig = figure(figsize=(8, 12))  # image dimensions
+    try:
+        _draw_resp_graph(fig, lines, backdrop, line_below, boxes, timer)
+        fig.savefig(os.path.join(output_dir, image_name))
+    finally:
+        close(fig)
+
+
+def _draw_resp_graph(fig, lines, backdrop, line_below, boxes, timer):
     fig.suptitle('Timer: '+timer)
     ax1 = fig.add_subplot(311)
     # we don't share this axis because the boxplot makes a horrible axis
@@ -36,8 +147,7 @@ def resp_graph(lines, points, line_below, boxplots, image_name, timer, output_di
 
     colors=itertools.cycle(['green','orange','purple'])
     for label, line in lines:
-        x_seq = sorted(line.keys())
-        y_seq = [line[x] for x in x_seq]
+        x_seq, y_seq = decimate(line)
         c=colors.next()
         ax.plot(x_seq, y_seq,
                 color=c, linestyle='-', linewidth=2.0, marker='o',
@@ -59,20 +169,21 @@ def resp_graph(lines, points, line_below, boxplots, image_name, timer, output_di
     ax.grid(True, color='#666666')
     #ax.tick_params(labelsize='x-small')
 
-    # Draw the actual timer values behind everything and almost transparent,
-    # just as a backdrop
-    xseq,yseq=zip(*points[1])
-    ax.plot(xseq,yseq, alpha=.2,
-        color='gray', linestyle='-', linewidth=0.0, marker='o',
-        markeredgecolor='gray', markerfacecolor='gray', markersize=2.0,zorder=-1)
+    # Draw the density of the timer values behind everything and almost
+    # transparent, just as a backdrop
+    if backdrop[1] is not None:
+        counts, x_edges, y_edges = backdrop[1]
+        ax.imshow(np.ma.masked_equal(np.log1p(counts.T), 0),
+                  extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]),
+                  origin='lower', aspect='auto', interpolation='nearest',
+                  cmap='Greys', alpha=.4, zorder=-1)
 
-    pos, boxes=zip(*boxplots)
-    ax.boxplot(boxes, positions=pos)
+    box_width, box_stats = boxes
+    draw_boxes(ax, box_stats, box_width)
 
     colors=itertools.cycle(['green','orange','purple'])
     for label, line in lines:
-        x_seq = sorted(line.keys())
-        y_seq = [line[x] for x in x_seq]
+        x_seq, y_seq = decimate(line)
         c=colors.next()
         ax.plot(x_seq, y_seq,
                 color=c, linestyle='-', linewidth=1.0, marker='o',
@@ -90,13 +201,10 @@ def resp_graph(lines, points, line_below, boxplots, image_name, timer, output_di
     #ax.tick_params(labelsize='x-small')
 
     throughput_label, throughputs_dict=line_below
-    x_seq = sorted(throughputs_dict.keys())
-    y_seq = [throughputs_dict[x] for x in x_seq]
+    x_seq, y_seq = decimate(throughputs_dict)
     ax.plot(x_seq, y_seq,
         color='red', linestyle='-', linewidth=0.75, marker='o',
         markeredgecolor='red', markerfacecolor='yellow', markersize=2.0,
              label=throughput_label)
     ax.set_xlim(left=0)
     ax.set_ylim(bottom=0)
-
-    savefig(os.path.join(output_dir, image_name))
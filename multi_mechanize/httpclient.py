@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""
+an HTTP client for test scripts, with persistent connections and timed phases
+
+Opening a new connection for every request makes the load generator spend
+its time on TCP (and TLS) handshakes, and run out of ephemeral ports, long
+before the server is under real load. ``HTTPClient`` keeps connections open
+between requests, and times every phase of a request into the transaction's
+custom timers::
+
+    from multi_mechanize import httpclient
+
+    class Transaction(object):
+        def __init__(self):
+            self.custom_timers = {}
+            self.http = httpclient.HTTPClient()
+
+        def run(self):
+            resp = self.http.get('http://www.example.com/',
+                                 self.custom_timers, 'Example_Homepage')
+            assert resp.status == 200, 'Bad HTTP Response'
+
+Every agent runs its own ``Transaction``, so by default every agent gets
+its own connections. ``HTTPClient(shared=True)`` uses one pool for the whole
+process instead.
+"""
+
+import errno
+import httplib
+import socket
+import threading
+import urlparse
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+from timing import clock_ns
+
+# bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+
+# idle connections kept per host
+MAX_IDLE = 10
+
+# requests that can be sent again when a kept-alive connection turns out
+# to have been closed by the server while it sat in the pool
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+# socket errors of sending on a connection the server has closed
+STALE_SEND_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+
+class TimedConnectionMixin:
+    """Times the DNS lookup, TCP connect and TLS handshake of connect()."""
+    def timed_connect(self):
+        start = clock_ns()
+        addresses = socket.getaddrinfo(
+            self.host, self.port, 0, socket.SOCK_STREAM)
+        resolved = clock_ns()
+        sock = None
+        error = socket.error('getaddrinfo returned no addresses')
+        for family, socktype, proto, canonname, address in addresses:
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.timeout)
+                sock.connect(address)
+                break
+            except socket.error, e:
+                error = e
+                if sock is not None:
+                    sock.close()
+                    sock = None
+        if sock is None:
+            raise error
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connected = clock_ns()
+        self.sock = sock
+        self.phases = [('DNS', resolved - start),
+                       ('Connect', connected - resolved)]
+        return connected
+
+
+class HTTPConnection(TimedConnectionMixin, httplib.HTTPConnection):
+    def connect(self):
+        self.timed_connect()
+
+
+class HTTPSConnection(TimedConnectionMixin, httplib.HTTPSConnection):
+    def connect(self):
+        connected = self.timed_connect()
+        if getattr(self, '_context', None) is not None:
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=self.host)
+        else:
+            self.sock = ssl.wrap_socket(
+                self.sock, self.key_file, self.cert_file)
+        self.phases.append(('TLS', clock_ns() - connected))
+
+
+CONNECTION_CLASSES = {
+    'http': HTTPConnection,
+    'https': HTTPSConnection,
+}
+
+
+class ConnectionPool(object):
+    """
+    Idle connections, per (scheme, host[:port]). Safe to share between
+    threads: a connection is only ever used by whoever took it out.
+    """
+    def __init__(self, max_idle=MAX_IDLE, timeout=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key, new=False):
+        """
+        Returns a connection for ``key``, and whether it was idle. With
+        ``new``, it is always a new one.
+        """
+        if not new:
+            with self.lock:
+                idle = self.idle.get(key)
+                if idle:
+                    return idle.pop(), True
+        scheme, netloc = key
+        connection_class = CONNECTION_CLASSES[scheme]
+        if self.timeout is None:
+            conn = connection_class(netloc)
+        else:
+            conn = connection_class(netloc, timeout=self.timeout)
+        return conn, False
+
+    def put(self, key, conn):
+        """Give back a connection that can take another request."""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.itervalues():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool():
+    """The connection pool shared by every agent in this process."""
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = ConnectionPool()
+        return _shared_pool
+
+
+class Response(object):
+    """
+    A fully read response. ``body`` is None when the client was asked not to
+    keep it, ``size`` is the number of body bytes read either way.
+    """
+    def __init__(self, status, reason, headers, body, size):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.size = size
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+class HTTPClient(object):
+    """
+    Sends requests over persistent connections, and records the time of
+    every request, and of its phases, as custom timers:
+
+    ``<name>``
+        the whole request, connection set up included
+    ``<name>_DNS``, ``<name>_Connect``, ``<name>_TLS``
+        name lookup, TCP connect and TLS handshake, for requests that had
+        to open a new connection
+    ``<name>_TTFB``
+        from sending the request until the response headers arrived
+    ``<name>_Transfer``
+        reading the response body
+
+    Response bodies are read in chunks of ``CHUNK_SIZE``. With
+    ``keep_body=False`` they are dropped as they arrive, so big downloads
+    don't take up memory.
+
+    The shared pool has the default ``max_idle`` and no ``timeout``, they
+    can't be set for a client that uses it.
+    """
+    def __init__(self, shared=False, max_idle=None, timeout=None,
+                 headers=None, keep_body=True):
+        if shared:
+            if max_idle is not None or timeout is not None:
+                raise ValueError(
+                    'max_idle and timeout can not be set with shared=True')
+            self.pool = shared_pool()
+        else:
+            if max_idle is None:
+                max_idle = MAX_IDLE
+            self.pool = ConnectionPool(max_idle, timeout)
+        self.headers = headers or {}
+        self.keep_body = keep_body
+
+    def get(self, url, custom_timers=None, name=None, headers=None):
+        return self.request('GET', url, None, headers, custom_timers, name)
+
+    def post(self, url, body, custom_timers=None, name=None, headers=None):
+        return self.request('POST', url, body, headers, custom_timers, name)
+
+    def request(self, method, url, body=None, headers=None,
+                custom_timers=None, name=None):
+        """
+        Send a request and read the whole response. The times go into
+        ``custom_timers`` under ``name`` (the request's path if not given).
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if scheme not in CONNECTION_CLASSES:
+            raise ValueError('Unsupported URL scheme: %s' % url)
+        key = (scheme, netloc)
+        target = path or '/'
+        if query:
+            target += '?' + query
+        all_headers = dict(self.headers)
+        if headers:
+            all_headers.update(headers)
+
+        start, sent, conn, resp = self._send(
+            key, method, target, body, all_headers)
+        first_byte = clock_ns()
+        phases = conn.phases + [('TTFB', first_byte - sent)]
+
+        chunks = []
+        size = 0
+        try:
+            while True:
+                chunk = resp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if self.keep_body:
+                    chunks.append(chunk)
+        except:
+            conn.close()
+            raise
+        finish = clock_ns()
+        phases.append(('Transfer', finish - first_byte))
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+
+        if custom_timers is not None:
+            if name is None:
+                name = target
+            add_timer(custom_timers, name, (finish - start) * 1e-9)
+            for phase, ns in phases:
+                add_timer(custom_timers, '%s_%s' % (name, phase), ns * 1e-9)
+
+        return Response(
+            resp.status, resp.reason,
+            dict((k.lower(), v) for k, v in resp.getheaders()),
+            ''.join(chunks) if self.keep_body else None, size)
+
+    def _send(self, key, method, target, body, headers):
+        """
+        Send the request and read the response headers. Returns when it
+        started, when the request was sent (after connecting), the
+        connection and the response.
+
+        If an idle connection turns out to have been closed by the server
+        before it sent any of the response, an idempotent request is sent
+        again on a new connection. Anything else, timeouts included, is
+        raised: the server may have acted on the request.
+        """
+        conn, reused = self.pool.get(key)
+        while True:
+            start = clock_ns()
+            conn.phases = []
+            sending = True
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                sent = clock_ns()
+                conn.request(method, target, body, headers)
+                sending = False
+                return start, sent, conn, conn.getresponse()
+            except Exception, e:
+                conn.close()
+                if not (reused and method in IDEMPOTENT_METHODS and
+                        is_stale(e, sending)):
+                    raise
+                conn, reused = self.pool.get(key, new=True)
+
+    def close(self):
+        self.pool.close()
+
+
+def is_stale(error, sending):
+    """
+    Whether ``error``, raised while ``sending`` the request or else while
+    waiting for the response, means the connection had been closed by the
+    server before the request: a reset or broken pipe while sending, or no
+    status line at all.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if sending:
+        return (isinstance(error, socket.error) and
+                error.errno in STALE_SEND_ERRNOS)
+    if isinstance(error, httplib.BadStatusLine):
+        # the message of an empty status line differs between versions
+        return (error.line in ('', "''") or
+                error.line.startswith('No status line received'))
+    return False
+
+
+def add_timer(custom_timers, name, value):
+    """Add a value to a custom timer, keeping earlier values of it."""
+    if name not in custom_timers:
+        custom_timers[name] = value
+    elif isinstance(custom_timers[name], list):
+        custom_timers[name].append(value)
+    else:
+        custom_timers[name] = [custom_timers[name], value]
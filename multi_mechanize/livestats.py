@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""rolling-window statistics of a test while it runs"""
+
+import threading
+
+import numpy as np
+
+from sketch import LatencyHistogram
+from transport import NO_ERROR
+
+# default length of the rolling window, in seconds
+WINDOW = 10
+
+LIVE_PERCENTILES = [50, 95, 99]
+
+ROW_FORMAT = '  %-24s %9.1f %6.1f%% %8.3f %8.3f %8.3f'
+
+
+class RollingStats(object):
+    """
+    Count, error count and latencies of the last ``window`` seconds, kept in
+    a ring of one-second slots.
+
+    Recording a value is a constant amount of work, the window is only
+    merged when it is read.
+    """
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.slots = [None] * window
+
+    def record(self, second, values, errors=0):
+        index = second % self.window
+        slot = self.slots[index]
+        if slot is None or slot[0] < second:
+            slot = self.slots[index] = [second, 0, 0, LatencyHistogram()]
+        elif slot[0] > second:
+            # already fell out of the window
+            return
+        slot[1] += len(values)
+        slot[2] += errors
+        slot[3].record(values)
+
+    def snapshot(self, now):
+        """
+        Returns the rate (per second), error rate and percentiles of the
+        window ending at ``now`` seconds into the run.
+        """
+        first = int(now) - self.window
+        slots = [slot for slot in self.slots
+                 if slot is not None and first < slot[0] <= now]
+        count = sum(slot[1] for slot in slots)
+        errors = sum(slot[2] for slot in slots)
+        histogram = LatencyHistogram()
+        for slot in slots:
+            histogram += slot[3]
+        seconds = min(float(self.window), max(now, 1.0))
+        return dict(
+            rate=count / seconds,
+            error_rate=errors / float(count) if count else 0.0,
+            pcts=histogram.percentiles(LIVE_PERCENTILES).tolist())
+
+
+class LiveStats(object):
+    """
+    Rolling statistics for every user group and every timer, fed with
+    ``transport.ResultBatch`` objects by the results writer.
+    """
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.user_groups = {}
+        self.timers = {}
+
+    def _stats(self, stats, name):
+        try:
+            return stats[name]
+        except KeyError:
+            stats[name] = RollingStats(self.window)
+            return stats[name]
+
+    def record_batch(self, batch, start_time):
+        records = batch.records
+        seconds = records['elapsed'].astype(int)
+        failed = records['error'] != NO_ERROR
+        timer_ids, times, values = batch.timer_samples(start_time)
+        with self.lock:
+            for stats in (self._stats(self.user_groups, batch.user_group_name),
+                          self._stats(self.timers, 'Transactions')):
+                record_by_second(
+                    stats, seconds, records['trans_time'], failed)
+            for timer_id in np.unique(timer_ids).tolist():
+                mask = timer_ids == timer_id
+                record_by_second(
+                    self._stats(self.timers, batch.strings[timer_id]),
+                    times[mask].astype(int), values[mask])
+
+    def lines(self, now):
+        """Returns the console lines showing the window ending at ``now``."""
+        header = '  %-24s %9s %7s %8s %8s %8s' % (
+            'last %is' % self.window, 'per sec', 'errors', '50%', '95%', '99%')
+        lines = [header]
+        with self.lock:
+            for title, stats in (('user group', self.user_groups),
+                                 ('timer', self.timers)):
+                for name in sorted(stats):
+                    s = stats[name].snapshot(now)
+                    lines.append(ROW_FORMAT % tuple(
+                        [('%s: %s' % (title, name))[:24], s['rate'],
+                         s['error_rate'] * 100] + s['pcts']))
+        return lines
+
+
+def record_by_second(stats, seconds, values, failed=None):
+    """Record ``values`` into ``stats``, split up by the second they fell in."""
+    for second in np.unique(seconds).tolist():
+        mask = seconds == second
+        errors = int(failed[mask].sum()) if failed is not None else 0
+        stats.record(second, values[mask], errors)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""
+the compact binary results format
+
+A binary results set is three files in the results directory:
+
+``results.mmbin``
+    one fixed-width record per transaction
+``results.mmtimers``
+    one fixed-width record per custom timer value
+``results.mmstr``
+    the string table: user group names, error strings and timer names,
+    one JSON encoded string per line. A string's id is its line number.
+
+Both record files start with an 8 byte magic string and can be mapped
+straight into NumPy record arrays.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+# first try to import a fast newer version of simplejson
+try:
+    import simplejson as json
+except ImportError:
+    # fall back to the old, slow library version
+    import json
+
+logger = logging.getLogger('mm_results')
+
+RESULTS_FILE = 'results.mmbin'
+TIMERS_FILE = 'results.mmtimers'
+STRINGS_FILE = 'results.mmstr'
+
+RESULTS_MAGIC = 'MMBIN\x00\x00\x02'
+TIMERS_MAGIC = 'MMTMR\x00\x00\x01'
+
+# error is -1 for transactions without an error. start and elapsed (the
+# finish) are seconds since the start of the run.
+RECORD_DTYPE = np.dtype([
+    ('elapsed', '<f8'),
+    ('epoch', '<f8'),
+    ('user_group', '<i4'),
+    ('trans_time', '<f8'),
+    ('error', '<i4'),
+    ('start', '<f8'),
+])
+
+# results files written before the start of transactions was recorded
+RESULTS_MAGIC_V1 = 'MMBIN\x00\x00\x01'
+RECORD_DTYPE_V1 = np.dtype(RECORD_DTYPE.descr[:-1])
+
+# trans is the 0-based index of the transaction in results.mmbin. time is
+# NaN when the value belongs to the transaction itself.
+SAMPLE_DTYPE = np.dtype([
+    ('trans', '<i8'),
+    ('timer', '<i4'),
+    ('time', '<f8'),
+    ('value', '<f8'),
+])
+
+
+def paths(results_dir):
+    return (os.path.join(results_dir, RESULTS_FILE),
+            os.path.join(results_dir, TIMERS_FILE),
+            os.path.join(results_dir, STRINGS_FILE))
+
+
+def map_records(file_name, magic, dtype):
+    """Memory-map a record file without reading it."""
+    with open(file_name, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError('%s is not a multi-mechanize binary results '
+                             'file' % file_name)
+    if os.path.getsize(file_name) == len(magic):
+        # mmap refuses empty mappings
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_name, dtype=dtype, mode='r', offset=len(magic))
+
+
+def map_results(file_name):
+    """
+    Memory-map a results file. Files from before the start column are read
+    into memory, with the start taken as the finish less the transaction
+    time.
+    """
+    with open(file_name, 'rb') as f:
+        magic = f.read(len(RESULTS_MAGIC))
+    if magic != RESULTS_MAGIC_V1:
+        return map_records(file_name, RESULTS_MAGIC, RECORD_DTYPE)
+    old = map_records(file_name, RESULTS_MAGIC_V1, RECORD_DTYPE_V1)
+    records = np.empty(len(old), dtype=RECORD_DTYPE)
+    for name in RECORD_DTYPE_V1.names:
+        records[name] = old[name]
+    records['start'] = old['elapsed'] - old['trans_time']
+    return records
+
+
+def read_strings(file_name):
+    with open(file_name, 'rb') as f:
+        return [json.loads(line) for line in f]
+
+
+class MMBinFile(object):
+    """
+    A binary results set, opened for reading.
+
+    ``records`` and ``samples`` are read-only memory-mapped record arrays,
+    so only the pages that are actually used are ever read from disk.
+    """
+    def __init__(self, results_file_name):
+        results_dir = os.path.dirname(results_file_name)
+        _, timers_file_name, strings_file_name = paths(results_dir)
+        logger.debug("Mapping binary results file: %s", results_file_name)
+        self.records = map_results(results_file_name)
+        self.samples = map_records(
+            timers_file_name, TIMERS_MAGIC, SAMPLE_DTYPE)
+        self.strings = read_strings(strings_file_name)
+
+
+class MMBinWriter(object):
+    """Appends result batches to a binary results set."""
+    def __init__(self, results_dir, buffer_size):
+        results_file_name, timers_file_name, strings_file_name = paths(
+            results_dir)
+        self.results_stream = open(results_file_name, 'wb', buffer_size)
+        self.timers_stream = open(timers_file_name, 'wb', buffer_size)
+        self.strings_stream = open(strings_file_name, 'wb')
+        self.results_stream.write(RESULTS_MAGIC)
+        self.timers_stream.write(TIMERS_MAGIC)
+        self.string_ids = {}
+
+    def string_id(self, s):
+        try:
+            return self.string_ids[s]
+        except KeyError:
+            string_id = self.string_ids[s] = len(self.string_ids)
+            if isinstance(s, str):
+                s = s.decode('utf-8', 'replace')
+            self.strings_stream.write(json.dumps(s) + '\n')
+            return string_id
+
+    def write(self, trans_count, batch):
+        """Write ``batch``, whose first transaction is number ``trans_count``."""
+        # batch strings ids -> string ids of this file. The extra entry at
+        # the end maps the -1 of "no error" to itself.
+        ids = np.array(
+            [self.string_id(s) for s in batch.strings] + [-1], dtype='<i4')
+
+        records = np.empty(len(batch), dtype=RECORD_DTYPE)
+        records['elapsed'] = batch.records['elapsed']
+        records['epoch'] = batch.records['epoch']
+        records['user_group'] = self.string_id(batch.user_group_name)
+        records['trans_time'] = batch.records['trans_time']
+        records['error'] = ids[batch.records['error']]
+        records['start'] = batch.records['start']
+        self.results_stream.write(records.tostring())
+
+        samples = np.empty(len(batch.samples), dtype=SAMPLE_DTYPE)
+        samples['trans'] = batch.samples['trans'] + (trans_count - 1)
+        samples['timer'] = ids[batch.samples['timer']]
+        samples['time'] = batch.samples['time']
+        samples['value'] = batch.samples['value']
+        self.timers_stream.write(samples.tostring())
+
+    def close(self):
+        self.results_stream.close()
+        self.timers_stream.close()
+        self.strings_stream.close()
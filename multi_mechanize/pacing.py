@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""think time and pacing between the iterations of a virtual user"""
+
+
+class ThinkTime(object):
+    """
+    A wait after every iteration, drawn from a distribution:
+
+    ``N``
+        always N seconds
+    ``uniform A B``
+        anywhere between A and B seconds
+    ``exponential MEAN``
+        exponentially distributed, like the gaps between independent
+        arrivals
+    ``gaussian MEAN STDEV``
+        normally distributed, never below 0
+    """
+    DISTRIBUTIONS = {'fixed': 1, 'uniform': 2, 'exponential': 1, 'gaussian': 2}
+
+    def __init__(self, distribution, args):
+        self.distribution = distribution
+        self.args = args
+
+    def wait(self, rng, start, finish):
+        """
+        Returns how long to wait after an iteration that ran from ``start``
+        to ``finish``, using the random number generator ``rng``.
+        """
+        if self.distribution == 'fixed':
+            return self.args[0]
+        elif self.distribution == 'uniform':
+            return rng.uniform(*self.args)
+        elif self.distribution == 'exponential':
+            return rng.expovariate(1.0 / self.args[0])
+        else:
+            return max(rng.gauss(*self.args), 0.0)
+
+
+class Pacing(object):
+    """
+    Start an iteration every ``interval`` seconds. An iteration that takes
+    longer than that is followed by the next one right away.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+
+    def wait(self, rng, start, finish):
+        return max(start + self.interval - finish, 0.0)
+
+
+def parse_think_time(value):
+    """
+    Parses a think_time option, see ``ThinkTime``. Raises ValueError for
+    anything else.
+    """
+    words = value.split()
+    if len(words) == 1:
+        words.insert(0, 'fixed')
+    distribution, args = words[0], [float(arg) for arg in words[1:]]
+    if ThinkTime.DISTRIBUTIONS.get(distribution) != len(args):
+        raise ValueError('Bad think time: %s' % value)
+    if [arg for arg in args if arg < 0]:
+        raise ValueError('Negative think time: %s' % value)
+    if distribution == 'exponential' and not args[0]:
+        raise ValueError('Exponential think time needs a mean above 0')
+    return ThinkTime(distribution, args)
+
+
+def parse_pacing(value):
+    """Parses a pacing option, the seconds between iteration starts."""
+    interval = float(value)
+    if interval <= 0:
+        raise ValueError('Pacing has to be above 0: %s' % value)
+    return Pacing(interval)
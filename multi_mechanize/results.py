@@ -6,15 +6,19 @@
 #  This file is part of Multi-Mechanize
 
 
+import itertools
 import logging
+import multiprocessing
 import os
 import time
-from collections import defaultdict
-import graph
+import cache
+import mmbin
+import scheduler
+import sketch
+import transport
+from transport import NAN, NO_ERROR
 import numpy as np
-from itertools import groupby
 import csv
-from operator import itemgetter
 from jinja2 import Template
 from jinja2 import Environment, FileSystemLoader
 
@@ -27,58 +31,207 @@ except ImportError:
 
 logger = logging.getLogger('mm_results')
 
+PERCENTILES = [25, 50, 80, 90, 95]
+# only reported from the latency sketches, too few raw samples fall above them
+HIGH_PERCENTILES = [99, 99.9]
+
+# the static report has matplotlib graphs, the interactive one charts the
+# series it loads from REPORT_DIR in the browser
+REPORTS = {
+    'static': 'results_template.html',
+    'interactive': 'results_interactive_template.html',
+}
+REPORT_DIR = 'report'
+# CSV results files from this size up are parsed by several processes, in
+# chunks of lines of about PARSE_CHUNK_BYTES (at most one per process and
+# PARSE_CHUNKS_PER_PROCESS)
+PARALLEL_PARSE_BYTES = 16 * 1024 * 1024
+PARSE_CHUNK_BYTES = 4 * 1024 * 1024
+PARSE_CHUNKS_PER_PROCESS = 4
+
+# bars of the distribution chart of the interactive report, up to the 99th
+# percentile
+HISTOGRAM_BINS = 50
+# slowest intervals of every timer broken down by user group and error
+SPIKE_INTERVALS = 5
+# errors counted on their own, the rarer ones are counted as OTHER_ERRORS
+MAX_ERROR_TYPES = 20
+OTHER_ERRORS = '(other errors)'
+
 def timer_table_vals(timer, interval_secs):
-    timer_vals=timer[:,1].copy() # must make a copy so we don't sort timer
-    timer_vals.sort()
+    timer_vals=np.sort(timer[:,1])
     n=len(timer_vals)
     graphs={}
-    graphs['pct_50_resptime'] = {}
-    graphs['pct_80_resptime'] = {}
-    graphs['pct_95_resptime'] = {}
 
     summary=dict(count=n,
                  min=timer_vals[0],
                  avg=np.average(timer_vals),
                  max=timer_vals[-1],
                  stdev=timer_vals.std(ddof=1)) #sample standard deviation
-    pct=[25,50,80,90,95]
-    for p,q in zip(pct,np.percentile(timer_vals, pct)):
+    for p,q in zip(PERCENTILES,np.percentile(timer_vals, PERCENTILES)):
         summary['pct_%s'%p]=q
 
-    splat_series = group_series(timer, interval_secs)
-    timer_table=[]
-    for i, bucket in splat_series:
-        cnt = len(bucket)
-        if cnt == 0:
-            row=dict(interval=i, count=0, rate=0, min='N/A', avg='N/A',pct_80='N/A',pct_90='N/A',pct_95='N/A',max='N/A',stdev='N/A')
-        else:
-            bucket.sort()
-            row=dict()
-            row['interval'] = i
-            row['count'] = cnt
-            row['rate'] = cnt / float(interval_secs)
-            row['min'] = bucket[0]
-            row['avg'] = np.average(bucket)
-            row['max'] = bucket[-1]
-            row['stdev'] = np.std(bucket, ddof=1) # sample stdev
-            # not exactly percentiles, since I'm not averaging values if
-            # the percentile doesn't fall exactly on a slot.
-            pct=[25,50,80,90,95]
-            for p,q in zip(pct,np.percentile(bucket, pct)):
+    keys, starts, counts, values = bucket_series(timer, interval_secs)
+    stats = bucket_stats(starts, counts, values)
+    stats['interval'] = keys
+    stats['count'] = counts
+    stats['rate'] = counts / float(interval_secs)
+    names = sorted(stats)
+    timer_table = [dict(zip(names, row))
+                   for row in zip(*[stats[name].tolist() for name in names])]
+
+    # graph data
+    graphs['pct_50_resptime'] = dict(zip(keys.tolist(), stats['pct_50'].tolist()))
+    graphs['pct_80_resptime'] = dict(zip(keys.tolist(), stats['pct_80'].tolist()))
+    graphs['pct_95_resptime'] = dict(zip(keys.tolist(), stats['pct_95'].tolist()))
+
+    boxes = box_stats(keys, starts, counts, values)
+    return summary, timer_table, graphs, boxes
+
+def phase_table_vals(timer, groups, group_ids, phases, run_time):
+    """
+    Stats of a timer's [time, value] points during every load profile phase
+    of every user group. ``groups`` holds the user group id of each point.
+    """
+    rows=[]
+    for user_group_name in sorted(phases):
+        in_group=groups == group_ids.get(user_group_name, -1)
+        for name, start, end in phases[user_group_name]:
+            if end is None:
+                end=run_time
+            vals=timer[in_group & (timer[:,0] >= start) & (timer[:,0] < end), 1]
+            if not len(vals):
+                continue
+            row=dict(user_group=user_group_name, phase=name, start=start,
+                     end=end, count=len(vals), avg=np.average(vals),
+                     min=vals.min(), max=vals.max())
+            if end > start:
+                row['rate']=len(vals) / float(end - start)
+            else:
+                row['rate']=float('nan')
+            for p,q in zip(PERCENTILES,np.percentile(vals, PERCENTILES)):
                 row['pct_%s'%p]=q
+            rows.append(row)
+    return rows
 
-        timer_table.append(row)
+def breakdown_vals(timer, groups, errors, strings, interval_secs, timer_table):
+    """
+    Breaks a timer's [time, value] points down by user group and by error,
+    into the intervals of ``timer_table_vals``. ``groups`` and ``errors``
+    hold the user group id and the error id (NO_ERROR if it passed) of the
+    transaction of every point, both ids into ``strings``.
+
+    Every (user group, interval) cell is computed from a single sort of
+    the points, and the errors are counted per cell with ``cell_counts``,
+    so there is no pass over the points per group or error.
+
+    Returns a dict of the summary of every user group (``groups``), the
+    interval series of every user group (``group_series``), the counts of
+    every error (``errors``) and the slowest intervals of
+    ``timer_table``, with the groups and errors in them (``spikes``).
+    """
+    times=timer[:,0]
+    values=timer[:,1]
+    # intervals are counted from the start of the run, like bucket_series
+    # does, and numbered from the earliest
+    slots=(times // interval_secs).astype(int)
+    first_slot=int(slots.min())
+    slots-=first_slot
+    num_slots=int(slots.max()) + 1
+    failed=errors != NO_ERROR
+    group_ids, group_index=np.unique(groups, return_inverse=True)
+    num_groups=len(group_ids)
 
-        # graph data
-        graphs['pct_50_resptime'][i] = row['pct_50']
-        graphs['pct_80_resptime'][i] = row['pct_80']
-        graphs['pct_95_resptime'][i] = row['pct_95']
+    # summary of every user group
+    order=np.lexsort((values, group_index))
+    starts=np.searchsorted(group_index[order], np.arange(num_groups))
+    counts=np.diff(np.concatenate((starts, [len(order)])))
+    stats=bucket_stats(starts, counts, values[order])
+    stats['count']=counts
+    stats['errors']=cell_counts(group_index[failed], num_groups)
+    group_rows=[]
+    for i, group_id in enumerate(group_ids.tolist()):
+        row=dict((name, column[i].item()) for name, column in stats.iteritems())
+        row['user_group']=strings[group_id]
+        row['error_rate']=row['errors'] / float(row['count'])
+        group_rows.append(row)
 
-    return summary, timer_table, graphs, splat_series
+    # stats of every (user group, interval) cell
+    cells=group_index * num_slots + slots
+    order=np.lexsort((values, cells))
+    cells=cells[order]
+    starts=np.concatenate(([0], np.flatnonzero(np.diff(cells)) + 1))
+    counts=np.diff(np.concatenate((starts, [len(cells)])))
+    cell_stats=bucket_stats(starts, counts, values[order], pct=[50, 95])
+    cell_stats['count']=counts
+    cell_stats['errors']=np.add.reduceat(failed[order].astype(int), starts)
+    cell_group=cells[starts] // num_slots
+    cell_slot=cells[starts] % num_slots
+    cell_stats['interval']=(cell_slot + first_slot) * interval_secs
+    names=('interval', 'count', 'errors', 'pct_50', 'pct_95')
+    group_series={}
+    for i, group_id in enumerate(group_ids.tolist()):
+        in_group=cell_group == i
+        group_series[strings[group_id]]=dict(
+            (name, cell_stats[name][in_group].tolist()) for name in names)
+
+    # counts of every error, over time and by user group. Past
+    # MAX_ERROR_TYPES the rarest errors are counted together.
+    error_ids, error_index=np.unique(errors[failed], return_inverse=True)
+    num_errors=len(error_ids)
+    error_slots=cell_counts(error_index * num_slots + slots[failed],
+                            num_errors * num_slots).reshape(num_errors, num_slots)
+    error_groups=cell_counts(error_index * num_groups + group_index[failed],
+                             num_errors * num_groups).reshape(num_errors, num_groups)
+    ranked=np.argsort(-error_slots.sum(axis=1), kind='mergesort')
+    error_names=[strings[error_id] for error_id in error_ids[ranked].tolist()]
+    error_slots=error_slots[ranked]
+    error_groups=error_groups[ranked]
+    if num_errors > MAX_ERROR_TYPES:
+        error_names=error_names[:MAX_ERROR_TYPES - 1] + [OTHER_ERRORS]
+        error_slots=np.vstack((error_slots[:MAX_ERROR_TYPES - 1],
+                               error_slots[MAX_ERROR_TYPES - 1:].sum(axis=0)))
+        error_groups=np.vstack((error_groups[:MAX_ERROR_TYPES - 1],
+                                error_groups[MAX_ERROR_TYPES - 1:].sum(axis=0)))
+    error_rows=[]
+    for name, slot_counts, group_counts in zip(
+            error_names, error_slots, error_groups):
+        with_errors=np.flatnonzero(slot_counts)
+        error_rows.append(dict(
+            error=name, count=int(slot_counts.sum()),
+            groups=dict((strings[group_id], n) for group_id, n in zip(
+                group_ids.tolist(), group_counts.tolist()) if n),
+            series=dict(interval=((with_errors + first_slot)
+                                  * interval_secs).tolist(),
+                        count=slot_counts[with_errors].tolist())))
+
+    # the slowest intervals, with what was in them
+    spikes=[]
+    slowest=sorted(timer_table, key=lambda row: -row['pct_95'])
+    for row in slowest[:SPIKE_INTERVALS]:
+        slot=int(round(row['interval'] / interval_secs)) - first_slot
+        in_slot=np.flatnonzero(cell_slot == slot)
+        spike_groups=[dict(user_group=strings[group_ids[cell_group[i]]],
+                           count=int(cell_stats['count'][i]),
+                           errors=int(cell_stats['errors'][i]),
+                           pct_95=float(cell_stats['pct_95'][i]))
+                      for i in in_slot.tolist()]
+        spike_groups.sort(key=lambda group: -group['pct_95'])
+        spike_errors=[dict(error=name, count=int(slot_counts[slot]))
+                      for name, slot_counts in zip(error_names, error_slots)
+                      if slot_counts[slot]]
+        spike_errors.sort(key=lambda error: -error['count'])
+        spikes.append(dict(interval=row['interval'], count=row['count'],
+                           pct_95=row['pct_95'], groups=spike_groups,
+                           errors=spike_errors))
+
+    return dict(groups=group_rows, group_series=group_series,
+                errors=error_rows, spikes=spikes)
 
 def output_results(
     results_dir, results_file, run_time, rampup, ts_interval,
-    user_group_configs=None, template_dirs=None):
+    user_group_configs=None, template_dirs=None, graph_processes=None,
+    report='static'):
 
     if not user_group_configs:
         user_group_configs = []
@@ -86,13 +239,35 @@ def output_results(
     if not template_dirs:
         template_dirs = 'templates'
     env = Environment(loader=FileSystemLoader(template_dirs))
-    template = env.get_template('results_template.html')
+    template = env.get_template(REPORTS[report])
     template_vars=dict()
+    if report == 'interactive':
+        report_dir = os.path.join(results_dir, REPORT_DIR)
+        if not os.path.isdir(report_dir):
+            os.makedirs(report_dir)
+        with open(os.path.join(report_dir, 'mmcharts.js'), 'w') as f:
+            f.write(env.loader.get_source(env, 'mmcharts.js')[0].encode('utf-8'))
+        template_vars['report_dir']=REPORT_DIR
+    else:
+        # only the static report needs matplotlib
+        import graph
 
-    results = Results(results_file, run_time)
+    results_cache = cache.ResultsCache(results_file)
+    results = Results(results_file, run_time,
+                      results_cache.read_results(read_results_file))
+    sketches = sketch.load_sketches(os.path.dirname(results_file))
+    phases = scheduler.load_phases(os.path.dirname(results_file))
+    # the timer tables only need computing again when these change
+    cache_params = [run_time, ts_interval] + cache.file_stamp([
+        os.path.join(os.path.dirname(results_file), name)
+        for name in (sketch.SKETCHES_FILE, scheduler.PHASES_FILE)])
+    cached_timers = results_cache.aggregates(cache_params)
+    group_ids = dict((results.strings[i], i) for i in np.unique(results.user_group))
 
     print 'transactions: %i' % results.total_transactions
     print 'errors: %i' % results.total_errors
+    if results.missed_dispatches:
+        print 'missed dispatches: %i' % results.missed_dispatches
     print ''
     print 'test start: %s' % results.start_datetime
     print 'test finish: %s' % results.finish_datetime
@@ -100,161 +275,778 @@ def output_results(
 
     template_vars['total_transactions']=results.total_transactions
     template_vars['total_errors']=results.total_errors
+    template_vars['missed_dispatches']=results.missed_dispatches
     template_vars['run_time']=run_time
     template_vars['rampup']=rampup
     template_vars['test_start']=results.start_datetime
     template_vars['test_finish']=results.finish_datetime
     template_vars['timeseries_interval']=ts_interval
     template_vars['user_group_configs']=user_group_configs
+    template_vars['phases']=phases
 
     # Make the "Transactions" timer just another custom timer
     template_vars['timers']={}
     template_vars['graph_filenames']={}
     results.uniq_timer_names.add('Transactions')
-    for resp_stats in results.resp_stats_list:
-        resp_stats.custom_timers['Transactions']=resp_stats.trans_time
 
-    start_time=results.epoch_start
-    for timer_string in sorted(results.uniq_timer_names):
-        timer_points = []  # [elapsed, timervalue]
-        for resp_stats in results.resp_stats_list:
-            try:
-                val = resp_stats.custom_timers[timer_string]
-                # the values in a custom timer can either be:
-                # (1) a single time delta (assumed to occur at the start of the transaction)
-                # (2) a list of time deltas (all assumed to occur at the start of the transaction)
-                # (3) (exact time, time delta) tuples
-                if not isinstance(val, (list, tuple)):
-                    # case (1)
-                    val=[(resp_stats.elapsed_time, val)]
-                elif not isinstance(val[0], (list, tuple)):
-                    # case (2)
-                    val=[(resp_stats.elapsed_time, v) for v in val]
-                else:
-                    # case (3) -- need to change the exact time to a relative time
-                    val=[(t-start_time, v) for t,v in val]
-                # now val is a list of (time since start of run, time delta)
-                timer_points.extend(val)
-            except (KeyError,IndexError):
-                pass
-        timer_points=np.asarray(timer_points,dtype=float)
-
-        template_vars['timers'][timer_string]={}
-        template_vars['timers'][timer_string]['s'],template_vars['timers'][timer_string]['table'],graph_data, splat_series=timer_table_vals(timer_points.copy(), ts_interval)
+    graph_tasks = []
+    timer_vals = {}
+    for index, timer_string in enumerate(sorted(results.uniq_timer_names)):
+        timer_points = results.timer_points(timer_string)  # [elapsed, timervalue]
+
+        if cached_timers and timer_string in cached_timers:
+            vals = cached_timers[timer_string]
+        else:
+            vals = timer_report_vals(results, timer_string, timer_points,
+                                     ts_interval, run_time, sketches,
+                                     phases, group_ids)
+        timer_vals[timer_string] = vals
+        template_vars['timers'][timer_string]=dict(
+            s=vals['s'], table=vals['table'], phases=vals['phases'],
+            groups=vals['groups'], errors=vals['errors'],
+            spikes=vals['spikes'])
+        graph_data = dict((name, dict(map(tuple, line)))
+                          for name, line in vals['graph_data'].iteritems())
+        boxes = vals['boxes']
+
+        if report == 'interactive':
+            template_vars['timers'][timer_string]['index']=index
+            write_timer_series(report_dir, index, vals, timer_points)
+            continue
 
         template_vars['graph_filenames'][timer_string]={}
         template_vars['graph_filenames'][timer_string]['resptime']=timer_string+'_response_times_intervals.png'
         template_vars['graph_filenames'][timer_string]['resptime_all']=timer_string+'_response_times.png'
         template_vars['graph_filenames'][timer_string]['throughput']=timer_string+'_throughput.png'
 
-        interval_secs=5.0
+        # the graph only gets aggregates, of a size that doesn't grow with
+        # the number of samples
+        interval_secs=max(5.0, run_time / float(graph.MAX_GRAPH_POINTS))
         bins=np.arange(0,run_time+interval_secs, interval_secs)
         hist,bins=np.histogram(timer_points[:,0],bins)
         throughput_points=dict(zip(bins,hist/interval_secs))
 
-        graph.resp_graph((('95%', graph_data['pct_95_resptime'],),
-                          ('80%', graph_data['pct_80_resptime']),
-                          ('Median',graph_data['pct_50_resptime'])),
-                         ('All timers', timer_points),
-                         ('Throughput', throughput_points),
-                         splat_series,
-                         template_vars['graph_filenames'][timer_string]['resptime'],
-                         timer=timer_string,
-                         output_dir=results_dir)
+        box_interval = ts_interval
+        if len(boxes) > graph.MAX_BOXES:
+            box_interval = ts_interval * int(np.ceil(
+                len(boxes) / float(graph.MAX_BOXES)))
+        timer_intervals = sketches and sketches.intervals.get(timer_string)
+        if timer_intervals and box_interval % sketches.interval == 0:
+            boxes = sketch_box_stats(timer_intervals, box_interval)
+        elif box_interval != ts_interval:
+            boxes = box_stats(*bucket_series(timer_points, box_interval))
+
+        graph_tasks.append((
+            ((('95%', graph_data['pct_95_resptime'],),
+              ('80%', graph_data['pct_80_resptime']),
+              ('Median',graph_data['pct_50_resptime'])),
+             ('All timers', graph.density_backdrop(timer_points, run_time)),
+             ('Throughput', throughput_points),
+             (box_interval * 0.5, boxes),
+             template_vars['graph_filenames'][timer_string]['resptime']),
+            dict(timer=timer_string, output_dir=results_dir)))
+
+    if cached_timers is None:
+        results_cache.save_aggregates(cache_params, timer_vals)
+
+    # the breakdown of all transactions goes in the summary
+    template_vars['user_groups']=timer_vals['Transactions']['groups']
+    template_vars['errors']=timer_vals['Transactions']['errors']
+
+    if graph_tasks:
+        # every timer's graph is drawn in its own process
+        graph.render_graphs(graph_tasks, graph_processes)
 
     with open(os.path.join(results_dir, 'results.html'), 'w') as f:
         f.write(template.render(**template_vars))
 
 
+def timer_report_vals(results, timer_string, timer_points, ts_interval,
+                      run_time, sketches, phases, group_ids):
+    """
+    The report tables of a timer: its summary, interval table, phase table,
+    graph lines, interval boxes and its breakdown by user group and error
+    (see ``breakdown_vals``), as a dict that can be cached as JSON.
+    """
+    summary, table, graph_data, boxes=timer_table_vals(
+        timer_points.copy(), ts_interval)
+    if sketches and timer_string in sketches.timers:
+        high_pcts = sketches.timers[timer_string].percentiles(HIGH_PERCENTILES)
+        for p, q in zip(HIGH_PERCENTILES, high_pcts.tolist()):
+            summary[sketch.pct_name(p)] = q
+    timer_phases=None
+    if phases:
+        timer_phases=phase_table_vals(
+            timer_points, results.timer_groups(timer_string), group_ids,
+            phases, run_time)
+    # float keys don't survive JSON, the lines are kept as [x, y] pairs
+    graph_lines=dict((name, sorted(line.items()))
+                     for name, line in graph_data.iteritems())
+    vals=dict(s=summary, table=table, phases=timer_phases,
+              graph_data=graph_lines, boxes=boxes)
+    vals.update(breakdown_vals(
+        timer_points, results.timer_groups(timer_string),
+        results.error[results.timer_transactions(timer_string)],
+        results.strings, ts_interval, table))
+    return vals
+
+
+def write_timer_series(report_dir, index, vals, timer_points):
+    """
+    Write the interval stats, the distribution and the series of every user
+    group and error of a timer for the interactive report, as
+    ``timer_<index>.js`` in ``report_dir``. It hands them to the report
+    page when loaded. ``vals`` are the report tables of the timer, from
+    ``timer_report_vals``.
+    """
+    timer_table=vals['table']
+    names=('interval', 'count', 'rate', 'min', 'avg', 'pct_50', 'pct_80',
+           'pct_90', 'pct_95', 'max', 'stdev')
+    intervals=dict((name, compact_series([row[name] for row in timer_table]))
+                   for name in names)
+
+    # group and error series, lined up with the intervals of the timer
+    positions=dict((row['interval'], i) for i, row in enumerate(timer_table))
+    groups={}
+    for name, series in vals['group_series'].iteritems():
+        pct_95=[None] * len(timer_table)
+        for key, value in zip(series['interval'], series['pct_95']):
+            pct_95[positions[key]]=value
+        groups[name]=compact_series(pct_95)
+    errors=[]
+    for row in vals['errors']:
+        counts=[0] * len(timer_table)
+        for key, count in zip(row['series']['interval'], row['series']['count']):
+            counts[positions[key]]=count
+        errors.append(dict(error=row['error'], counts=counts))
+
+    values=timer_points[:,1]
+    top=np.percentile(values, 99) or values.max() or 1.0
+    counts, edges=np.histogram(values[values <= top], bins=HISTOGRAM_BINS,
+                               range=(0, top))
+    data=dict(intervals=intervals, groups=groups, errors=errors,
+              histogram=dict(edges=compact_series(edges),
+                             counts=counts.tolist(),
+                             above=int((values > top).sum())))
+    with open(os.path.join(report_dir, 'timer_%i.js' % index), 'w') as f:
+        f.write('mmReport.timerLoaded(%i, %s);\n' % (
+            index, json.dumps(data, separators=(',', ':'))))
+
+
+def compact_series(values):
+    """Values rounded to 6 significant digits, NaN as None, for JSON."""
+    return [v if isinstance(v, (int, long)) else
+            None if v is None or v != v else float('%.6g' % v)
+            for v in values]
+
+
 class Results(object):
-    def __init__(self, results_file_name, run_time):
+    """
+    The results of a test run, held as NumPy columns.
+
+    One entry per transaction, in the order they were written:
+
+    ``start``, ``elapsed``, ``epoch``, ``trans_time``
+        as written by the agents. ``start`` and ``elapsed`` (the finish)
+        are seconds since the start of the run.
+    ``user_group``, ``error``
+        ids into ``strings``, ``error`` is -1 for transactions that didn't
+        fail
+
+    and one entry per custom timer value, sorted by timer:
+
+    ``timer_ids``
+        ids into ``strings``
+    ``timer_trans``
+        index of the transaction the value belongs to
+    ``timer_times``
+        time since the start of the run, the start of the transaction for
+        values without an exact time
+    ``timer_values``
+        the measured value
+
+    Transactions from after the end of the run are dropped. They still
+    count in ``total_transactions``, and in ``total_errors`` if they
+    failed, except for the open workload transactions that never got to
+    start, which are counted as ``missed_dispatches``.
+
+    ``parsed`` is what ``read_results_file`` returned for the file, for
+    callers that already read it.
+    """
+    def __init__(self, results_file_name, run_time, parsed=None):
         self.results_file_name = results_file_name
         self.run_time = run_time
         self.total_transactions = 0
         self.total_errors = 0
-        self.uniq_timer_names = set()
-        self.uniq_user_group_names = set()
+        self.missed_dispatches = 0
+
+        if parsed is None:
+            parsed = self.parse_file()
+        records, samples, self.strings = parsed
+        self.set_columns(records, samples)
 
-        self.resp_stats_list = self.parse_file()
+        self.uniq_timer_names = set(self.timer_slices)
+        self.uniq_user_group_names = set(
+            self.strings[i] for i in np.unique(self.user_group))
 
-        self.epoch_start = self.resp_stats_list[0].epoch_secs
-        self.epoch_finish = self.resp_stats_list[-1].epoch_secs
+        self.epoch_finish = self.epoch[-1]
         self.start_datetime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.epoch_start))
         self.finish_datetime = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.epoch_finish))
 
-    def parse_file(self):
-        if not os.path.exists(self.results_file_name):
-            logger.critical("Results CSV doesn't exist")
-            logger.debug("Expected results CSV at: %s", self.results_file_name)
-        f = csv.reader(open(self.results_file_name, 'rb'))
-        logger.debug("Reading CSV file: %s", self.results_file_name)
-
-        resp_stats_list = []
-        for fields in f:
-            request_num = int(fields[0])
-            elapsed_time = float(fields[1])
-            epoch_secs = float(fields[2])
-            user_group_name = fields[3]
-            trans_time = float(fields[4])
-            error = fields[5]
-
-            self.uniq_user_group_names.add(user_group_name)
-
-            custom_timers = json.loads(fields[6])
-            self.uniq_timer_names.update(custom_timers.keys())
-
-            response_stats = ResponseStats(
-                request_num,
-                elapsed_time,
-                epoch_secs,
-                user_group_name,
-                trans_time,
-                error,
-                custom_timers)
-
-            if elapsed_time < self.run_time:
-                # Drop all times that appear after the last request was sent
-                # (incomplete interval)
-                resp_stats_list.append(response_stats)
-
-            if error != '':
-                self.total_errors += 1
-
-            self.total_transactions += 1
-
-        # Ensure the CSV was parsaeble
-        if not resp_stats_list:
-            logger.critical("Error parsing CSV results file")
+    def set_columns(self, records, samples):
+        self.total_transactions = len(records['elapsed'])
+        # open workload transactions that never started are counted apart
+        # from the ones that failed
+        missed = np.in1d(records['error'], [
+            i for i, s in enumerate(self.strings)
+            if s == transport.MISSED_DISPATCH])
+        self.missed_dispatches = int(missed.sum())
+        self.total_errors = int(
+            (records['error'] != NO_ERROR).sum()) - self.missed_dispatches
+
+        # Drop all times that appear after the last request was sent
+        # (incomplete interval)
+        keep = records['elapsed'] < self.run_time
+        if not keep.any():
+            logger.critical("Error parsing results file")
             exit(1)
+        self.start = records['start'][keep]
+        self.elapsed = records['elapsed'][keep]
+        self.epoch = records['epoch'][keep]
+        self.user_group = records['user_group'][keep]
+        self.trans_time = records['trans_time'][keep]
+        self.error = records['error'][keep]
+        self.epoch_start = self.epoch[0]
+        # wall clock time of the start of the run. The median copes with
+        # older results, whose epoch was truncated to whole seconds.
+        self.run_start_time = float(np.median(self.epoch - self.elapsed))
+
+        sample_trans = samples['trans']
+        sample_keep = keep[sample_trans]
+        sample_trans = sample_trans[sample_keep]
+        timer_ids = samples['timer'][sample_keep]
+        timer_times = samples['time'][sample_keep]
+        timer_values = samples['value'][sample_keep]
+
+        # values without an exact time started with their transaction,
+        # exact times need to be made relative to the start of the run
+        at_trans = np.isnan(timer_times)
+        timer_times = np.where(
+            at_trans, records['start'][sample_trans],
+            timer_times - self.run_start_time)
+
+        # sorting once by timer turns every timer into a slice of the table
+        order = np.argsort(timer_ids, kind='mergesort')
+        self.timer_ids = timer_ids[order]
+        self.timer_trans = (np.cumsum(keep) - 1)[sample_trans[order]]
+        self.timer_times = timer_times[order]
+        self.timer_values = timer_values[order]
+
+        self.timer_slices = {}
+        ids = np.unique(self.timer_ids)
+        starts = np.searchsorted(self.timer_ids, ids, side='left')
+        ends = np.searchsorted(self.timer_ids, ids, side='right')
+        for timer_id, start, end in zip(ids, starts, ends):
+            self.timer_slices[self.strings[timer_id]] = slice(start, end)
+
+    def timer_points(self, timer_name):
+        """
+        Returns the [time since start of run, value] points of a timer.
+
+        The transaction times are available as the "Transactions" timer,
+        at the time each transaction started.
+        """
+        if timer_name == 'Transactions':
+            return np.column_stack((self.start, self.trans_time))
+        timer_slice = self.timer_slices.get(timer_name, slice(0, 0))
+        return np.column_stack((self.timer_times[timer_slice],
+                                self.timer_values[timer_slice]))
+
+    def timer_transactions(self, timer_name):
+        """
+        Returns the transaction index of every point returned by
+        ``timer_points``.
+        """
+        if timer_name == 'Transactions':
+            return np.arange(len(self.trans_time))
+        timer_slice = self.timer_slices.get(timer_name, slice(0, 0))
+        return self.timer_trans[timer_slice]
+
+    def timer_groups(self, timer_name):
+        """
+        Returns the user group id of every point returned by
+        ``timer_points``.
+        """
+        if timer_name == 'Transactions':
+            return self.user_group
+        return self.user_group[self.timer_transactions(timer_name)]
+
+    def parse_file(self):
+        """
+        Returns the transaction columns, the timer columns and the string
+        table of the results file.
+        """
+        return read_results_file(self.results_file_name)
+
+
+def read_results_file(results_file_name, processes=None):
+    """
+    Returns the transaction columns, the timer columns and the string table
+    of a results file, in any of the results formats. Nothing is dropped.
+
+    CSV files of PARALLEL_PARSE_BYTES or more are split into chunks of
+    whole lines, which ``processes`` processes (one per CPU by default)
+    parse at the same time.
+    """
+    if not os.path.exists(results_file_name):
+        logger.critical("Results file doesn't exist")
+        logger.debug("Expected results file at: %s", results_file_name)
+    if results_file_name.endswith(mmbin.RESULTS_FILE):
+        return read_mmbin_file(results_file_name)
+
+    logger.debug("Reading CSV file: %s", results_file_name)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    timers_file_name = os.path.join(
+        os.path.dirname(results_file_name), 'results_timers.csv')
+    with open(results_file_name, 'rb') as f:
+        # a columnar results file has a header, and its timers live in
+        # their own file
+        columnar = f.readline().startswith('trans_count')
+
+    chunks = timer_chunks = None
+    if processes > 1:
+        try:
+            chunks = parse_parallel(_parse_results_task, results_file_name,
+                                    (columnar,), processes)
+        except (ValueError, IndexError, csv.Error), e:
+            # a chunk that started within a quoted field spanning lines
+            logger.debug('Parallel parsing failed (%s)', e)
+        if chunks is not None and not chunks_follow(chunks):
+            logger.debug('Chunks of %s don\'t line up', results_file_name)
+            chunks = None
+        if columnar:
+            try:
+                timer_chunks = parse_parallel(
+                    _parse_timers_task, timers_file_name, (), processes)
+            except (ValueError, IndexError, csv.Error), e:
+                logger.debug('Parallel parsing failed (%s)', e)
+    if chunks is None:
+        chunks = [parse_results_range(results_file_name, 0, None, columnar)]
+    if columnar:
+        if timer_chunks is None:
+            # too small to be worth splitting, or splitting it failed
+            timer_chunks = [parse_timers_range(timers_file_name, 0, None)]
+        chunks += timer_chunks
+    return merge_chunks(chunks)
 
-        return resp_stats_list
+def read_mmbin_file(results_file_name):
+    try:
+        f = mmbin.MMBinFile(results_file_name)
+    except (IOError, ValueError), e:
+        logger.critical("Error reading binary results file: %s", e)
+        exit(1)
+    return f.records, f.samples, f.strings
 
+def parse_parallel(parse_task, file_name, args, processes):
+    """
+    Parse ``file_name`` in chunks of lines in a pool of processes, with
+    ``parse_task((file_name, start, end) + args)``. Returns the parsed
+    chunks, or None if the file is too small to bother.
+    """
+    size = os.path.getsize(file_name)
+    if size < PARALLEL_PARSE_BYTES:
+        return None
+    chunk_bytes = max(PARSE_CHUNK_BYTES,
+                      size // (processes * PARSE_CHUNKS_PER_PROCESS))
+    tasks = [(file_name, start, end) + args
+             for start, end in split_lines(file_name, chunk_bytes)]
+    pool = multiprocessing.Pool(min(processes, len(tasks)))
+    try:
+        # get() with a timeout, so ctrl-c isn't ignored while waiting
+        chunks = pool.map_async(parse_task, tasks, chunksize=1).get(1e9)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return chunks
+
+def split_lines(file_name, chunk_bytes):
+    """
+    Returns (start, end) byte ranges of about ``chunk_bytes`` covering a
+    file, split at the start of lines. The last end is None.
+    """
+    size = os.path.getsize(file_name)
+    offsets = [0]
+    with open(file_name, 'rb') as f:
+        while offsets[-1] + chunk_bytes < size:
+            f.seek(offsets[-1] + chunk_bytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            offsets.append(f.tell())
+    return zip(offsets, offsets[1:] + [None])
+
+def chunks_follow(chunks):
+    """
+    Whether every chunk of transactions starts right after the previous
+    one, which it doesn't if the file was split within a row.
+    """
+    last = None
+    for chunk in chunks:
+        if chunk['first'] is None:
+            continue
+        if last is not None and chunk['first'] != last + 1:
+            return False
+        last = chunk['last']
+    return True
+
+def read_lines(f, end):
+    """The lines of ``f`` from where it is up to byte ``end``."""
+    pos = f.tell()
+    while end is None or pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
 
-class ResponseStats(object):
-    def __init__(self, request_num, elapsed_time, epoch_secs, user_group_name, trans_time, error, custom_timers):
-        self.request_num = request_num
-        self.elapsed_time = elapsed_time
-        self.epoch_secs = epoch_secs
-        self.user_group_name = user_group_name
-        self.trans_time = trans_time
-        self.error = error
-        self.custom_timers = custom_timers
+def _parse_results_task(args):
+    return parse_results_range(*args)
+
+def _parse_timers_task(args):
+    return parse_timers_range(*args)
+
+def parse_results_range(results_file_name, start, end, columnar):
+    """
+    Parse the rows of a CSV results file from byte ``start`` to ``end``.
+    Returns a chunk for ``merge_chunks``: a dict of the transaction and
+    timer columns, and of the strings they refer to. Timer values refer to
+    transactions by their index in the chunk.
+    """
+    strings = StringTable()
+    with open(results_file_name, 'rb') as f:
+        f.seek(start)
+        chunk = parse_results_rows(
+            csv.reader(read_lines(f, end)), columnar, strings)
+    chunk['strings'] = strings.strings
+    return chunk
+
+def parse_results_rows(rows, columnar, strings):
+    """
+    Parse rows of a CSV results file, with string ids from ``strings``, a
+    StringTable. Returns a dict of the transaction and timer columns, and
+    the first and last trans_count. Timer values refer to transactions by
+    their index in the rows.
+    """
+    columns = ([], [], [], [], [], [])
+    start_times, elapsed, epoch, user_group, trans_time, error = columns
+    sample_columns = ([], [], [], [])
+    sample_trans, timer_ids, timer_times, timer_values = sample_columns
+    first = last = None
+
+    # the start comes last, older results don't have it
+    start_column = 6 if columnar else 7
+    for fields in rows:
+        if fields[0] == 'trans_count':
+            continue
+        last = int(fields[0])
+        if first is None:
+            first = last
+        trans = len(elapsed)
+        elapsed.append(float(fields[1]))
+        epoch.append(float(fields[2]))
+        user_group.append(strings[fields[3]])
+        trans_time.append(float(fields[4]))
+        error.append(strings[fields[5]] if fields[5] else NO_ERROR)
+        if len(fields) > start_column:
+            start_times.append(float(fields[start_column]))
+        else:
+            start_times.append(elapsed[-1] - trans_time[-1])
+
+        if not columnar:
+            for name, t, v in transport.iter_timer_samples(
+                    json.loads(fields[6])):
+                sample_trans.append(trans)
+                timer_ids.append(strings[name])
+                timer_times.append(t)
+                timer_values.append(v)
+
+    records = dict(zip(
+        ('start', 'elapsed', 'epoch', 'user_group', 'trans_time', 'error'),
+        [np.array(c, dtype=float) for c in (start_times, elapsed, epoch)] +
+        [np.array(user_group, dtype=int)] +
+        [np.array(trans_time, dtype=float)] +
+        [np.array(error, dtype=int)]))
+    return dict(records=records, samples=sample_arrays(sample_columns),
+                first=first, last=last)
+
+def parse_timers_range(timers_file_name, start, end):
+    """
+    Parse the rows of a ``results_timers.csv`` from byte ``start`` to
+    ``end``. Returns a chunk for ``merge_chunks`` without transactions,
+    whose timer values refer to transactions by their index in the file.
+    """
+    logger.debug("Reading timers CSV file: %s", timers_file_name)
+    strings = StringTable()
+    with open(timers_file_name, 'rb') as f:
+        f.seek(start)
+        samples = parse_timers_rows(csv.reader(read_lines(f, end)), strings)
+    return dict(records=None, samples=samples,
+                strings=strings.strings, first=None, last=None)
+
+def parse_timers_rows(rows, strings):
+    """
+    Parse rows of a ``results_timers.csv``, with string ids from
+    ``strings``. Returns the timer columns, whose values refer to
+    transactions by their index in the file.
+    """
+    sample_columns = ([], [], [], [])
+    sample_trans, timer_ids, timer_times, timer_values = sample_columns
+    for request_num, timer_name, t, value in rows:
+        if request_num == 'trans_count':
+            continue  # header
+        sample_trans.append(int(request_num) - 1)
+        timer_ids.append(strings[timer_name])
+        timer_times.append(float(t) if t else NAN)
+        timer_values.append(float(value))
+    return sample_arrays(sample_columns)
+
+def iter_results_chunks(results_file_name, chunk_size):
+    """
+    Yields the transaction columns, the timer columns and the string table
+    of a results file, in any of the results formats, ``chunk_size``
+    transactions at a time, so a run of any length can be gone through in
+    little memory. Timer values refer to transactions by their index in
+    the chunk. The string table grows as the chunks are read, the ids in
+    earlier chunks stay valid.
+    """
+    if results_file_name.endswith(mmbin.RESULTS_FILE):
+        # memory-mapped, slices of it are only read when used
+        records, samples, strings = read_mmbin_file(results_file_name)
+        num_trans = len(records)
+        for first in xrange(0, num_trans, chunk_size):
+            last = min(first + chunk_size, num_trans)
+            sample_first, sample_last = np.searchsorted(
+                samples['trans'], [first, last]).tolist()
+            chunk_samples = dict(
+                (name, samples[name][sample_first:sample_last])
+                for name in ('trans', 'timer', 'time', 'value'))
+            chunk_samples['trans'] = chunk_samples['trans'] - first
+            yield (dict((name, records[name][first:last])
+                        for name in records.dtype.names),
+                   chunk_samples, strings)
+        return
+
+    strings = StringTable()
+    timers_file_name = os.path.join(
+        os.path.dirname(results_file_name), 'results_timers.csv')
+    with open(results_file_name, 'rb') as f:
+        columnar = f.readline().startswith('trans_count')
+        f.seek(0)
+        rows = csv.reader(f)
+        timer_rows = pending = None
+        if columnar:
+            timers_file = open(timers_file_name, 'rb')
+            timer_rows = csv.reader(timers_file)
+            pending = []  # the first timer row of the next chunk
+        try:
+            num_trans = 0
+            while True:
+                chunk = parse_results_rows(
+                    itertools.islice(rows, chunk_size), columnar, strings)
+                if chunk['first'] is None:
+                    break
+                samples = chunk['samples']
+                if columnar:
+                    chunk_rows = []
+                    for row in itertools.chain(pending, timer_rows):
+                        if (row[0] != 'trans_count' and
+                                int(row[0]) > chunk['last']):
+                            pending = [row]
+                            break
+                        chunk_rows.append(row)
+                    else:
+                        pending = []
+                    samples = parse_timers_rows(chunk_rows, strings)
+                    samples['trans'] -= num_trans
+                num_trans += len(chunk['records']['elapsed'])
+                yield chunk['records'], samples, strings.strings
+        finally:
+            if columnar:
+                timers_file.close()
+
+def sample_arrays(sample_columns):
+    sample_trans, timer_ids, timer_times, timer_values = sample_columns
+    return dict(
+        trans=np.array(sample_trans, dtype=int),
+        timer=np.array(timer_ids, dtype=int),
+        time=np.array(timer_times, dtype=float),
+        value=np.array(timer_values, dtype=float))
+
+def merge_chunks(chunks):
+    """
+    Returns the transaction columns, the timer columns and the string
+    table of parsed chunks, in order. Chunks without transactions hold the
+    timer values of a columnar file, which refer to all the transactions.
+    """
+    strings = StringTable()
+    records = dict((name, []) for name in
+                   ('start', 'elapsed', 'epoch', 'user_group', 'trans_time',
+                    'error'))
+    samples = dict((name, []) for name in ('trans', 'timer', 'time', 'value'))
+    num_trans = 0
+    for chunk in chunks:
+        # from the chunk's string ids to the merged ones
+        ids = np.array([strings[name] for name in chunk['strings']] + [-1],
+                       dtype=int)
+        if chunk['records'] is not None:
+            for name, column in chunk['records'].iteritems():
+                if name in ('user_group', 'error'):
+                    # NO_ERROR (-1) is the extra id at the end
+                    column = ids[column]
+                records[name].append(column)
+            sample_trans = chunk['samples']['trans'] + num_trans
+            num_trans += len(chunk['records']['elapsed'])
+        else:
+            sample_trans = chunk['samples']['trans']
+        samples['trans'].append(sample_trans)
+        samples['timer'].append(ids[chunk['samples']['timer']])
+        samples['time'].append(chunk['samples']['time'])
+        samples['value'].append(chunk['samples']['value'])
+    for columns in (records, samples):
+        for name in columns:
+            columns[name] = np.concatenate(columns[name])
+    return records, samples, strings.strings
+
+class StringTable(dict):
+    """Hands out consecutive ids for strings, in ``strings``."""
+    def __init__(self):
+        dict.__init__(self)
+        self.strings = []
+
+    def __missing__(self, s):
+        string_id = self[s] = len(self.strings)
+        self.strings.append(s)
+        return string_id
+
+
+def bucket_series(points, interval):
+    """
+    Buckets [time, value] points into intervals of ``interval`` seconds,
+    counted from the start of the run, with a single sort. The interval
+    latency sketches and the database rollups use the same intervals.
+
+    Returns (keys, starts, counts, values): ``values`` holds the values
+    sorted by interval and then by value, and the values of the interval
+    starting at ``keys[i]`` are ``values[starts[i]:starts[i] + counts[i]]``.
+    Empty intervals are left out.
+    """
+    points=np.asarray(points,dtype=float)
+    times=interval*(points[:,0]//interval)
+    order=np.lexsort((points[:,1], times))
+    times=times[order]
+    values=points[order,1]
+
+    starts=np.flatnonzero(np.diff(times)) + 1
+    starts=np.concatenate(([0], starts))
+    counts=np.diff(np.concatenate((starts, [len(times)])))
+    return times[starts], starts, counts, values
+
+
+def bucket_stats(starts, counts, values, pct=PERCENTILES):
+    """
+    Computes the min, avg, max, stdev and pct_<n> columns of every bucket
+    returned by ``bucket_series`` at once.
+    """
+    ends=starts + counts
+    sums=np.add.reduceat(values, starts)
+    avg=sums / counts
+    deviations=values - np.repeat(avg, counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # sample stdev, which is NaN for single values
+        stdev=np.sqrt(np.add.reduceat(deviations * deviations, starts)
+                      / (counts - 1))
+
+    stats=dict(min=values[starts], max=values[ends - 1], avg=avg, stdev=stdev)
+    for p in pct:
+        stats['pct_%s'%p]=sorted_percentile(values, starts, counts, p)
+    return stats
+
+
+def sorted_percentile(values, starts, counts, p):
+    """
+    The linearly interpolated ``p`` percentile of each sorted run
+    ``values[starts[i]:starts[i] + counts[i]]``, like ``np.percentile``.
+    """
+    pos=(counts - 1) * (p / 100.0)
+    below=np.floor(pos).astype(int)
+    above=np.minimum(below + 1, counts - 1)
+    frac=pos - below
+    low=values[starts + below]
+    high=values[starts + above]
+    return low + (high - low) * frac
+
+
+def box_stats(keys, starts, counts, values):
+    """
+    The stats of a box plot of every bucket returned by ``bucket_series``:
+    its quartiles, and whiskers 1.5 times the interquartile range beyond
+    them, clipped to the bucket's min and max.
+    """
+    q1=sorted_percentile(values, starts, counts, 25)
+    med=sorted_percentile(values, starts, counts, 50)
+    q3=sorted_percentile(values, starts, counts, 75)
+    iqr=q3 - q1
+    whislo=np.maximum(values[starts], q1 - 1.5 * iqr)
+    whishi=np.minimum(values[starts + counts - 1], q3 + 1.5 * iqr)
+    names=('pos', 'q1', 'med', 'q3', 'whislo', 'whishi')
+    return [dict(zip(names, row)) for row in zip(
+        *[c.tolist() for c in (keys, q1, med, q3, whislo, whishi)])]
+
+
+def sketch_box_stats(timer_intervals, interval):
+    """
+    ``box_stats`` from the interval latency sketches of a timer, merged
+    into intervals of ``interval`` seconds.
+    """
+    merged={}
+    for key, histogram in timer_intervals.iteritems():
+        box_key=key // interval * interval
+        merged.setdefault(box_key, sketch.LatencyHistogram())
+        merged[box_key] += histogram
+    boxes=[]
+    for key in sorted(merged):
+        histogram=merged[key]
+        if not histogram.count:
+            continue
+        q1, med, q3=histogram.percentiles([25, 50, 75]).tolist()
+        iqr=q3 - q1
+        boxes.append(dict(pos=key, q1=q1, med=med, q3=q3,
+                          whislo=max(histogram.min, q1 - 1.5 * iqr),
+                          whishi=min(histogram.max, q3 + 1.5 * iqr)))
+    return boxes
 
 
 def group_series(points, interval):
     """
     Returns [key, [list of values]], where key is the maximal step
     below each of the corresponding values.
-
-    This function may sort points.
     """
-    points=np.asarray(points,dtype=float)
-    points[:,0]=interval*((points[:,0]-points[0,0])//interval)
-    # sort points by first column, then group by first column
-    points=points[points[:,0].argsort(),]
-    grouping=[(key,map(itemgetter(1), values))
-            for key,values in groupby(points,itemgetter(0))]
-    return grouping
+    keys, starts, counts, values = bucket_series(points, interval)
+    return [(key, values[start:start + count]) for key, start, count
+            in zip(keys.tolist(), starts.tolist(), counts.tolist())]
+
+
+def cell_counts(cells, num_cells):
+    """How many times each of ``range(num_cells)`` is in ``cells``."""
+    counts=np.zeros(num_cells, dtype=int)
+    if len(cells):
+        found=np.bincount(cells)
+        counts[:len(found)]=found
+    return counts
 
 if __name__ == '__main__':
     output_results('./', 'results.csv', 120, 1, 5)
@@ -7,19 +7,44 @@
 #
 """a collection of functions and classes for multi-mechanize results files"""
 
-import re
-import fileinput
+import logging
+import os
 from datetime import datetime
 
+import numpy as np
+
+import results
+import sketch
+import transport
+from transport import NO_ERROR
+
 try:
     from sqlalchemy.ext.declarative import declarative_base
-    from sqlalchemy.orm import sessionmaker, relation
-    from sqlalchemy import create_engine
-    from sqlalchemy import Column, Integer, String, Float, DateTime
-    from sqlalchemy import ForeignKey, UniqueConstraint
+    from sqlalchemy.orm import relation
+    from sqlalchemy import create_engine, inspect
+    from sqlalchemy import Column, Integer, String, Float, DateTime, Text
+    from sqlalchemy import ForeignKey, Index, UniqueConstraint
+    from sqlalchemy import and_, func, select
+    from sqlalchemy.schema import CreateTable
 except ImportError:
     print "(optional: please install sqlalchemy to enable db logging)"
 
+# first try to import a fast newer version of simplejson
+try:
+    import simplejson as json
+except ImportError:
+    # fall back to the old, slow library version
+    import json
+
+logger = logging.getLogger('mm_resultsloader')
+
+# transactions inserted per database transaction
+CHUNK_SIZE = 10000
+
+# percentiles kept in columns of the rollup tables, for querying. The
+# sketches they come from give any other percentile.
+ROLLUP_PERCENTILES = [50, 90, 95, 99]
+
 
 Base = declarative_base()
 
@@ -69,7 +94,8 @@ class ResultRow(Base):
     """class representing a multi-mechanize results.csv row"""
     __tablename__ = 'mechanize_results'
     __table_args__ = (
-        UniqueConstraint('run_id','trans_count', name='uix_1')
+        UniqueConstraint('project_name', 'run_id', 'trans_count',
+                         name='uix_1'),
         )
 
     id = Column(Integer, nullable=False, primary_key=True)
@@ -129,51 +155,398 @@ class TimerRow(Base):
     result_rows = relation("ResultRow",
         primaryjoin="TimerRow.mechanize_results_id==ResultRow.id")
 
+class TimerInterval(Base):
+    """
+    class representing the values of a timer in one interval of a run
+
+    ``interval_start`` is seconds since the start of the run, ``sketch`` a
+    JSON ``sketch.LatencyHistogram``.
+    """
+    __tablename__ = 'mechanize_timer_intervals'
+    __table_args__ = (
+        Index('ix_timer_intervals_run', 'project_name', 'run_id'),
+        Index('ix_timer_intervals_timer', 'project_name', 'timer_name',
+              'run_id'),
+        )
+
+    id = Column(Integer, nullable=False, primary_key=True)
+    mechanize_global_configs_id = Column(Integer,
+        ForeignKey('mechanize_global_configs.id'), nullable=False)
+    project_name = Column(String(50), nullable=False)
+    run_id = Column(DateTime, nullable=False)
+    timer_name = Column(String(50), nullable=False)
+    interval_start = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+    errors = Column(Integer, nullable=False)
+    min_time = Column(Float)
+    avg_time = Column(Float)
+    max_time = Column(Float)
+    stdev_time = Column(Float)
+    pct_50 = Column(Float)
+    pct_90 = Column(Float)
+    pct_95 = Column(Float)
+    pct_99 = Column(Float)
+    sketch = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return "<TimerInterval('%s','%s','%s','%.3f','%i')>" % (
+                self.project_name, self.run_id, self.timer_name,
+                self.interval_start, self.count)
+
+class RunSummary(Base):
+    """
+    class representing the values of a timer over a whole run
+
+    The "Transactions" timer holds the transaction times, its count and
+    errors are the run's.
+    """
+    __tablename__ = 'mechanize_run_summaries'
+    __table_args__ = (
+        UniqueConstraint('project_name', 'run_id', 'timer_name',
+                         name='uix_run_summaries'),
+        Index('ix_run_summaries_timer', 'project_name', 'timer_name',
+              'run_id'),
+        )
+
+    id = Column(Integer, nullable=False, primary_key=True)
+    mechanize_global_configs_id = Column(Integer,
+        ForeignKey('mechanize_global_configs.id'), nullable=False)
+    project_name = Column(String(50), nullable=False)
+    run_id = Column(DateTime, nullable=False)
+    timer_name = Column(String(50), nullable=False)
+    run_time = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+    errors = Column(Integer, nullable=False)
+    throughput = Column(Float, nullable=False)
+    min_time = Column(Float)
+    avg_time = Column(Float)
+    max_time = Column(Float)
+    stdev_time = Column(Float)
+    pct_50 = Column(Float)
+    pct_90 = Column(Float)
+    pct_95 = Column(Float)
+    pct_99 = Column(Float)
+    sketch = Column(Text, nullable=False)
+
+    def __repr__(self):
+        return "<RunSummary('%s','%s','%s','%i','%i')>" % (
+                self.project_name, self.run_id, self.timer_name,
+                self.count, self.errors)
+
 def load_results_database(project_name, run_localtime, results_dir, 
         results_database, run_time, rampup, results_ts_interval,
-        user_group_configs):
-    """parse and load a multi-mechanize results csv file into a database"""
+        user_group_configs, results_file=None, chunk_size=CHUNK_SIZE):
+    """
+    load a multi-mechanize results file (in any results format) into a
+    database
+
+    The file is read ``chunk_size`` transactions at a time, and rows are
+    inserted with executemany a chunk at a time, each chunk in its own
+    database transaction, so memory use doesn't grow with the length of
+    the run. Loading the same run again picks up after the last chunk
+    that made it in. Tables are created without their indexes, which are
+    only added once everything is loaded.
+
+    The run's rollups, per timer and per ``results_ts_interval`` as well as
+    per timer over the whole run, are gathered from the chunks as they go
+    by and (re)written last, in one database transaction. Like the
+    report, they leave out the transactions from after the end of the run.
+    """
+    if results_file is None:
+        results_file = os.path.join(results_dir, 'results.csv')
 
-    logline_re = re.compile('(.+),(.+),(.+),(.+),(.+),(.?),(\{.+\})')
-    
     engine = create_engine(results_database, echo=False)
-    ResultRow.metadata.create_all(engine)
-    TimerRow.metadata.create_all(engine)
-    GlobalConfig.metadata.create_all(engine)
-    UserGroupConfig.metadata.create_all(engine)
-
-    sa_session = sessionmaker(bind=engine)
-    sa_current_session = sa_session()
-    
+    create_tables(engine)
+
     run_id = datetime(run_localtime.tm_year, run_localtime.tm_mon,
         run_localtime.tm_mday, run_localtime.tm_hour, run_localtime.tm_min,
         run_localtime.tm_sec)
 
-    results_file = results_dir + 'results.csv'
-   
-    global_config = GlobalConfig(run_time, rampup, results_ts_interval)
-    sa_current_session.add(global_config)
-    
-    for i, ug_config in enumerate(user_group_configs):
-        user_group_config = UserGroupConfig(ug_config.name, 
-                ug_config.num_threads, ug_config.script_file)
-        global_config.user_group_configs.append(user_group_config)
-
-    for line in fileinput.input([results_file]):
-        line = line.rstrip()
-        match = logline_re.match(line)
-        if match:
-            result_row = ResultRow(project_name, run_id, match.group(1), 
-                    match.group(2), match.group(3), match.group(4),
-                    match.group(5), match.group(6), match.group(7))
-    
-            global_config.results.append(result_row)
-            timer_data = eval(match.group(7))
-            for index in timer_data:
-                timer_row = TimerRow(index, timer_data[index])
-                result_row.timers.append(timer_row)
-
-            sa_current_session.add(result_row)
-    
-    sa_current_session.commit()
-    sa_current_session.close()
+    config_id, loaded = loaded_so_far(engine, project_name, run_id)
+    if loaded:
+        logger.info('resuming the load of run %s after %i transactions',
+                    run_id, loaded)
+    rollups = RunRollups(run_time, results_ts_interval)
+    num_trans = 0
+    for records, samples, strings in results.iter_results_chunks(
+            results_file, chunk_size):
+        # timer values in the order of their transactions
+        order = np.argsort(samples['trans'], kind='mergesort')
+        samples = dict((name, np.asarray(samples[name])[order])
+                       for name in ('trans', 'timer', 'time', 'value'))
+        rollups.add_chunk(records, samples, strings)
+
+        chunk_trans = len(records['elapsed'])
+        first = max(loaded - num_trans, 0)
+        if first < chunk_trans:
+            conn = engine.connect()
+            trans = conn.begin()
+            try:
+                if config_id is None:
+                    config_id = insert_config(
+                        conn, run_time, rampup, results_ts_interval,
+                        user_group_configs)
+                insert_chunk(conn, config_id, project_name, run_id, records,
+                             samples, strings, first, chunk_trans, num_trans)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+            finally:
+                conn.close()
+        num_trans += chunk_trans
+
+    if num_trans:
+        conn = engine.connect()
+        trans = conn.begin()
+        try:
+            insert_rollups(conn, config_id, project_name, run_id, rollups)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+
+    create_indexes(engine)
+
+
+def create_tables(engine):
+    """Create the missing results tables, without their indexes."""
+    existing = set(inspect(engine).get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing:
+            engine.execute(CreateTable(table))
+
+
+def create_indexes(engine):
+    """Create the indexes of the results tables that don't exist yet."""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
+def loaded_so_far(engine, project_name, run_id):
+    """
+    Returns the config id and the number of transactions of a run that
+    has (partly) been loaded before, or (None, 0).
+    """
+    results_table = ResultRow.__table__
+    row = engine.execute(
+        select([func.max(results_table.c.trans_count),
+                func.max(results_table.c.mechanize_global_configs_id)])
+        .where(and_(results_table.c.project_name == project_name,
+                    results_table.c.run_id == run_id))).fetchone()
+    if row is None or row[0] is None:
+        return None, 0
+    return row[1], row[0]
+
+
+def insert_config(conn, run_time, rampup, results_ts_interval,
+                  user_group_configs):
+    """Insert the run's global and user group configs, returns the id."""
+    result = conn.execute(GlobalConfig.__table__.insert().values(
+        run_time=run_time, rampup=int(rampup),
+        results_ts_interval=int(results_ts_interval)))
+    config_id = result.inserted_primary_key[0]
+    if user_group_configs:
+        conn.execute(UserGroupConfig.__table__.insert(), [
+            dict(mechanize_global_configs_id=config_id,
+                 user_group=str(ug_config.name),
+                 threads=int(ug_config.num_threads),
+                 script=str(ug_config.script_file))
+            for ug_config in user_group_configs])
+    return config_id
+
+
+def insert_chunk(conn, config_id, project_name, run_id, records, samples,
+                 strings, first, last, offset=0):
+    """
+    Insert transactions ``first`` to ``last`` of a chunk and their timer
+    values. The chunk starts ``offset`` transactions into the run.
+    """
+    results_table = ResultRow.__table__
+    sample_first, sample_last = np.searchsorted(
+        samples['trans'], [first, last]).tolist()
+    chunk_samples = dict((name, column[sample_first:sample_last])
+                         for name, column in samples.iteritems())
+    chunk_samples['trans'] = chunk_samples['trans'] - first
+    custom_timers = transport.custom_timers_from_samples(
+        last - first, chunk_samples, strings)
+
+    errors = records['error'][first:last].tolist()
+    user_groups = records['user_group'][first:last].tolist()
+    conn.execute(results_table.insert(), [
+        dict(mechanize_global_configs_id=config_id,
+             project_name=project_name,
+             run_id=run_id,
+             trans_count=offset + first + i + 1,
+             elapsed=elapsed,
+             epoch=epoch,
+             user_group_name=strings[user_groups[i]],
+             scriptrun_time=trans_time,
+             error=strings[errors[i]] if errors[i] != NO_ERROR else '',
+             custom_timers=json.dumps(custom_timers[i]))
+        for i, (elapsed, epoch, trans_time) in enumerate(zip(
+            records['elapsed'][first:last].tolist(),
+            records['epoch'][first:last].tolist(),
+            records['trans_time'][first:last].tolist()))])
+
+    if not len(chunk_samples['trans']):
+        return
+    # the ids the database gave the transactions
+    result_ids = dict(conn.execute(
+        select([results_table.c.trans_count, results_table.c.id])
+        .where(and_(results_table.c.project_name == project_name,
+                    results_table.c.run_id == run_id,
+                    results_table.c.trans_count > offset + first,
+                    results_table.c.trans_count <= offset + last))).fetchall())
+    conn.execute(TimerRow.__table__.insert(), [
+        dict(mechanize_results_id=result_ids[offset + first + trans + 1],
+             timer_name=strings[timer_id],
+             elapsed=value)
+        for trans, timer_id, value in zip(
+            chunk_samples['trans'].tolist(),
+            chunk_samples['timer'].tolist(),
+            chunk_samples['value'].tolist())])
+
+
+def rollup_values(histogram):
+    """The columns of a rollup row that come from a LatencyHistogram."""
+    summary = histogram.summary(ROLLUP_PERCENTILES)
+    row = dict(min_time=summary['min'],
+               avg_time=summary['avg'],
+               max_time=summary['max'],
+               stdev_time=summary['stdev'])
+    for p in ROLLUP_PERCENTILES:
+        row[sketch.pct_name(p)] = summary[sketch.pct_name(p)]
+    # not every database takes NaN, e.g. the stdev of a single value
+    for name, value in row.items():
+        if value != value:
+            row[name] = None
+    row['count'] = histogram.count
+    row['sketch'] = json.dumps(histogram.to_dict())
+    return row
+
+
+class RunRollups(object):
+    """
+    The LatencyHistograms and error counts of every timer of a run, over
+    the whole run and per ``interval`` seconds since its start, gathered
+    one chunk of results at a time.
+
+    Like ``results.Results``, transactions from after the end of the run
+    are left out and the "Transactions" timer holds the transaction times,
+    at the time each transaction started. The start of the run is taken
+    from the first chunk, exact timer times are relative to it.
+    """
+    def __init__(self, run_time, interval):
+        self.run_time = float(run_time)
+        self.interval = interval
+        self.run_start_time = None
+        # timer name -> [histogram, errors], and timer name -> interval
+        # start -> [histogram, errors]
+        self.timers = {}
+        self.intervals = {}
+
+    def add_chunk(self, records, samples, strings):
+        """Add a chunk of results, as yielded by ``iter_results_chunks``."""
+        keep = records['elapsed'] < self.run_time
+        if not keep.any():
+            return
+        failed = records['error'] != NO_ERROR
+        if self.run_start_time is None:
+            # the median copes with older results, whose epoch was
+            # truncated to whole seconds
+            self.run_start_time = float(np.median(
+                records['epoch'][keep] - records['elapsed'][keep]))
+        self.add('Transactions', records['start'][keep],
+                 records['trans_time'][keep], failed[keep])
+
+        sample_keep = keep[samples['trans']]
+        sample_trans = samples['trans'][sample_keep]
+        timer_ids = samples['timer'][sample_keep]
+        timer_times = samples['time'][sample_keep]
+        # values without an exact time started with their transaction
+        timer_times = np.where(
+            np.isnan(timer_times), records['start'][sample_trans],
+            timer_times - self.run_start_time)
+        timer_values = samples['value'][sample_keep]
+        for timer_id in np.unique(timer_ids).tolist():
+            of_timer = timer_ids == timer_id
+            self.add(strings[timer_id], timer_times[of_timer],
+                     timer_values[of_timer], failed[sample_trans[of_timer]])
+
+    def add(self, timer_name, times, values, failed):
+        """Add the [time, value] points of a timer."""
+        self.record(self.timers, timer_name, values, failed)
+        intervals = self.intervals.setdefault(timer_name, {})
+        keys = (times // self.interval).astype(np.int64)
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        values = values[order]
+        failed = failed[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+        ends = np.concatenate((starts[1:], [len(keys)]))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            self.record(intervals, float(keys[start] * self.interval),
+                        values[start:end], failed[start:end])
+
+    def record(self, rollups, key, values, failed):
+        if key not in rollups:
+            rollups[key] = [sketch.LatencyHistogram(), 0]
+        rollup = rollups[key]
+        rollup[0].record(values)
+        rollup[1] += int(failed.sum())
+
+    def timer_names(self):
+        return ['Transactions'] + sorted(
+            name for name in self.timers if name != 'Transactions')
+
+    def timer_intervals(self, timer_name):
+        """
+        Returns (interval start, histogram, error count) for every interval
+        of a timer with values in it.
+        """
+        return [(interval_start, histogram, errors)
+                for interval_start, (histogram, errors)
+                in sorted(self.intervals[timer_name].iteritems())]
+
+
+def insert_rollups(conn, config_id, project_name, run_id, rollups):
+    """
+    Replace the rollup rows of a run with the ones in ``rollups``, a
+    ``RunRollups``.
+    """
+    for table in (TimerInterval.__table__, RunSummary.__table__):
+        conn.execute(table.delete().where(and_(
+            table.c.project_name == project_name,
+            table.c.run_id == run_id)))
+
+    run_time = rollups.run_time
+    summary_rows = []
+    interval_rows = []
+    for timer_name in rollups.timer_names():
+        histogram, errors = rollups.timers[timer_name]
+        intervals = rollups.timer_intervals(timer_name)
+        keys = dict(mechanize_global_configs_id=config_id,
+                    project_name=project_name,
+                    run_id=run_id,
+                    timer_name=timer_name)
+        row = dict(keys, run_time=run_time, errors=errors,
+                   throughput=histogram.count / run_time)
+        row.update(rollup_values(histogram))
+        summary_rows.append(row)
+        for interval_start, interval_histogram, interval_errors in intervals:
+            row = dict(keys, interval_start=interval_start,
+                       errors=interval_errors)
+            row.update(rollup_values(interval_histogram))
+            interval_rows.append(row)
+
+    if summary_rows:
+        conn.execute(RunSummary.__table__.insert(), summary_rows)
+    if interval_rows:
+        conn.execute(TimerInterval.__table__.insert(), interval_rows)
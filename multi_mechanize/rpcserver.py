@@ -6,16 +6,42 @@
 #  This file is part of Multi-Mechanize
 
 
+import os
 import SimpleXMLRPCServer
 import socket
+import SocketServer
 import thread
+import threading
+import xmlrpclib
+import zlib
+
+import distributed
+
+# first try to import a fast newer version of simplejson
+try:
+    import simplejson as json
+except ImportError:
+    # fall back to the old, slow library version
+    import json
+
+# bytes of a results file sent per get_results_chunk() call
+RESULTS_CHUNK_SIZE = 1 << 20
     
     
     
-def launch_rpc_server(port, project_name, run_callback):  
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn,
+                           SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """
+    Handles every call in its own thread, so status calls get answered
+    while results are being sent.
+    """
+    daemon_threads = True
+
+
+def launch_rpc_server(port, project_name, run_callback, project_path=None):
     host = socket.gethostbyaddr(socket.gethostname())[0]
-    server = SimpleXMLRPCServer.SimpleXMLRPCServer((host, port), logRequests=False)
-    server.register_instance(RemoteControl(project_name, run_callback))
+    server = ThreadedXMLRPCServer((host, port), logRequests=False, allow_none=True)
+    server.register_instance(RemoteControl(project_name, run_callback, project_path))
     server.register_introspection_functions()
     print '\nMulti-Mechanize: %s listening on port %i' % (host, port)
     print 'waiting for xml-rpc commands...\n'
@@ -27,29 +53,60 @@ def launch_rpc_server(port, project_name, run_callback):
 
 
 class RemoteControl(object):
-    def __init__(self, project_name, run_callback):
+    def __init__(self, project_name, run_callback, project_path=None):
         self.project_name = project_name
+        if project_path is None:
+            project_path = os.path.join('projects', project_name)
+        self.project_path = project_path
         self.run_callback = run_callback
+        # calls come in on their own threads, only one may start a test
+        self.lock = threading.Lock()
         self.test_running = False
         self.output_dir = None
+        # wall clock time the next test is to start at, None for right away
+        self.start_time = None
+        # the results of the current (or last) test, see distributed
+        self.stream = distributed.BatchStream()
+        # the ResultsWriter of the current (or last) test
+        self.results_writer = None
     
     def run_test(self):
-        if self.test_running:
-            return 'Test Already Running'
-        else:
-            thread.start_new_thread(self.run_callback, (self,))
-            return 'Test Started'    
+        return self.run_test_at(None)
+
+    def run_test_at(self, start_time):
+        """Start a test, at the wall clock time ``start_time``."""
+        with self.lock:
+            if self.test_running:
+                return 'Test Already Running'
+            self.test_running = True
+            self.start_time = start_time
+            self.stream = distributed.BatchStream()
+            self.results_writer = None
+        thread.start_new_thread(
+            self.run_callback,
+            (self.project_name, self.project_path, self))
+        return 'Test Started'
+
+    def get_batches(self, offset):
+        """
+        Returns the result batches of the current (or last) test from
+        number ``offset`` on, see ``distributed.BatchStream``, and the
+        error the test failed with, if any.
+        """
+        batches, finished = self.stream.fetch(offset)
+        return dict(data=distributed.encode_batches(batches),
+                    finished=finished, error=self.stream.error)
     
     def check_test_running(self):
         return self.test_running
     
     def update_config(self, config):
-        with open('projects/%s/config.cfg' % self.project_name, 'w') as f:
+        with open(os.path.join(self.project_path, 'config.cfg'), 'w') as f:
             f.write(config)
             return True
  
     def get_config(self):
-        with open('projects/%s/config.cfg' % self.project_name, 'r') as f:
+        with open(os.path.join(self.project_path, 'config.cfg'), 'r') as f:
             return f.read()
             
     def get_project_name(self):
@@ -59,5 +116,49 @@ class RemoteControl(object):
         if self.output_dir is None:
             return 'Results Not Available'
         else:
-            with open(self.output_dir + 'results.csv', 'r') as f:
+            with open(os.path.join(self.output_dir, 'results.csv'), 'r') as f:
                 return f.read()
+
+    def list_results(self):
+        """
+        Returns the name and size of every file of the last test's results,
+        for fetching them with get_results_chunk(). Sizes are strings, XML-RPC
+        integers stop at 2 GiB.
+        """
+        if self.output_dir is None:
+            return 'Results Not Available'
+        return [dict(name=name,
+                     size=str(os.path.getsize(os.path.join(self.output_dir, name))))
+                for name in sorted(os.listdir(self.output_dir))
+                if os.path.isfile(os.path.join(self.output_dir, name))]
+
+    def get_results_chunk(self, name, offset, size=RESULTS_CHUNK_SIZE):
+        """
+        Returns up to ``size`` bytes of the results file ``name`` from
+        ``offset`` on, zlib compressed, and the offset of the next chunk.
+        ``eof`` is set on the last chunk. Offsets are passed as strings, like
+        the sizes of list_results().
+        """
+        if self.output_dir is None:
+            return 'Results Not Available'
+        offset = int(offset)
+        size = min(int(size), RESULTS_CHUNK_SIZE)
+        # only files of the results directory itself
+        file_name = os.path.join(self.output_dir, os.path.basename(name))
+        with open(file_name, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+            eof = f.tell() >= os.fstat(f.fileno()).st_size
+        return dict(data=xmlrpclib.Binary(zlib.compress(data)),
+                    offset=str(offset + len(data)), eof=eof)
+
+    def get_summaries(self):
+        """
+        Returns the latency sketches of the current (or last) test, for
+        every timer over the whole run and per time-series interval, as
+        zlib compressed JSON (see ``sketch.TimerSketches.to_dict``).
+        """
+        if self.results_writer is None:
+            return 'Results Not Available'
+        summaries = self.results_writer.sketches_dict()
+        return xmlrpclib.Binary(zlib.compress(json.dumps(summaries)))
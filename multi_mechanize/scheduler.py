@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""load profiles, and dispatching transactions at a target arrival rate"""
+
+import bisect
+import os
+import threading
+import time
+
+import timing
+
+# first try to import a fast newer version of simplejson
+try:
+    import simplejson as json
+except ImportError:
+    # fall back to the old, slow library version
+    import json
+
+PHASES_FILE = 'phases.json'
+
+
+class LoadProfile(object):
+    """
+    A load level (running users, or transactions per second) that changes
+    over the course of a run.
+
+    ``points`` is a list of (time in seconds, level) pairs, sorted by time,
+    that the level moves linearly between. Two points at the same time make
+    the level jump. The level holds at the last point until the end of the
+    run.
+
+    ``phases`` names the parts of the profile, as (name, start, end) with
+    an end of None for "until the end of the run".
+    """
+    def __init__(self, points, phases=()):
+        self.points = list(points)
+        self.times = [t for t, level in self.points]
+        self.phases = list(phases)
+
+    def level(self, t):
+        i = bisect.bisect_right(self.times, t) - 1
+        if i < 0:
+            return 0.0
+        if i == len(self.points) - 1:
+            return self.points[i][1]
+        (t0, level0), (t1, level1) = self.points[i], self.points[i + 1]
+        return level0 + (level1 - level0) * (t - t0) / (t1 - t0)
+
+    def scaled(self, factor):
+        return LoadProfile([(t, level * factor) for t, level in self.points],
+                           self.phases)
+
+    def segments(self, run_time):
+        """
+        Yields (start, end, start level, slope) for every linear part of
+        the profile up to ``run_time``.
+        """
+        points = self.points + [(max(run_time, self.times[-1]),
+                                 self.points[-1][1])]
+        for (t0, level0), (t1, level1) in zip(points, points[1:]):
+            if t1 > t0 and t0 < run_time:
+                yield t0, min(t1, run_time), level0, (level1 - level0) / (t1 - t0)
+
+    def intended_starts(self, run_time):
+        """
+        Taking the level as a rate, yields the time (in seconds since the
+        start of the run) every transaction is meant to start at, up to
+        ``run_time``.
+
+        A transaction is due every time the integral of the rate grows by
+        one, which is exact for ramps as well as for constant rates.
+        """
+        needed = 0.0  # area under the rate until the next transaction
+        for start, end, rate, slope in self.segments(run_time):
+            t = start
+            while True:
+                rate_at_t = rate + slope * (t - start)
+                # solve rate_at_t * dt + slope / 2 * dt ** 2 == needed
+                discriminant = rate_at_t * rate_at_t + 2 * slope * needed
+                if needed == 0:
+                    dt = 0.0
+                elif discriminant < 0 or rate_at_t + discriminant ** 0.5 <= 0:
+                    dt = float('inf')
+                else:
+                    dt = 2 * needed / (rate_at_t + discriminant ** 0.5)
+                if t + dt >= end:
+                    needed -= (rate_at_t + slope * (end - t) / 2) * (end - t)
+                    needed = max(needed, 0.0)
+                    break
+                t += dt
+                if rate_at_t > 0 or slope > 0:
+                    yield t
+                needed = 1.0
+
+
+def worker_share(total, worker, num_workers):
+    """
+    The whole part of ``total`` taken by worker ``worker`` of
+    ``num_workers``. The first workers take one more of what doesn't
+    divide evenly, so the parts always add up to ``total``.
+    """
+    share = total // num_workers
+    if worker < total % num_workers:
+        share += 1
+    return share
+
+
+def parse_profile(value):
+    """
+    Parses a load profile option. It is either a list of phases:
+
+    ``ramp N T``
+        move linearly to level N over T seconds
+    ``hold T``
+        keep the current level for T seconds
+    ``step N [T]``
+        jump to level N (and hold it for T seconds)
+    ``spike N T``
+        jump to level N for T seconds, then back to the current level
+
+    e.g. ``ramp 100 60, hold 300, step 200 300, spike 500 10, ramp 0 60``,
+    starting from level 0. Or it is a level, optionally followed by more
+    ``level@start_secs`` steps, e.g. ``10, 50@30, 100@60``.
+
+    Raises ValueError for anything else.
+    """
+    value = value.strip()
+    if not value[:1].isalpha():
+        return parse_steps(value)
+
+    t = 0.0
+    level = 0.0
+    points = [(t, level)]
+    phases = []
+    for phase in value.split(','):
+        words = phase.split()
+        kind, args = words[0], [float(arg) for arg in words[1:]]
+        if kind == 'ramp' and len(args) == 2:
+            new_level, secs = args
+            phases.append(('ramp to %g' % new_level, t, t + secs))
+            points.append((t + secs, new_level))
+            t, level = t + secs, new_level
+        elif kind == 'hold' and len(args) == 1:
+            secs, = args
+            phases.append(('hold at %g' % level, t, t + secs))
+            points.append((t + secs, level))
+            t += secs
+        elif kind == 'step' and len(args) in (1, 2):
+            new_level = args[0]
+            secs = args[1] if len(args) == 2 else 0
+            phases.append(('step to %g' % new_level, t, t + secs))
+            points.append((t, new_level))
+            points.append((t + secs, new_level))
+            t, level = t + secs, new_level
+        elif kind == 'spike' and len(args) == 2:
+            spike_level, secs = args
+            phases.append(('spike to %g' % spike_level, t, t + secs))
+            points.extend([(t, spike_level), (t + secs, spike_level),
+                           (t + secs, level)])
+            t += secs
+        else:
+            raise ValueError('Bad load profile phase: %s' % phase.strip())
+    return LoadProfile(points, phases)
+
+
+def parse_steps(value):
+    steps = []
+    for step in value.split(','):
+        if '@' in step:
+            level, start = step.split('@')
+        else:
+            level, start = step, 0
+        steps.append((float(start), float(level)))
+    steps.sort()
+
+    points = []
+    phases = []
+    for i, (start, level) in enumerate(steps):
+        if points:
+            points.append((start, points[-1][1]))
+        points.append((start, level))
+        end = steps[i + 1][0] if i + 1 < len(steps) else None
+        phases.append(('at %g' % level, start, end))
+    if points[0][0] > 0:
+        points.insert(0, (0.0, 0.0))
+    return LoadProfile(points, phases)
+
+
+def save_phases(output_dir, phases):
+    """
+    Save the phases of every user group's load profile, as a dict of user
+    group name -> list of (name, start, end).
+    """
+    with open(os.path.join(output_dir, PHASES_FILE), 'wb') as f:
+        json.dump(phases, f)
+
+
+def load_phases(results_dir):
+    file_name = os.path.join(results_dir, PHASES_FILE)
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, 'rb') as f:
+        return json.load(f)
+
+
+class Dispatcher(threading.Thread):
+    """
+    Puts the intended start time (a ``timing.clock_ns`` time) of every
+    transaction on the ``jobs`` queue, exactly when it is due, whether or
+    not an agent is free to pick it up. Puts a None for each of
+    ``num_agents`` at the end.
+    """
+    def __init__(self, jobs, profile, run_clock, run_time, num_agents):
+        threading.Thread.__init__(self)
+        self.jobs = jobs
+        self.profile = profile
+        self.run_clock = run_clock
+        self.run_time = run_time
+        self.num_agents = num_agents
+
+    def run(self):
+        for t in self.profile.intended_starts(self.run_time):
+            intended = self.run_clock.to_ns(t)
+            delay = (intended - timing.clock_ns()) * 1e-9
+            if delay > 0:
+                time.sleep(delay)
+            self.jobs.put(intended)
+        for i in range(self.num_agents):
+            self.jobs.put(None)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""
+mergeable latency histograms with a bounded relative error
+
+Values are counted in log-linear buckets, in the style of HdrHistogram:
+below ``LINEAR_UNITS`` every ``UNIT`` gets its own bucket, above that every
+power of two is split into ``2 ** PRECISION`` equal buckets. A value is
+reported as the middle of its bucket, which is never more than
+``1 / 2 ** (PRECISION + 1)`` of the value away from it.
+
+Histograms of the same timer can be added together, whichever process,
+node or interval they were filled in.
+"""
+
+import os
+
+import numpy as np
+
+# first try to import a fast newer version of simplejson
+try:
+    import simplejson as json
+except ImportError:
+    # fall back to the old, slow library version
+    import json
+
+# smallest distinguishable value, in seconds
+UNIT = 1e-6
+# every power of two is split into 2 ** PRECISION buckets
+PRECISION = 7
+# values from 2 ** MAX_BITS units (about 12 days) up share the last bucket
+MAX_BITS = 40
+
+SUB_BUCKETS = 1 << PRECISION
+LINEAR_UNITS = 1 << (PRECISION + 1)
+MAX_UNITS = 1 << MAX_BITS
+
+SKETCHES_FILE = 'sketches.json'
+
+
+def bucket_indexes(values):
+    """Returns the bucket index of every value (in seconds)."""
+    units = np.floor(np.asarray(values, dtype=float) / UNIT)
+    units = np.clip(units, 0, MAX_UNITS - 1).astype(np.int64)
+    indexes = units.copy()
+    big = units >= LINEAR_UNITS
+    big_units = units[big]
+    # frexp is exact for integers, unlike log2
+    shift = np.frexp(big_units)[1].astype(np.int64) - 1 - PRECISION
+    indexes[big] = (LINEAR_UNITS + (shift - 1) * SUB_BUCKETS +
+                    np.right_shift(big_units, shift) - SUB_BUCKETS)
+    return indexes
+
+
+def bucket_values(indexes):
+    """Returns the value (in seconds) in the middle of every bucket."""
+    indexes = np.asarray(indexes, dtype=np.int64)
+    lower = indexes.astype(float)
+    width = np.ones(len(indexes))
+    big = indexes >= LINEAR_UNITS
+    k = indexes[big] - LINEAR_UNITS
+    shift = k // SUB_BUCKETS + 1
+    width[big] = 2.0 ** shift
+    lower[big] = (k % SUB_BUCKETS + SUB_BUCKETS) * width[big]
+    return (lower + width / 2.0) * UNIT
+
+
+class LatencyHistogram(object):
+    """
+    Counts of values per bucket, plus their exact count, sum, sum of
+    squares, min and max.
+
+    Only the range of buckets that has been used is kept in memory.
+    """
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def record(self, values):
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return
+        indexes = bucket_indexes(values)
+        first = indexes.min()
+        self.add_counts(first, np.bincount(indexes - first))
+        self.count += len(values)
+        self.sum += float(values.sum())
+        self.sum_sq += float(np.dot(values, values))
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def add_counts(self, offset, counts):
+        """Add ``counts`` to the buckets starting at index ``offset``."""
+        if not len(self.counts):
+            self.offset = offset
+            self.counts = np.array(counts, dtype=np.int64)
+            return
+        start = min(self.offset, offset)
+        end = max(self.offset + len(self.counts), offset + len(counts))
+        if start != self.offset or end != self.offset + len(self.counts):
+            grown = np.zeros(end - start, dtype=np.int64)
+            grown[self.offset - start:
+                  self.offset - start + len(self.counts)] = self.counts
+            self.offset = start
+            self.counts = grown
+        self.counts[offset - start:offset - start + len(counts)] += counts
+
+    def __iadd__(self, other):
+        if other.count:
+            self.add_counts(other.offset, other.counts)
+            self.count += other.count
+            self.sum += other.sum
+            self.sum_sq += other.sum_sq
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        return self
+
+    def __add__(self, other):
+        merged = LatencyHistogram()
+        merged += self
+        merged += other
+        return merged
+
+    def percentiles(self, pcts):
+        """Returns the value at each of the ``pcts`` percentiles."""
+        pcts = np.asarray(pcts, dtype=float)
+        if not self.count:
+            return np.repeat(np.nan, len(pcts))
+        ranks = np.maximum(np.ceil(pcts / 100.0 * self.count), 1)
+        buckets = np.searchsorted(np.cumsum(self.counts), ranks)
+        values = bucket_values(buckets + self.offset)
+        return np.clip(values, self.min, self.max)
+
+    def summary(self, pcts):
+        """
+        Returns the count, min, avg, max, stdev and pct_<n> of the values,
+        named like the summaries in ``results``.
+        """
+        summary = dict(count=self.count, min=self.min, max=self.max)
+        if self.count:
+            summary['avg'] = self.sum / self.count
+        else:
+            summary['avg'] = float('nan')
+        if self.count > 1:
+            variance = ((self.sum_sq - self.sum * self.sum / self.count)
+                        / (self.count - 1))
+            summary['stdev'] = max(variance, 0) ** 0.5
+        else:
+            summary['stdev'] = float('nan')
+        for p, q in zip(pcts, self.percentiles(pcts).tolist()):
+            summary[pct_name(p)] = q
+        return summary
+
+    def to_dict(self):
+        nonzero = np.flatnonzero(self.counts)
+        return dict(
+            count=self.count, sum=self.sum, sum_sq=self.sum_sq,
+            min=self.min, max=self.max,
+            buckets=(nonzero + self.offset).tolist(),
+            counts=self.counts[nonzero].tolist())
+
+    @classmethod
+    def from_dict(cls, d):
+        histogram = cls()
+        if d['buckets']:
+            buckets = np.array(d['buckets'], dtype=np.int64)
+            counts = np.zeros(buckets[-1] - buckets[0] + 1, dtype=np.int64)
+            counts[buckets - buckets[0]] = d['counts']
+            histogram.add_counts(buckets[0], counts)
+        histogram.count = d['count']
+        histogram.sum = d['sum']
+        histogram.sum_sq = d['sum_sq']
+        histogram.min = d['min']
+        histogram.max = d['max']
+        return histogram
+
+
+def pct_name(p):
+    """pct_50 for 50, pct_99_9 for 99.9"""
+    return 'pct_%s' % str(p).replace('.', '_')
+
+
+class TimerSketches(object):
+    """
+    A ``LatencyHistogram`` for every timer over the whole run, and one for
+    every timer in every ``interval`` seconds of it.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.timers = {}
+        self.intervals = {}
+
+    def record(self, timer_name, times, values):
+        """
+        Record the ``values`` of a timer, measured ``times`` seconds after
+        the start of the run.
+        """
+        if not len(values):
+            return
+        self.timers.setdefault(timer_name, LatencyHistogram()).record(values)
+        timer_intervals = self.intervals.setdefault(timer_name, {})
+        keys = (np.asarray(times) // self.interval).astype(np.int64)
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        values = np.asarray(values)[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+        ends = np.concatenate((starts[1:], [len(keys)]))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            key = int(keys[start]) * self.interval
+            timer_intervals.setdefault(key, LatencyHistogram()).record(
+                values[start:end])
+
+    def record_batch(self, batch, start_time, run_time=None):
+        """
+        Record the transaction times and custom timers of a
+        ``transport.ResultBatch``. Like ``results.Results``, transactions
+        that finished ``run_time`` seconds or more into the run are left
+        out.
+        """
+        records = batch.records
+        timer_ids, times, values = batch.timer_samples(start_time)
+        if run_time is not None:
+            keep = records['elapsed'] < run_time
+            records = records[keep]
+            sample_keep = keep[batch.samples['trans']]
+            timer_ids = timer_ids[sample_keep]
+            times = times[sample_keep]
+            values = values[sample_keep]
+        self.record('Transactions', records['start'], records['trans_time'])
+        for timer_id in np.unique(timer_ids).tolist():
+            mask = timer_ids == timer_id
+            self.record(batch.strings[timer_id], times[mask], values[mask])
+
+    def __iadd__(self, other):
+        for timer_name, histogram in other.timers.iteritems():
+            self.timers.setdefault(timer_name, LatencyHistogram())
+            self.timers[timer_name] += histogram
+        for timer_name, timer_intervals in other.intervals.iteritems():
+            mine = self.intervals.setdefault(timer_name, {})
+            for key, histogram in timer_intervals.iteritems():
+                mine.setdefault(key, LatencyHistogram())
+                mine[key] += histogram
+        return self
+
+    def to_dict(self):
+        return dict(
+            interval=self.interval,
+            timers=dict((name, h.to_dict())
+                        for name, h in self.timers.iteritems()),
+            intervals=dict(
+                (name, [[key, h.to_dict()]
+                        for key, h in sorted(timer_intervals.iteritems())])
+                for name, timer_intervals in self.intervals.iteritems()))
+
+    @classmethod
+    def from_dict(cls, d):
+        sketches = cls(d['interval'])
+        for name, h in d['timers'].iteritems():
+            sketches.timers[name] = LatencyHistogram.from_dict(h)
+        for name, timer_intervals in d['intervals'].iteritems():
+            sketches.intervals[name] = dict(
+                (key, LatencyHistogram.from_dict(h))
+                for key, h in timer_intervals)
+        return sketches
+
+    def save(self, results_dir):
+        with open(os.path.join(results_dir, SKETCHES_FILE), 'wb') as f:
+            json.dump(self.to_dict(), f)
+
+
+def load_sketches(results_dir):
+    """Returns the ``TimerSketches`` saved in ``results_dir``, if any."""
+    file_name = os.path.join(results_dir, SKETCHES_FILE)
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, 'rb') as f:
+        return TimerSketches.from_dict(json.load(f))
@@ -0,0 +1,280 @@
+/*
+ * Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+ * License: GNU LGPLv3
+ *
+ * This file is part of Multi-Mechanize
+ *
+ * Small canvas charts for the interactive results report. No other
+ * libraries, no network: the report works from the local disk.
+ *
+ *   MMCharts.lineChart(element, {x: [...], series: [{label, color, y}],
+ *                                xLabel, yLabel})
+ *   MMCharts.barChart(element, {edges: [...], counts: [...],
+ *                               xLabel, yLabel})
+ *
+ * Drag across a line chart to zoom in on that time range, double click to
+ * zoom back out. Lines are drawn as the min and max of every pixel
+ * column, so even very long series draw quickly.
+ */
+
+var MMCharts = (function () {
+    var WIDTH = 760, HEIGHT = 260;
+    var MARGIN = {left: 60, right: 15, top: 25, bottom: 40};
+    var FONT = '10px Verdana, sans-serif';
+
+    // about n round numbers between lo and hi
+    function ticks(lo, hi, n) {
+        if (!(hi > lo)) {
+            hi = lo + 1;
+        }
+        var raw = (hi - lo) / n;
+        var mag = Math.pow(10, Math.floor(Math.log(raw) / Math.LN10));
+        var steps = [1, 2, 5, 10];
+        var step = mag;
+        for (var i = 0; i < steps.length; i++) {
+            if (raw <= steps[i] * mag) {
+                step = steps[i] * mag;
+                break;
+            }
+        }
+        var result = [];
+        for (var t = Math.ceil(lo / step) * step; t <= hi + step * 1e-9; t += step) {
+            result.push(Math.abs(t) < step * 1e-9 ? 0 : t);
+        }
+        return result;
+    }
+
+    function format(v) {
+        if (v === null || isNaN(v)) {
+            return '';
+        }
+        return String(Math.abs(v) >= 1000 ? Math.round(v) : +v.toPrecision(4));
+    }
+
+    function makeCanvas(element) {
+        var ratio = window.devicePixelRatio || 1;
+        var canvas = document.createElement('canvas');
+        canvas.width = WIDTH * ratio;
+        canvas.height = HEIGHT * ratio;
+        canvas.style.width = WIDTH + 'px';
+        canvas.style.height = HEIGHT + 'px';
+        element.appendChild(canvas);
+        var ctx = canvas.getContext('2d');
+        ctx.scale(ratio, ratio);
+        return canvas;
+    }
+
+    function Plot(canvas, xRange, yRange) {
+        this.canvas = canvas;
+        this.ctx = canvas.getContext('2d');
+        this.x0 = xRange[0];
+        this.x1 = xRange[1] > xRange[0] ? xRange[1] : xRange[0] + 1;
+        this.y0 = yRange[0];
+        this.y1 = yRange[1] > yRange[0] ? yRange[1] : yRange[0] + 1;
+        this.w = WIDTH - MARGIN.left - MARGIN.right;
+        this.h = HEIGHT - MARGIN.top - MARGIN.bottom;
+    }
+
+    Plot.prototype.px = function (x) {
+        return MARGIN.left + (x - this.x0) / (this.x1 - this.x0) * this.w;
+    };
+
+    Plot.prototype.py = function (y) {
+        return MARGIN.top + this.h - (y - this.y0) / (this.y1 - this.y0) * this.h;
+    };
+
+    Plot.prototype.xAt = function (px) {
+        return this.x0 + (px - MARGIN.left) / this.w * (this.x1 - this.x0);
+    };
+
+    Plot.prototype.axes = function (xLabel, yLabel) {
+        var ctx = this.ctx, i, t;
+        ctx.clearRect(0, 0, WIDTH, HEIGHT);
+        ctx.font = FONT;
+        ctx.strokeStyle = '#CCCCCC';
+        ctx.fillStyle = '#000000';
+        ctx.lineWidth = 1;
+        var xTicks = ticks(this.x0, this.x1, 8);
+        ctx.textAlign = 'center';
+        ctx.textBaseline = 'top';
+        for (i = 0; i < xTicks.length; i++) {
+            t = Math.round(this.px(xTicks[i])) + 0.5;
+            ctx.beginPath();
+            ctx.moveTo(t, MARGIN.top);
+            ctx.lineTo(t, MARGIN.top + this.h);
+            ctx.stroke();
+            ctx.fillText(format(xTicks[i]), t, MARGIN.top + this.h + 4);
+        }
+        var yTicks = ticks(this.y0, this.y1, 5);
+        ctx.textAlign = 'right';
+        ctx.textBaseline = 'middle';
+        for (i = 0; i < yTicks.length; i++) {
+            t = Math.round(this.py(yTicks[i])) + 0.5;
+            ctx.beginPath();
+            ctx.moveTo(MARGIN.left, t);
+            ctx.lineTo(MARGIN.left + this.w, t);
+            ctx.stroke();
+            ctx.fillText(format(yTicks[i]), MARGIN.left - 4, t);
+        }
+        ctx.strokeStyle = '#666666';
+        ctx.strokeRect(MARGIN.left + 0.5, MARGIN.top + 0.5, this.w, this.h);
+        ctx.textAlign = 'center';
+        ctx.textBaseline = 'bottom';
+        ctx.fillText(xLabel || '', MARGIN.left + this.w / 2, HEIGHT - 2);
+        ctx.save();
+        ctx.translate(12, MARGIN.top + this.h / 2);
+        ctx.rotate(-Math.PI / 2);
+        ctx.textBaseline = 'middle';
+        ctx.fillText(yLabel || '', 0, 0);
+        ctx.restore();
+    };
+
+    // the line through (x[i], y[i]), one vertical stroke per pixel column
+    Plot.prototype.line = function (x, y, color) {
+        var ctx = this.ctx;
+        ctx.save();
+        ctx.beginPath();
+        ctx.rect(MARGIN.left, MARGIN.top, this.w, this.h);
+        ctx.clip();
+        ctx.strokeStyle = color;
+        ctx.lineWidth = 1.5;
+        ctx.beginPath();
+        var column = null, lo = 0, hi = 0, last = 0, started = false;
+        function flush() {
+            if (column === null) {
+                return;
+            }
+            if (!started) {
+                ctx.moveTo(column, lo);
+                started = true;
+            }
+            ctx.lineTo(column, lo);
+            ctx.lineTo(column, hi);
+            ctx.lineTo(column, last);
+        }
+        for (var i = 0; i < x.length; i++) {
+            if (y[i] === null || x[i] < this.x0 && x[i + 1] < this.x0 ||
+                    x[i] > this.x1 && x[i - 1] > this.x1) {
+                continue;
+            }
+            var cx = Math.round(this.px(x[i])), cy = this.py(y[i]);
+            if (cx !== column) {
+                flush();
+                column = cx;
+                lo = hi = cy;
+            }
+            lo = Math.min(lo, cy);
+            hi = Math.max(hi, cy);
+            last = cy;
+        }
+        flush();
+        ctx.stroke();
+        ctx.restore();
+    };
+
+    Plot.prototype.legend = function (series) {
+        var ctx = this.ctx, x = MARGIN.left;
+        ctx.font = FONT;
+        ctx.textAlign = 'left';
+        ctx.textBaseline = 'middle';
+        for (var i = 0; i < series.length; i++) {
+            ctx.fillStyle = series[i].color;
+            ctx.fillRect(x, 8, 10, 4);
+            ctx.fillStyle = '#000000';
+            ctx.fillText(series[i].label, x + 14, 10);
+            x += 24 + ctx.measureText(series[i].label).width;
+        }
+    };
+
+    function extent(values, lo, hi) {
+        for (var i = 0; i < values.length; i++) {
+            if (values[i] !== null) {
+                lo = Math.min(lo, values[i]);
+                hi = Math.max(hi, values[i]);
+            }
+        }
+        return [lo, hi];
+    }
+
+    function lineChart(element, options) {
+        var canvas = makeCanvas(element);
+        var x = options.x, series = options.series;
+        var full = [x.length ? x[0] : 0, x.length ? x[x.length - 1] : 1];
+        var view = full.slice();
+
+        function draw(selection) {
+            var yMax = 0, i, j;
+            for (i = 0; i < series.length; i++) {
+                for (j = 0; j < x.length; j++) {
+                    if (x[j] >= view[0] && x[j] <= view[1] && series[i].y[j] !== null) {
+                        yMax = Math.max(yMax, series[i].y[j]);
+                    }
+                }
+            }
+            var plot = new Plot(canvas, view, [0, yMax * 1.05]);
+            plot.axes(options.xLabel, options.yLabel);
+            for (i = 0; i < series.length; i++) {
+                plot.line(x, series[i].y, series[i].color);
+            }
+            plot.legend(series);
+            if (selection) {
+                plot.ctx.fillStyle = 'rgba(51, 102, 204, 0.2)';
+                plot.ctx.fillRect(Math.min(selection[0], selection[1]), MARGIN.top,
+                                  Math.abs(selection[1] - selection[0]), plot.h);
+            }
+            return plot;
+        }
+
+        var plot = draw(), dragStart = null;
+        function offsetX(event) {
+            return event.clientX - canvas.getBoundingClientRect().left;
+        }
+        canvas.onmousedown = function (event) {
+            dragStart = offsetX(event);
+        };
+        canvas.onmousemove = function (event) {
+            if (dragStart !== null) {
+                draw([dragStart, offsetX(event)]);
+            }
+        };
+        canvas.onmouseup = function (event) {
+            var end = offsetX(event);
+            if (dragStart !== null && Math.abs(end - dragStart) > 3) {
+                var a = plot.xAt(Math.min(dragStart, end));
+                var b = plot.xAt(Math.max(dragStart, end));
+                view = [Math.max(a, full[0]), Math.min(b, full[1])];
+            }
+            dragStart = null;
+            plot = draw();
+        };
+        canvas.onmouseleave = function () {
+            if (dragStart !== null) {
+                dragStart = null;
+                plot = draw();
+            }
+        };
+        canvas.ondblclick = function () {
+            view = full.slice();
+            plot = draw();
+        };
+        canvas.title = 'drag to zoom in, double click to zoom out';
+    }
+
+    function barChart(element, options) {
+        var canvas = makeCanvas(element);
+        var edges = options.edges, counts = options.counts;
+        var plot = new Plot(canvas, [edges[0], edges[edges.length - 1]],
+                            [0, extent(counts, 0, 0)[1] * 1.05]);
+        plot.axes(options.xLabel, options.yLabel);
+        var ctx = plot.ctx;
+        ctx.fillStyle = options.color || '#3366CC';
+        for (var i = 0; i < counts.length; i++) {
+            var left = plot.px(edges[i]), right = plot.px(edges[i + 1]);
+            var top = plot.py(counts[i]);
+            ctx.fillRect(left, top, Math.max(right - left - 1, 1),
+                         plot.py(0) - top);
+        }
+    }
+
+    return {lineChart: lineChart, barChart: barChart, format: format};
+})();
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""
+a monotonic clock for timing transactions and the waits between them
+
+Everything in a run is timed in integer nanoseconds of one monotonic clock,
+which NTP and changes to the system time don't affect. It is converted to
+wall clock time with a single offset, taken once.
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+import sys
+import time
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _linux_monotonic_ns():
+    """time.monotonic_ns() for python 2 on linux, or None if unavailable."""
+    CLOCK_MONOTONIC = 1
+    for name in ('rt', 'c'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        break
+    else:
+        return None
+
+    def monotonic_ns():
+        t = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'clock_gettime failed')
+        return t.tv_sec * 1000000000 + t.tv_nsec
+    return monotonic_ns
+
+
+def _float_ns(clock):
+    return lambda: int(clock() * 1e9)
+
+
+def _choose_clock():
+    """
+    Returns the nanosecond clock, and whether it is the same for every
+    process on the machine.
+    """
+    if hasattr(time, 'monotonic_ns'):
+        return time.monotonic_ns, True
+    if hasattr(time, 'monotonic'):
+        return _float_ns(time.monotonic), True
+    if sys.platform.startswith('linux'):
+        monotonic_ns = _linux_monotonic_ns()
+        if monotonic_ns is not None:
+            return monotonic_ns, True
+    if sys.platform.startswith('win'):
+        # time.clock has finer granularity than time.time on windows, and
+        # doesn't follow changes to the system time, but it counts from the
+        # start of each process
+        return _float_ns(time.clock), False
+    return _float_ns(time.time), True
+
+# nanoseconds from an arbitrary starting point, never going backwards
+clock_ns, SYSTEM_WIDE = _choose_clock()
+
+
+def clock():
+    """The monotonic clock, in seconds."""
+    return clock_ns() * 1e-9
+
+# the one wall clock time this process converts monotonic times with
+_anchor_ns = clock_ns()
+_anchor_wall = time.time()
+
+
+def to_wall(ns):
+    """Wall clock time (seconds since the epoch) of a clock_ns() time."""
+    return _anchor_wall + (ns - _anchor_ns) * 1e-9
+
+
+def from_wall(t):
+    """clock_ns() time of a wall clock time."""
+    return _anchor_ns + int(round((t - _anchor_wall) * 1e9))
+
+
+class RunClock(object):
+    """
+    The start of a test run, shared by every process taking part in it.
+
+    Times during the run are kept as seconds since its start. As doubles,
+    those stay exact to the nanosecond for over 100 days, unlike seconds
+    since the epoch.
+    """
+    def __init__(self, start_time=None):
+        """Starts now, or at the wall clock time ``start_time``."""
+        if start_time is None:
+            self.start_ns = clock_ns()
+            start_time = to_wall(self.start_ns)
+        else:
+            self.start_ns = from_wall(start_time)
+        # wall clock time of the start, for converting times given by test
+        # scripts and for the report
+        self.start_time = start_time
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not SYSTEM_WIDE:
+            # another process, another clock
+            self.start_ns = from_wall(self.start_time)
+
+    def elapsed(self, ns=None):
+        """Seconds from the start of the run to clock_ns() time ``ns``."""
+        if ns is None:
+            ns = clock_ns()
+        return (ns - self.start_ns) * 1e-9
+
+    def to_ns(self, elapsed):
+        """clock_ns() time ``elapsed`` seconds into the run."""
+        return self.start_ns + int(round(elapsed * 1e9))
+
+
+@contextlib.contextmanager
+def timer(custom_timers, name):
+    """
+    Time the ``with`` block into the custom timer ``name``, as an
+    [exact start time, duration] pair, e.g.::
+
+        with timing.timer(self.custom_timers, 'Login'):
+            resp = br.open(url)
+    """
+    start = clock_ns()
+    try:
+        yield
+    finally:
+        duration = (clock_ns() - start) * 1e-9
+        custom_timers.setdefault(name, []).append([to_wall(start), duration])
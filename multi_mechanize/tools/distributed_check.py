@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+
+
+"""
+checks of a controller run through two local load nodes that share the
+controller's results_database: the database gets the merged run once, and
+the post_run_script runs once, on the controller
+
+usage: distributed_check.py
+"""
+
+
+import glob
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import xmlrpclib
+
+from sqlalchemy import create_engine
+
+import multi_mechanize
+
+
+MM_ROOT = multi_mechanize.__path__[0]
+MM_SCRIPT = os.path.join(MM_ROOT, 'bin', 'multi-mechanize.py')
+
+CONFIG = """\
+[global]
+run_time: 4
+rampup: 1
+console_logging: off
+results_ts_interval: 1
+results_database: sqlite:///%(database)s
+post_run_script: %(post_run_script)s
+
+[user_group-1]
+threads: 3
+script: example_mock.py
+"""
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def clone_project(tmp_dir, name, env):
+    project_path = os.path.join(tmp_dir, name)
+    subprocess.check_call(
+        [sys.executable, MM_SCRIPT, project_path, '--clone-test-project'],
+        env=env, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    # short transactions, so a short run has plenty of them
+    script = os.path.join(project_path, 'test_scripts', 'example_mock.py')
+    with open(script) as f:
+        code = f.read()
+    with open(script, 'w') as f:
+        f.write(code.replace('random.uniform(1, 2)',
+                             'random.uniform(0.01, 0.02)'))
+    return project_path
+
+
+def wait_for_node(host, port, timeout=30):
+    proxy = xmlrpclib.ServerProxy('http://%s:%i' % (host, port))
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return not proxy.check_test_running()
+        except socket.error:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.2)
+
+
+def check(name, passed):
+    print '%-55s %s' % (name, 'ok' if passed else 'FAILED')
+    return passed
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(MM_ROOT)] +
+        os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    nodes = []
+    try:
+        database = os.path.join(tmp_dir, 'results.db')
+        post_run_log = os.path.join(tmp_dir, 'post_run.log')
+        post_run_script = os.path.join(tmp_dir, 'post_run.sh')
+        with open(post_run_script, 'w') as f:
+            f.write('#!/bin/sh\necho ran >> %s\n' % post_run_log)
+        os.chmod(post_run_script, 0755)
+
+        controller_path = clone_project(tmp_dir, 'controller', env)
+        with open(os.path.join(controller_path, 'config.cfg'), 'w') as f:
+            f.write(CONFIG % dict(database=database,
+                                  post_run_script=post_run_script))
+
+        # the host the nodes' rpc servers listen on
+        host = socket.gethostbyaddr(socket.gethostname())[0]
+        addresses = []
+        for name in ('node-1', 'node-2'):
+            node_path = clone_project(tmp_dir, name, env)
+            port = free_port()
+            log = open(os.path.join(tmp_dir, name + '.log'), 'w')
+            nodes.append(subprocess.Popen(
+                [sys.executable, MM_SCRIPT, node_path, '-p', str(port)],
+                env=env, stdout=log, stderr=subprocess.STDOUT))
+            addresses.append((host, port))
+        passed = check('both nodes are listening', all(
+            wait_for_node(host, port) for host, port in addresses))
+        if not passed:
+            return 1
+
+        status = subprocess.call(
+            [sys.executable, MM_SCRIPT, controller_path, '--controller',
+             ','.join('%s:%i' % address for address in addresses)],
+            env=env, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        passed &= check('the controller run succeeds', status == 0)
+
+        results_dirs = glob.glob(
+            os.path.join(controller_path, 'results', 'results_*'))
+        num_trans = 0
+        if len(results_dirs) == 1:
+            with open(os.path.join(results_dirs[0], 'results.csv')) as f:
+                num_trans = len(f.readlines())
+        passed &= check('the controller merged the nodes\' results',
+                        num_trans > 0)
+
+        engine = create_engine('sqlite:///' + database)
+        count, runs, distinct = engine.execute(
+            'SELECT count(*), count(DISTINCT run_id), '
+            'count(DISTINCT trans_count) FROM mechanize_results').fetchone()
+        passed &= check('the database holds the merged run, once',
+                        count == num_trans and runs == 1
+                        and distinct == count)
+        if os.path.exists(post_run_log):
+            with open(post_run_log) as f:
+                post_runs = len(f.readlines())
+        else:
+            post_runs = 0
+        passed &= check('the post_run_script runs once', post_runs == 1)
+        return 0 if passed else 1
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+
+
+"""
+checks of the HTTP client against a local stub server: connections are
+kept alive, only idempotent requests are sent again when the server closed
+a pooled connection, and timeouts are never retried
+
+usage: httpclient_check.py
+"""
+
+
+import BaseHTTPServer
+import httplib
+import socket
+import sys
+import threading
+import time
+
+from multi_mechanize import httpclient
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    ``/ok`` answers, ``/close`` answers and then closes the connection
+    without saying so, like a server whose keep-alive timeout ran out.
+    ``/slow`` answers after a second.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.answer()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self.answer()
+
+    def answer(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path,
+                                    self.client_address[1]))
+        if self.path == '/slow':
+            time.sleep(1)
+        body = 'stub'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/close':
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(BaseHTTPServer.HTTPServer):
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def process_request(self, request, client_address):
+        # a thread per connection, so a slow request doesn't hold up others
+        thread = threading.Thread(
+            target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        thread.start()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def count(self, path):
+        with self.lock:
+            return len([r for r in self.requests if r[1] == path])
+
+    def ports(self, path):
+        with self.lock:
+            return [r[2] for r in self.requests if r[1] == path]
+
+
+def check(name, passed):
+    print '%-55s %s' % (name, 'ok' if passed else 'FAILED')
+    return passed
+
+
+def main():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%i' % server.server_address[1]
+    passed = True
+
+    client = httpclient.HTTPClient()
+    timers = {}
+    for i in range(3):
+        client.get(url + '/ok', timers, 'ok')
+    passed &= check('keep-alive: 3 requests over one connection',
+                    len(set(server.ports('/ok'))) == 1)
+    passed &= check('every request is timed',
+                    len(timers['ok']) == 3 and 'ok_TTFB' in timers)
+
+    client.get(url + '/close')
+    time.sleep(0.2)
+    resp = client.get(url + '/ok')
+    passed &= check('GET on a closed pooled connection is sent again',
+                    resp.status == 200 and server.count('/ok') == 4)
+
+    client.get(url + '/close')
+    time.sleep(0.2)
+    try:
+        client.post(url + '/ok', 'data')
+        posted = True
+    except (httplib.HTTPException, socket.error):
+        posted = False
+    passed &= check('POST on a closed pooled connection is not resent',
+                    not posted and server.count('/ok') == 4)
+
+    slow_client = httpclient.HTTPClient(timeout=0.3)
+    slow_client.get(url + '/ok')
+    try:
+        slow_client.get(url + '/slow')
+        timed_out = False
+    except socket.timeout:
+        timed_out = True
+    time.sleep(1)
+    passed &= check('a timeout on a pooled connection is raised, not resent',
+                    timed_out and server.count('/slow') == 1)
+
+    try:
+        httpclient.HTTPClient(shared=True, timeout=1)
+        rejected = False
+    except ValueError:
+        rejected = True
+    passed &= check('shared=True rejects a timeout', rejected)
+
+    server.shutdown()
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
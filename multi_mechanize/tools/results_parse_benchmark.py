@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+
+
+"""
+benchmark of parsing a results.csv in one process, against parsing it in
+chunks in a process per CPU
+
+usage: results_parse_benchmark.py [number of transactions] [processes]
+"""
+
+
+import csv
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from multi_mechanize import results
+
+
+def write_results(file_name, num_trans):
+    """A classic results.csv with two custom timers per transaction."""
+    rng = random.Random(0)
+    with open(file_name, 'wb') as f:
+        writer = csv.writer(f)
+        for i in xrange(num_trans):
+            elapsed = i * 0.001
+            trans_time = rng.uniform(0.01, 0.2)
+            timers = {'Login': trans_time * 0.3, 'Search': trans_time * 0.6}
+            error = 'Bad HTTP Response' if rng.random() < 0.01 else ''
+            writer.writerow([i + 1, elapsed, 1300000000 + int(elapsed),
+                             'user_group-%i' % (i % 2), trans_time, error,
+                             json.dumps(timers), elapsed - trans_time])
+
+
+def same(a, b):
+    """Whether two parsed results hold the same values (NaN included)."""
+    for columns_a, columns_b in zip(a[:2], b[:2]):
+        for name in columns_a:
+            x, y = columns_a[name], columns_b[name]
+            if x.shape != y.shape:
+                return False
+            equal = x == y
+            if x.dtype.kind == 'f':
+                equal |= np.isnan(x) & np.isnan(y)
+            if not equal.all():
+                return False
+    return a[2] == b[2]
+
+
+def main():
+    num_trans = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    if len(sys.argv) > 2:
+        processes = int(sys.argv[2])
+    else:
+        processes = multiprocessing.cpu_count()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results_file = os.path.join(tmp_dir, 'results.csv')
+        write_results(results_file, num_trans)
+        print '%i transactions, %.1f MB, %i processes' % (
+            num_trans, os.path.getsize(results_file) / 1e6, processes)
+
+        times = {}
+        parsed = {}
+        for name, procs in (('serial', 1), ('parallel', processes)):
+            start = time.time()
+            parsed[name] = results.read_results_file(results_file, procs)
+            times[name] = time.time() - start
+            print '%-8s %8.2f secs  %10.0f transactions/sec' % (
+                name, times[name], num_trans / times[name])
+        print 'speedup: %.1fx' % (times['serial'] / times['parallel'])
+        print 'same results: %s' % same(parsed['serial'], parsed['parallel'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+
+
+"""
+benchmark of loading results into a database: one ORM object per row and a
+single commit, against the chunked executemany loader
+
+usage: resultsloader_benchmark.py [number of transactions]
+"""
+
+
+import csv
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from multi_mechanize import resultsloader
+
+
+class UserGroupConfig(object):
+    def __init__(self, num_threads, name, script_file):
+        self.num_threads = num_threads
+        self.name = name
+        self.script_file = script_file
+
+
+def write_results(file_name, num_trans):
+    """A classic results.csv with two custom timers per transaction."""
+    rng = random.Random(0)
+    with open(file_name, 'wb') as f:
+        writer = csv.writer(f)
+        for i in xrange(num_trans):
+            elapsed = i * 0.001
+            trans_time = rng.uniform(0.01, 0.2)
+            timers = {'Login': trans_time * 0.3, 'Search': trans_time * 0.6}
+            error = 'Bad HTTP Response' if rng.random() < 0.01 else ''
+            writer.writerow([i + 1, elapsed, 1300000000 + int(elapsed),
+                             'user_group-%i' % (i % 2), trans_time, error,
+                             json.dumps(timers), elapsed - trans_time])
+
+
+def load_orm(results_file, database, run_localtime, user_group_configs):
+    """The way results used to be loaded."""
+    engine = create_engine(database, echo=False)
+    resultsloader.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    run_id = datetime(*run_localtime[:6])
+    global_config = resultsloader.GlobalConfig(60, 0, 5)
+    session.add(global_config)
+    for ug_config in user_group_configs:
+        global_config.user_group_configs.append(resultsloader.UserGroupConfig(
+            ug_config.name, ug_config.num_threads, ug_config.script_file))
+    for fields in csv.reader(open(results_file, 'rb')):
+        result_row = resultsloader.ResultRow(
+            'benchmark', run_id, *fields[:7])
+        global_config.results.append(result_row)
+        for name, value in json.loads(fields[6]).iteritems():
+            result_row.timers.append(resultsloader.TimerRow(name, value))
+        session.add(result_row)
+    session.commit()
+    session.close()
+
+
+def load_bulk(results_file, database, run_localtime, user_group_configs):
+    resultsloader.load_results_database(
+        'benchmark', run_localtime, os.path.dirname(results_file), database,
+        60, 0, 5, user_group_configs, results_file)
+
+
+def main():
+    num_trans = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results_file = os.path.join(tmp_dir, 'results.csv')
+        write_results(results_file, num_trans)
+        run_localtime = time.localtime()
+        user_group_configs = [UserGroupConfig(10, 'user_group-0', 'a.py'),
+                              UserGroupConfig(10, 'user_group-1', 'b.py')]
+
+        times = {}
+        for name, load in (('orm', load_orm), ('bulk', load_bulk)):
+            database = 'sqlite:///%s' % os.path.join(tmp_dir, name + '.db')
+            start = time.time()
+            load(results_file, database, run_localtime, user_group_configs)
+            times[name] = time.time() - start
+            print '%-5s %8.2f secs  %10.0f transactions/sec' % (
+                name, times[name], num_trans / times[name])
+        print 'speedup: %.1fx' % (times['orm'] / times['bulk'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""batched, binary transport of transaction results from agents to the writer"""
+
+import struct
+import threading
+import time
+
+import numpy as np
+
+
+# one fixed-width record per transaction:
+#   start and finish (elapsed) in seconds since the start of the run, epoch,
+#   scriptrun_time, error string id (-1 when no error)
+RECORD = struct.Struct('<ddddi')
+RECORD_DTYPE = np.dtype([
+    ('start', '<f8'),
+    ('elapsed', '<f8'),
+    ('epoch', '<f8'),
+    ('trans_time', '<f8'),
+    ('error', '<i4'),
+])
+
+# one fixed-width record per custom timer value:
+#   index of the transaction in the batch, timer name string id,
+#   exact time of the sample (NaN when it belongs to the transaction), value
+SAMPLE = struct.Struct('<iidd')
+SAMPLE_DTYPE = np.dtype([
+    ('trans', '<i4'),
+    ('timer', '<i4'),
+    ('time', '<f8'),
+    ('value', '<f8'),
+])
+
+NO_ERROR = -1
+NAN = float('nan')
+
+# the error of an open workload transaction that never got an agent before
+# the end of the run
+MISSED_DISPATCH = 'Missed dispatch'
+
+# flush a batch once it holds this many transactions...
+BATCH_SIZE = 1000
+# ...or once its oldest transaction has waited this many seconds
+BATCH_DELAY = 0.5
+
+
+def iter_timer_samples(custom_timers):
+    """
+    Yields a (timer name, exact time, value) tuple for every value in a
+    ``custom_timers`` dict. The time is NaN for values without one.
+    """
+    for name, val in custom_timers.iteritems():
+        # the values in a custom timer can either be:
+        # (1) a single time delta (assumed to occur at the start of the transaction)
+        # (2) a list of time deltas (all assumed to occur at the start of the transaction)
+        # (3) (exact time, time delta) tuples
+        if not isinstance(val, (list, tuple)):
+            yield name, NAN, val
+        elif val and isinstance(val[0], (list, tuple)):
+            for t, v in val:
+                yield name, t, v
+        else:
+            for v in val:
+                yield name, NAN, v
+
+
+class ResultBatcher(object):
+    """
+    Collects the results of all agents in one user group process and ships
+    them to the results writer in batches.
+
+    Results are packed into fixed-layout binary buffers as they arrive, so a
+    flush is a single ``queue.put`` of a few byte strings instead of one
+    pickled tuple and dict per transaction.
+    """
+    def __init__(self, queue, user_group_name, process_num,
+                 batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY):
+        self.queue = queue
+        self.user_group_name = user_group_name
+        self.process_num = process_num
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.records = bytearray()
+        self.samples = bytearray()
+        self.num_records = 0
+        self.strings = []
+        self.string_ids = {}
+        self.batch_start = None
+
+    def _string_id(self, s):
+        try:
+            return self.string_ids[s]
+        except KeyError:
+            self.strings.append(s)
+            self.string_ids[s] = len(self.strings) - 1
+            return self.string_ids[s]
+
+    def add(self, start, elapsed, epoch, trans_time, error, custom_timers):
+        with self.lock:
+            if self.batch_start is None:
+                self.batch_start = time.time()
+            trans = self.num_records
+            if error:
+                error_id = self._string_id(error)
+            else:
+                error_id = NO_ERROR
+            self.records.extend(
+                RECORD.pack(start, elapsed, epoch, trans_time, error_id))
+            self.num_records += 1
+
+            for name, t, v in iter_timer_samples(custom_timers):
+                self.samples.extend(
+                    SAMPLE.pack(trans, self._string_id(name), t, v))
+
+            if (self.num_records >= self.batch_size or
+                    time.time() - self.batch_start >= self.batch_delay):
+                self._flush()
+
+    def flush(self, stale_only=False):
+        """
+        Send the pending batch to the writer.
+
+        With ``stale_only``, only send it if it has been waiting for longer
+        than ``batch_delay``.
+        """
+        with self.lock:
+            if self.batch_start is None:
+                return
+            if stale_only and time.time() - self.batch_start < self.batch_delay:
+                return
+            self._flush()
+
+    def _flush(self):
+        if self.num_records:
+            self.queue.put((
+                self.user_group_name,
+                self.process_num,
+                tuple(self.strings),
+                str(self.records),
+                str(self.samples)))
+        self._reset()
+
+
+class ResultBatch(object):
+    """
+    The writer-side view of one batch sent by a ``ResultBatcher``.
+
+    The binary buffers are decoded in bulk into NumPy record arrays.
+    """
+    def __init__(self, payload):
+        (self.user_group_name, self.process_num, self.strings,
+         records, samples) = payload
+        self.records = np.frombuffer(records, dtype=RECORD_DTYPE)
+        self.samples = np.frombuffer(samples, dtype=SAMPLE_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def error_count(self):
+        return int((self.records['error'] != NO_ERROR).sum())
+
+    def errors(self):
+        """Returns the error string of every transaction ('' for none)."""
+        strings = self.strings
+        return [strings[i] if i != NO_ERROR else ''
+                for i in self.records['error'].tolist()]
+
+    def timer_samples(self, start_time):
+        """
+        Returns the timer ids, times and values of the custom timer values in
+        the batch, with times in seconds since ``start_time``. Values without
+        an exact time are taken to start with their transaction.
+        """
+        samples = self.samples
+        times = samples['time']
+        times = np.where(np.isnan(times),
+                         self.records['start'][samples['trans']],
+                         times - start_time)
+        return samples['timer'], times, samples['value']
+
+    def custom_timers(self):
+        """
+        Returns the ``custom_timers`` dict of every transaction, in the same
+        shape the test script produced it.
+        """
+        return custom_timers_from_samples(
+            len(self.records), self.samples, self.strings)
+
+
+def custom_timers_from_samples(num_trans, samples, strings):
+    """
+    Rebuild the ``custom_timers`` dicts of ``num_trans`` transactions from
+    an array of timer samples, as laid out in ``SAMPLE_DTYPE``.
+    """
+    timers = [{} for _ in xrange(num_trans)]
+    for trans, timer_id, t, v in zip(
+            samples['trans'].tolist(), samples['timer'].tolist(),
+            samples['time'].tolist(), samples['value'].tolist()):
+        timers[trans].setdefault(strings[timer_id], []).append((t, v))
+    for trans_timers in timers:
+        for name, values in trans_timers.iteritems():
+            if values[0][0] == values[0][0]:
+                # exact times were given (case 3)
+                trans_timers[name] = [[t, v] for t, v in values]
+            elif len(values) == 1:
+                trans_timers[name] = values[0][1]
+            else:
+                trans_timers[name] = [v for t, v in values]
+    return timers
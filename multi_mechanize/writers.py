@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#
+#  This file is part of Multi-Mechanize
+"""on-disk formats the results writer can produce"""
+
+import csv
+import os
+
+import mmbin
+
+# first try to import a fast newer version of simplejson
+try:
+    import simplejson as json
+except ImportError:
+    # fall back to the old, slow library version
+    import json
+
+# size of the write buffer in front of each results file
+BUFFER_SIZE = 1 << 20
+
+RESULTS_CSV = 'results.csv'
+TIMERS_CSV = 'results_timers.csv'
+
+RESULTS_HEADER = ('trans_count', 'elapsed', 'epoch', 'user_group_name',
+                  'scriptrun_time', 'error', 'start')
+TIMERS_HEADER = ('trans_count', 'timer', 'time', 'value')
+
+
+class CSVWriter(object):
+    """
+    The classic ``results.csv``: one row per transaction, with the custom
+    timers of the transaction as a JSON object. The start of the
+    transaction, in seconds since the start of the run, follows it.
+    """
+    def __init__(self, output_dir):
+        self.filestream = open(
+            os.path.join(output_dir, RESULTS_CSV), 'wb', BUFFER_SIZE)
+        self.writer = csv.writer(self.filestream)
+
+    def write(self, trans_count, batch):
+        """Write ``batch``, whose first transaction is number ``trans_count``."""
+        records = batch.records
+        self.writer.writerows(zip(
+            xrange(trans_count, trans_count + len(batch)),
+            records['elapsed'].tolist(),
+            records['epoch'].tolist(),
+            [batch.user_group_name] * len(batch),
+            records['trans_time'].tolist(),
+            batch.errors(),
+            [json.dumps(t) for t in batch.custom_timers()],
+            records['start'].tolist()))
+
+    def close(self):
+        self.filestream.close()
+
+
+class ColumnarWriter(object):
+    """
+    ``results.csv`` with a header and only the per-transaction columns, plus
+    ``results_timers.csv`` with one row per custom timer value.
+
+    The timer name, time and value each get their own plain column, so
+    nothing has to be encoded to or parsed from JSON. The time column is
+    left empty when the value belongs to the transaction itself.
+    """
+    def __init__(self, output_dir):
+        self.results_stream = open(
+            os.path.join(output_dir, RESULTS_CSV), 'wb', BUFFER_SIZE)
+        self.timers_stream = open(
+            os.path.join(output_dir, TIMERS_CSV), 'wb', BUFFER_SIZE)
+        self.results_writer = csv.writer(self.results_stream)
+        self.timers_writer = csv.writer(self.timers_stream)
+        self.results_writer.writerow(RESULTS_HEADER)
+        self.timers_writer.writerow(TIMERS_HEADER)
+
+    def write(self, trans_count, batch):
+        """Write ``batch``, whose first transaction is number ``trans_count``."""
+        records = batch.records
+        self.results_writer.writerows(zip(
+            xrange(trans_count, trans_count + len(batch)),
+            records['elapsed'].tolist(),
+            records['epoch'].tolist(),
+            [batch.user_group_name] * len(batch),
+            records['trans_time'].tolist(),
+            batch.errors(),
+            records['start'].tolist()))
+
+        samples = batch.samples
+        strings = batch.strings
+        self.timers_writer.writerows(zip(
+            (samples['trans'] + trans_count).tolist(),
+            [strings[i] for i in samples['timer'].tolist()],
+            [repr(t) if t == t else '' for t in samples['time'].tolist()],
+            samples['value'].tolist()))
+
+    def close(self):
+        self.results_stream.close()
+        self.timers_stream.close()
+
+
+class BinaryWriter(mmbin.MMBinWriter):
+    """
+    The compact binary format, see ``mmbin``. Meant for long runs, it is
+    much smaller than the CSV formats and is memory-mapped for analysis.
+    """
+    def __init__(self, output_dir):
+        mmbin.MMBinWriter.__init__(self, output_dir, BUFFER_SIZE)
+
+
+WRITERS = {
+    'csv': CSVWriter,
+    'columnar': ColumnarWriter,
+    'binary': BinaryWriter,
+}
+RESULTS_FORMATS = sorted(WRITERS)
+
+# the file the analysis reads for each format
+RESULTS_FILES = {
+    'csv': RESULTS_CSV,
+    'columnar': RESULTS_CSV,
+    'binary': mmbin.RESULTS_FILE,
+}
+
+
+def open_writer(results_format, output_dir):
+    return WRITERS[results_format](output_dir)
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+#
+#  Copyright (c) 2010 Corey Goldberg (corey@goldb.org)
+#  License: GNU LGPLv3
+#  
+#  This file is part of Multi-Mechanize
+
+
+from multi_mechanize import httpclient
+
+
+
+class Transaction(object):
+    def __init__(self):
+        self.custom_timers = {}
+        # keeps its connections open from one run to the next
+        self.http = httpclient.HTTPClient()
+    
+    def run(self):
+        # times the request, and its DNS, connect, TTFB and transfer phases
+        resp = self.http.get('http://www.example.com/', self.custom_timers,
+                             'Example_Homepage')
+        
+        assert (resp.status == 200), 'Bad HTTP Response'
+        assert ('Example Web Page' in resp.body), 'Failed Content Verification'
+
+
+if __name__ == '__main__':
+    trans = Transaction()
+    trans.run()
+    print trans.custom_timers